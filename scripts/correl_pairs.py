@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+"""
+Stream all-pairs feature correlations from a table as an edge list
+===============================================
+Author: Eric Franzosa (eric.franzosa@gmail.com)
+"""
+
+from __future__ import print_function
+
+import sys
+import argparse
+
+import numpy as np
+
+from zopy.utils import iter_rows, tprint, say
+from zopy.correlations import iter_edges, c_methods, c_block, c_min_n
+
+# constants
+c_na_values = {"", "NA", "NaN", "nan", "#N/A"}
+
+def get_args( ):
+    parser = argparse.ArgumentParser( )
+    parser.add_argument( "table", help="features (rows) x samples (cols) table" )
+    parser.add_argument( "-l", "--last-metadata", help="last metadata row (skipped)" )
+    parser.add_argument( "-m", "--method", choices=c_methods, default="spearman",
+                         help="pearson (linear) or spearman (rank) correlation" )
+    parser.add_argument( "-t", "--threshold", type=float, default=0.0, help="min |r| to report" )
+    parser.add_argument( "-p", "--max-p", type=float, default=None, help="max pvalue to report" )
+    parser.add_argument( "-n", "--min-n", type=int, default=c_min_n, help="min pairwise-complete samples" )
+    parser.add_argument( "-b", "--block", type=int, default=c_block, help="rows per tile" )
+    args = parser.parse_args( )
+    return args
+
+def load( path, last_metadata=None ):
+    names, rows = [], []
+    in_data = last_metadata is None
+    for i, row in enumerate( iter_rows( path ) ):
+        if i == 0:
+            continue
+        elif not in_data:
+            in_data = row[0] == last_metadata
+            continue
+        names.append( row[0] )
+        rows.append( [float( k ) if k not in c_na_values else np.nan for k in row[1:]] )
+    return names, np.array( rows )
+
+def main( ):
+    args = get_args( )
+    names, data = load( args.table, args.last_metadata )
+    say( "Correlating {:,} features over {:,} samples".format( *data.shape ) )
+    tprint( "FEATURE1", "FEATURE2", args.method.upper( ), "P_VALUE", "N" )
+    for name1, name2, r, p, n in iter_edges(
+            data,
+            names=names,
+            method=args.method,
+            threshold=args.threshold,
+            max_p=args.max_p,
+            min_n=args.min_n,
+            block=args.block, ):
+        tprint( name1, name2, "%.6g" % r, "%.6g" % p, n )
+
+if __name__ == "__main__":
+    main( )
@@ -5,8 +5,9 @@ import argparse
 import csv
 
 from zopy.utils import try_open, say, die
-from zopy.dictation import col2dict, polymap
+from zopy.dictation import col2dict, compact_polymap
 from zopy.enrichments import fisher_enrich, c_fisher_fields
+from zopy.diskcache import disk_memoize
 
 #-------------------------------------------------------------------------------
 # utils shared with enrich_rank
@@ -37,6 +38,9 @@ def add_common_args( parser ):
     parser.add_argument( "-o", "--outfile",
                          default=None,
                          help="Where to put the output" )
+    parser.add_argument( "-c", "--cache",
+                         default=None,
+                         help="Binary (.npz) cache of the gene set mapping; built on first use" )
     return None
 
 #-------------------------------------------------------------------------------
@@ -81,11 +85,12 @@ def main( ):
             headers=args.skip_headers, )
         background = {g:(g if k is None else k) for g, k in background.items( )}
     # load gene sets
-    gene_sets = polymap(
+    gene_sets = compact_polymap(
         args.gene_sets,
-        reverse=args.reversed_mapping, )
-    # run analysis
-    results = fisher_enrich( 
+        reverse=args.reversed_mapping,
+        cache=args.cache, )
+    # run analysis (reusing results of identical earlier runs)
+    results = disk_memoize( fisher_enrich )( 
         genes,
         gene_sets,
         depletions=not args.exclude_depletions,
@@ -5,8 +5,9 @@ import argparse
 import csv
 
 from zopy.utils import try_open, say
-from zopy.dictation import col2dict, polymap
+from zopy.dictation import col2dict, compact_polymap
 from zopy.enrichments import rank_enrich, c_rank_fields, Link
+from zopy.diskcache import disk_memoize
 # common elements
 import scripts.enrich_fisher as interface
 
@@ -40,11 +41,12 @@ def main( ):
         func=make_link,
         headers=args.skip_headers, )
     # load key sets
-    gene_sets = polymap(
+    gene_sets = compact_polymap(
         args.gene_sets,
-        reverse=args.reversed_mapping, )
-    # perform analysis
-    results = rank_enrich( 
+        reverse=args.reversed_mapping,
+        cache=args.cache, )
+    # perform analysis (reusing results of identical earlier runs)
+    results = disk_memoize( rank_enrich )( 
         values,
         gene_sets,
         depletions=not args.exclude_depletions,
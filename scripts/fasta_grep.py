@@ -1,7 +1,10 @@
 #! /usr/bin/env python
 
+from __future__ import print_function
+
 import sys, re, argparse
 from Bio import SeqIO
+from zopy.patterns import PatternSet, load_patterns
 
 # argument parsing (python argparse)
 parser = argparse.ArgumentParser()
@@ -28,19 +31,20 @@ parser.add_argument(
     help='tabbed output', )
 args = parser.parse_args()
 
+# compile patterns once
+plist = []
+if args.pattern is not None:
+    plist.append( args.pattern )
+if args.patterns_file is not None:
+    plist += load_patterns( args.patterns_file )
+matcher = PatternSet( plist )
+
 # search
 for record in SeqIO.parse( args.input, "fasta" ) :
-    plist = []
-    if args.pattern is not None:
-        plist.append( args.pattern )
-    if args.patterns_file is not None:
-        with open( args.patterns_file ) as fh:
-            for line in fh:
-                plist.append( line.strip() )
-    match = re.search( "|".join( plist ), record.name )
+    match = matcher.search( record.name )
     if ( match and not args.inverted ) or ( not match and args.inverted ):
         if args.tabbed:
-            print "\t".join( [record.name, str( record.seq )] )
+            print( "\t".join( [record.name, str( record.seq )] ) )
         else:
-            print ">"+record.name
-            print str( record.seq )
+            print( ">"+record.name )
+            print( str( record.seq ) )
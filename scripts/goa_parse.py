@@ -13,38 +13,38 @@ import os
 import sys
 import re
 import argparse
+from multiprocessing import Pool
 
-from zopy.utils import iter_rows, say
+from zopy.utils import try_open, iter_rows, say
+from zopy.compression import sniff
 
 #-------------------------------------------------------------------------------
 # cli
 #-------------------------------------------------------------------------------
 
-parser = argparse.ArgumentParser( )
-parser.add_argument( "goa" )
-parser.add_argument( "gene_list" )
-parser.add_argument( "--outfile", default="goa_parse.tsv" )
-parser.add_argument( "--require-cafa-code", action="store_true" )
-parser.add_argument( "--gene-prefix", default="" )
-args = parser.parse_args( )
+def get_args( ):
+    parser = argparse.ArgumentParser( )
+    parser.add_argument( "goa" )
+    parser.add_argument( "gene_list" )
+    parser.add_argument( "--outfile", default="goa_parse.tsv" )
+    parser.add_argument( "--require-cafa-code", action="store_true" )
+    parser.add_argument( "--gene-prefix", default="" )
+    parser.add_argument( "--processes", type=int, default=1,
+                         help="parse chunks of the GOA file in parallel" )
+    return parser.parse_args( )
 
 #-------------------------------------------------------------------------------
 # constants
 #-------------------------------------------------------------------------------
 
-cafa_codes = {"EXP", "TAS", "IC"}
+cafa_codes = {b"EXP", b"TAS", b"IC"}
+# bytes of the GOA file handled per task
+c_block = 2**24
+# the header comment block ends at the first line not starting with "!"
+c_first_row = re.compile( b"^[^!\n]", re.M )
 
 #-------------------------------------------------------------------------------
-# load gene set
-#-------------------------------------------------------------------------------
-
-genes = set( )
-for row in iter_rows( args.gene_list ):
-    genes.add( row[0] )
-say( "Loaded", len( genes ), "genes" )
-    
-#-------------------------------------------------------------------------------
-# process goa file
+# block parsing
 #-------------------------------------------------------------------------------
 
 """
@@ -55,43 +55,131 @@ Col5 is the Gene Ontology annotation.
 Col4 is a logical modifier of the uniprot->go mapping.
   Must exclude the cases where this is "NOT".
 Col7 is a short evidence code
+
+Blocks are parsed as bytes. Only column 2 is split out before the (hashed)
+gene check, so the rows of genes outside the set, usually the large
+majority, cost one partial split each. The other columns are split only
+for rows that pass.
 """
-    
-# term->gene mapping
-mapping = {}
-annotated = set( )
-
-for row in iter_rows( args.goa ):
-    if row[0][0] == "!":
-        continue
-    gene = row[1]
-    term = row[4]
-    qual = row[3]
-    code = row[6]
-    if gene not in genes:
-        continue
-    if "NOT" in qual:
-        continue
-    if args.require_cafa_code and code not in cafa_codes:
-        continue
-    # all checks pass
-    inner = mapping.setdefault( term, set( ) )
-    inner.add( gene )
-    annotated.add( gene )
-
-say( "Using", len( mapping ), "terms" )
-say( "Annotated", len( annotated ), "genes, i.e.",
-     "{:.1f}%".format( 100.0 * len( annotated ) / len( genes ) ) )
-    
+
+c_shared = {}
+
+def share( genes, require_cafa_code ):
+    c_shared["genes"] = genes
+    c_shared["cafa"] = require_cafa_code
+
+def parse_block( block ):
+    """ ( term, gene ) pairs from a block of complete GAF lines """
+    genes, cafa = c_shared["genes"], c_shared["cafa"]
+    if block[:1] == b"!":
+        # skip the comment block in one step
+        match = c_first_row.search( block )
+        block = block[match.start( ):] if match is not None else b""
+    pairs = []
+    for line in block.split( b"\n" ):
+        head = line.split( b"\t", 2 )
+        if len( head ) < 3 or head[1] not in genes or line[:1] == b"!":
+            continue
+        row = line.split( b"\t", 7 )
+        if len( row ) < 7 or b"NOT" in row[3]:
+            continue
+        if cafa and row[6] not in cafa_codes:
+            continue
+        pairs.append( ( row[4], row[1] ) )
+    return pairs
+
+def read_range( task ):
+    """ parse the lines that start within [start, stop) of an uncompressed file """
+    path, start, stop = task
+    with open( path, "rb" ) as fh:
+        if start > 0:
+            # the partial line belongs to the previous range
+            fh.seek( start - 1 )
+            fh.readline( )
+        block = fh.read( max( 0, stop - fh.tell( ) ) )
+        if block[-1:] != b"\n":
+            block += fh.readline( )
+    return parse_block( block )
+
+def iter_blocks( fh, size=c_block ):
+    """ successive blocks of complete lines from a binary stream """
+    rest = b""
+    while True:
+        data = fh.read( size )
+        if data == b"":
+            break
+        data = rest + data
+        cut = data.rfind( b"\n" ) + 1
+        if cut == 0:
+            rest = data
+            continue
+        yield data[:cut]
+        rest = data[cut:]
+    if rest != b"":
+        yield rest
+
+def iter_pairs( path, genes, require_cafa_code, processes=1 ):
+    """ yield lists of ( term, gene ) pairs for successive parts of the GOA file """
+    share( genes, require_cafa_code )
+    plain = os.path.isfile( path ) and sniff( path ) is None
+    if processes < 2:
+        with try_open( path, "rb" ) as fh:
+            for block in iter_blocks( fh ):
+                yield parse_block( block )
+        return
+    pool = Pool( processes, initializer=share, initargs=( genes, require_cafa_code ) )
+    try:
+        if plain:
+            # workers read their own byte ranges
+            size = os.path.getsize( path )
+            tasks = [[path, start, min( size, start + c_block )] for start in range( 0, size, c_block )]
+            for pairs in pool.imap( read_range, tasks ):
+                yield pairs
+        else:
+            # decompress here; a bounded window of blocks keeps memory flat
+            window = []
+            with try_open( path, "rb" ) as fh:
+                for block in iter_blocks( fh ):
+                    window.append( block )
+                    if len( window ) >= 2 * processes:
+                        for pairs in pool.map( parse_block, window ):
+                            yield pairs
+                        window = []
+            for pairs in pool.map( parse_block, window ):
+                yield pairs
+    finally:
+        pool.close( )
+        pool.join( )
+
 #-------------------------------------------------------------------------------
-# write output
+# main
 #-------------------------------------------------------------------------------
 
-fh = open( args.outfile, "w" )
-for term in sorted( mapping ):
-    genes = [args.gene_prefix + gene for gene in mapping[term]]
-    genes.sort( )
-    outline = [term] + genes
-    print( "\t".join( outline ), file=fh )
-fh.close( )
-say( "Wrote mapping to:", args.outfile )
+def main( ):
+    args = get_args( )
+    # load gene set
+    # bytes, to match the raw lines split by the parser
+    genes = {row[0].encode( "utf8" ) for row in iter_rows( args.gene_list )}
+    say( "Loaded", len( genes ), "genes" )
+    # process goa file: term->gene mapping
+    mapping = {}
+    annotated = set( )
+    for pairs in iter_pairs( args.goa, genes, args.require_cafa_code, processes=args.processes ):
+        for term, gene in pairs:
+            mapping.setdefault( term, set( ) ).add( gene )
+            annotated.add( gene )
+    say( "Using", len( mapping ), "terms" )
+    say( "Annotated", len( annotated ), "genes, i.e.",
+         "{:.1f}%".format( 100.0 * len( annotated ) / len( genes ) ) )
+    # write output
+    fh = open( args.outfile, "w" )
+    for term in sorted( mapping ):
+        members = [args.gene_prefix + gene.decode( "utf8" ) for gene in mapping[term]]
+        members.sort( )
+        outline = [term.decode( "utf8" )] + members
+        print( "\t".join( outline ), file=fh )
+    fh.close( )
+    say( "Wrote mapping to:", args.outfile )
+
+if __name__ == "__main__":
+    main( )
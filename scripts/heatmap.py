@@ -22,6 +22,7 @@ from zopy.table2 import table
 from zopy.utils import die, warn, path2name, qw
 import zopy.mplutils2 as mu
 from zopy.dictation import col2dict, col2dict2
+from zopy.diskcache import disk_memoize
 
 #-------------------------------------------------------------------------------
 # constants
@@ -306,6 +307,11 @@ pylab.register_cmap( name="bbcry", cmap=bbcry )
 # utility functions
 #-------------------------------------------------------------------------------
 
+@disk_memoize
+def cached_linkage( data, method, metric ):
+    """ cached wrapper around sch.linkage (slow for big tables) """
+    return sch.linkage( data, method=method, metric=metric )
+
 def subseq( seq, index ):
     """numpy-style slicing and indexing for lists"""
     return [seq[i] for i in index]
@@ -508,14 +514,14 @@ class DataFrame( ):
             temp = [rankdata( col ) for col in self.dat.transpose( )]
             temp = np.array( temp )
             try:
-                Z = sch.linkage( temp, method=linkage, metric="correlation" )
+                Z = cached_linkage( temp, linkage, "correlation" )
                 order = sch.leaves_list( Z )
             except:
                 warn( "Spearman clustering failed" )
                 Z = None
                 order = range( len( self.col ) )
         else:
-            Z = sch.linkage( self.dat.transpose(), method=linkage, metric=metric )
+            Z = cached_linkage( self.dat.transpose(), linkage, metric )
             order = sch.leaves_list( Z )
         self.dat = self.dat[:, order]
         self.col = subseq( self.col, order )
@@ -549,14 +555,14 @@ class DataFrame( ):
             temp = [rankdata( col ) for col in self.dat.transpose( )]
             temp = np.array( temp )
             try:
-                Z = sch.linkage( temp.transpose( ), method=linkage, metric="correlation" )
+                Z = cached_linkage( temp.transpose( ), linkage, "correlation" )
                 order = sch.leaves_list( Z )
             except:
                 warn( "Spearman clustering failed" )
                 Z = None
                 order = range( len( self.row ) )                
         else:
-            Z = sch.linkage( self.dat, method=linkage, metric=metric )
+            Z = cached_linkage( self.dat, linkage, metric )
             order = sch.leaves_list( Z )
         self.dat = self.dat[order, :]
         self.row = subseq( self.row, order )
@@ -8,10 +8,30 @@ import os
 import sys
 import re
 import glob
+import heapq
+import tempfile
 import argparse
+from itertools import islice
 
-from zopy.utils import reader, path2name, say
-from zopy.table2 import nesteddict2table
+from zopy.utils import reader, path2name, say, die, try_open
+from zopy.table2 import nesteddict2table, c_strHeaders, c_strNA
+from zopy.compression import open_output
+
+# ---------------------------------------------------------------
+# constants
+# ---------------------------------------------------------------
+
+# ( key, value ) pairs sorted in memory per run of the external sort
+c_sort_chunk = 10**6
+# inputs merged at once; more are merged in groups via temp files
+c_max_open = 500
+c_special = {
+    "UNMAPPED":0, 
+    "UNGROUPED":1, 
+    "UNINTEGRATED":2, 
+    "UniRef90_unknown":3, 
+    "UniRef50_unknown":4, 
+    }
 
 # ---------------------------------------------------------------
 # argparse 
@@ -86,8 +106,125 @@ parser.add_argument(
     choices=["piped", "piped_humann"],
     help="special sorting options",
     )
+parser.add_argument(
+    "-S", "--stream",
+    action="store_true",
+    help="k-way merge inputs one row at a time (low memory; inputs are sorted externally first)",
+    )
+parser.add_argument(
+    "--presorted",
+    action="store_true",
+    help="with --stream: inputs are already sorted by feature (in --mode order); skip sorting",
+    )
 args = parser.parse_args()
 
+# ---------------------------------------------------------------
+# streaming merge
+# ---------------------------------------------------------------
+
+def feature_sort_key( mode ):
+    """ sort key matching the feature order of the in-memory merge """
+    if mode is None:
+        return lambda x: x
+    elif mode == "piped":
+        return lambda x: x.split( "|" )
+    elif mode == "piped_humann":
+        default = 1 + max( c_special.values( ) )
+        return lambda x: ( c_special.get( x.split( "|" )[0], default ), x.split( "|" ) )
+
+def iter_items( path ):
+    with try_open( path ) as fh:
+        for astrItems in reader( fh ):
+            if args.strip_comments and astrItems[0][0] == "#":
+                continue
+            yield astrItems
+
+def get_colhead( path ):
+    if args.use_headers:
+        for astrItems in iter_items( path ):
+            return astrItems[args.val_col]
+    return path2name( path ) if not args.use_full_names else os.path.split( path )[1]
+
+def iter_pairs( path ):
+    """ ( key, value ) pairs of one input with the header/pattern options applied """
+    for i, astrItems in enumerate( iter_items( path ) ):
+        if i == 0 and args.strip_headers:
+            continue
+        strKey = astrItems[args.key_col]
+        if args.key_pattern and not re.search( args.key_pattern, strKey ):
+            continue
+        yield strKey, astrItems[args.val_col]
+
+def iter_temp( fh ):
+    fh.seek( 0 )
+    for line in fh:
+        items = line.rstrip( "\n" ).split( "\t" )
+        yield items[0], items[1:]
+
+def iter_sorted( path, sortkey ):
+    """ ( key, [value] ) sorted by feature; runs too large for memory are spilled to temp files """
+    pairs = iter_pairs( path )
+    pairkey = lambda pair: sortkey( pair[0] )
+    if args.presorted:
+        merged = pairs
+    else:
+        runs = []
+        while True:
+            # stable sorts keep file order among duplicate keys
+            chunk = sorted( islice( pairs, c_sort_chunk ), key=pairkey )
+            if len( chunk ) == 0:
+                break
+            run = tempfile.TemporaryFile( "w+" )
+            run.writelines( "%s\t%s\n" % pair for pair in chunk )
+            runs.append( ( ( key, values[0] ) for key, values in iter_temp( run ) ) )
+            if len( chunk ) < c_sort_chunk:
+                break
+        merged = heapq.merge( *runs, key=pairkey ) if len( runs ) > 1 else ( runs[0] if runs else [] )
+    # repeated keys: the last value wins ( as in the in-memory merge )
+    current, last = None, None
+    for strKey, strValue in merged:
+        if current is not None and strKey != current:
+            if args.presorted and sortkey( strKey ) < sortkey( current ):
+                die( path, "is not sorted at", strKey, "(drop --presorted)" )
+            yield current, [last]
+        current, last = strKey, strValue
+    if current is not None:
+        yield current, [last]
+
+def merge_sources( sources, sortkey, fill ):
+    """ k-way merge of ( key, values ) sources, each ( iterator, width ); yields full rows """
+    offsets = [0]
+    for source, width in sources:
+        offsets.append( offsets[-1] + width )
+    def tag( i, source ):
+        # the source index breaks ties, so values are never compared
+        for strKey, values in source:
+            yield sortkey( strKey ), i, strKey, values
+    current, row = None, None
+    for _, i, strKey, values in heapq.merge( *[tag( i, source ) for i, ( source, width ) in enumerate( sources )] ):
+        if strKey != current:
+            if current is not None:
+                yield current, row
+            current, row = strKey, [fill] * offsets[-1]
+        row[offsets[i]:offsets[i+1]] = values
+    if current is not None:
+        yield current, row
+
+def stream_merge( paths, sortkey, fill ):
+    """ merge inputs, in groups of c_max_open ( through temp files ) when there are many """
+    sources = [( iter_sorted( path, sortkey ), 1 ) for path in paths]
+    while len( sources ) > c_max_open:
+        groups = []
+        for i in range( 0, len( sources ), c_max_open ):
+            group = sources[i:i+c_max_open]
+            temp = tempfile.TemporaryFile( "w+" )
+            for strKey, row in merge_sources( group, sortkey, fill ):
+                temp.write( "\t".join( [strKey] + row ) + "\n" )
+            groups.append( ( iter_temp( temp ), sum( width for source, width in group ) ) )
+            say( "Merged group of", len( group ), "inputs" )
+        sources = groups
+    return merge_sources( sources, sortkey, fill )
+
 # ---------------------------------------------------------------
 # load all data
 # ---------------------------------------------------------------
@@ -106,6 +243,18 @@ if args.file is not None:
     after = len( args.inputs )
     say( "Will load:", after - before, "additional files gathered from:", args.file )
 
+if args.stream:
+    # samples sorted by colhead; for repeated colheads, the last input wins
+    dictColheadPaths = {get_colhead( strPath ):strPath for strPath in args.inputs}
+    astrColheads = sorted( dictColheadPaths )
+    fill = args.fill_empty if args.fill_empty is not None else c_strNA
+    with open_output( args.output ) as fh:
+        fh.write( "\t".join( [args.origin if args.origin is not None else c_strHeaders] + astrColheads ) + "\n" )
+        for strKey, astrRow in stream_merge( [dictColheadPaths[k] for k in astrColheads], 
+                                             feature_sort_key( args.mode ), fill ):
+            fh.write( "\t".join( [strKey] + astrRow ) + "\n" )
+    sys.exit( )
+
 for iDex, strPath in enumerate( args.inputs ):
     say( sys.stderr, "Loading", iDex+1, "of", len( args.inputs ), ":", strPath )
     aastrData = []
@@ -139,13 +288,7 @@ if args.mode is None:
 elif args.mode == "piped":
     astrFeatures = sorted( dictFeatureIndex.keys( ), key=lambda x: x.split( "|" ) )
 elif args.mode == "piped_humann":
-    special = {
-        "UNMAPPED":0, 
-        "UNGROUPED":1, 
-        "UNINTEGRATED":2, 
-        "UniRef90_unknown":3, 
-        "UniRef50_unknown":4, 
-        }
+    special = c_special
     default = 1 + max( special.values( ) )
     astrFeatures = sorted( dictFeatureIndex.keys( ), key=lambda x: x.split( "|" ) )
     astrFeatures = sorted( astrFeatures, key=lambda x: special.get( x.split( "|" )[0], default ) )
@@ -3,11 +3,15 @@
 import os
 import sys
 import re
+import csv
 import glob
 import argparse
+from multiprocessing import Pool
 
-from zopy.table2 import table, c_strNA, nesteddict2table
-from zopy.utils import warn
+import numpy as np
+
+from zopy.table2 import table, c_strNA, c_strHeaders
+from zopy.utils import warn, die, try_open
 
 # ---------------------------------------------------------------
 # argparse 
@@ -34,8 +38,96 @@ parser.add_argument(
     action="store_true",
     help="iteratively merge tables (better maintains feature order)",
 )
+parser.add_argument( 
+    "-p", "--processes",
+    type=int,
+    default=1,
+    help="parse input tables in parallel",
+)
+parser.add_argument( 
+    "-s", "--sparse",
+    action="store_true",
+    help="numeric tables: assemble as a sparse matrix (missing values are 0; written to 6 sig figs)",
+)
 args = parser.parse_args()
 
+# ---------------------------------------------------------------
+# loading as ( row, col, value ) triples
+# ---------------------------------------------------------------
+
+def load_cells( path ):
+    """ ( rowheads, colheads, 2d array of values ) for one table, deduplicated like table2nesteddict """
+    with try_open( path ) as fh:
+        # same parsing as zopy.table2 ( quote characters are data )
+        rows = [row for row in csv.reader( fh, delimiter="\t", quoting=csv.QUOTE_NONE )]
+    if len( rows ) == 0:
+        die( "Empty table:", path )
+    width = len( rows[0] )
+    for i, row in enumerate( rows ):
+        if len( row ) != width:
+            die( "Ragged table:", path, "row", i + 1, "has", len( row ), "fields; the header has", width )
+    colheads = rows[0][1:]
+    # repeated colheads: the last col wins; repeated rowheads: the first row wins
+    cols = {}
+    for j, colhead in enumerate( colheads ):
+        cols[colhead] = j + 1
+    seen = set( )
+    rowheads, values = [], []
+    for row in rows[1:]:
+        if row[0] not in seen:
+            seen.add( row[0] )
+            rowheads.append( row[0] )
+            values.append( [row[j] for j in cols.values( )] )
+    return rowheads, list( cols ), np.array( values, dtype=str ).reshape( len( rowheads ), len( cols ) )
+
+def assemble( paths, loaded, sparse=False ):
+    """ scatter all tables' cells into one matrix over the union of headers; later tables overwrite """
+    rowheads = sorted( set( r for result in loaded for r in result[0] ) )
+    colheads = sorted( set( c for result in loaded for c in result[1] ) )
+    rowmap = {r:i for i, r in enumerate( rowheads )}
+    colmap = {c:j for j, c in enumerate( colheads )}
+    # flat cell index = row * ncols + col, in input order
+    cells, values, sources = [], [], []
+    for k, ( tRowheads, tColheads, tValues ) in enumerate( loaded ):
+        rr = np.array( [rowmap[r] for r in tRowheads], dtype=np.int64 )
+        cc = np.array( [colmap[c] for c in tColheads], dtype=np.int64 )
+        cells.append( ( rr[:, None] * len( colheads ) + cc[None, :] ).ravel( ) )
+        values.append( tValues.ravel( ).astype( object ) )
+        sources.append( np.full( tValues.size, k ) )
+    cells, values, sources = np.concatenate( cells ), np.concatenate( values ), np.concatenate( sources )
+    order = np.argsort( cells, kind="mergesort" )
+    cells, values, sources = cells[order], values[order], sources[order]
+    # report overwrites that change a value ( consecutive cells within a group are in input order )
+    repeat = cells[1:] == cells[:-1]
+    for i in np.flatnonzero( repeat & ( values[1:] != values[:-1] ) ):
+        r, c = divmod( cells[i+1], len( colheads ) )
+        warn( paths[sources[i+1]], "overwrites", rowheads[r], colheads[c], values[i], "with", values[i+1] )
+    last = np.append( ~repeat, True )
+    cells, values = cells[last], values[last]
+    if sparse:
+        from scipy.sparse import csr_matrix
+        rr, cc = np.divmod( cells, len( colheads ) )
+        try:
+            numbers = values.astype( float )
+        except ValueError:
+            die( "--sparse requires numeric tables" )
+        matrix = csr_matrix( ( numbers, ( rr, cc ) ), shape=( len( rowheads ), len( colheads ) ) )
+    else:
+        matrix = np.full( len( rowheads ) * len( colheads ), c_strNA, dtype=object )
+        matrix[cells] = values
+        matrix = matrix.reshape( len( rowheads ), len( colheads ) )
+    return rowheads, colheads, matrix
+
+def load_all( paths, processes=1 ):
+    if processes > 1:
+        pool = Pool( processes )
+        loaded = pool.map( load_cells, paths )
+        pool.close( )
+        pool.join( )
+    else:
+        loaded = [load_cells( p ) for p in paths]
+    return loaded
+
 # ---------------------------------------------------------------
 # load and process data
 # ---------------------------------------------------------------
@@ -49,17 +141,16 @@ elif args.legacy:
     for p2 in args.tables[1:]:
         t2 = table( p2 )
         t.merge( t2 )
+elif args.sparse:
+    if args.metatable is not None or args.fill_empty not in [None, "0"]:
+        die( "--sparse fills missing values with 0 and can't attach a metatable" )
+    from zopy.table_sparse import table as sparse_table
+    rowheads, colheads, matrix = assemble( args.tables, load_all( args.tables, args.processes ), sparse=True )
+    sparse_table( data=matrix, rowheads=rowheads, colheads=colheads, origin=c_strHeaders, verbose=False ).write( )
+    sys.exit( )
 else:    
-    data = {}
-    for p in args.tables:
-        d = table( p ).table2nesteddict( )
-        for r in d:
-            inner = data.setdefault( r, {} )
-            for c in d[r]:
-                if c in inner and inner[c] != d[r][c]:
-                    warn( p, "overwrites", r, c, inner[c], "with", d[r][c] )
-                inner[c] = d[r][c]
-    t = nesteddict2table( data, empty=c_strNA )
+    rowheads, colheads, matrix = assemble( args.tables, load_all( args.tables, args.processes ) )
+    t = table( [[c_strHeaders] + colheads] + [[r] + list( row ) for r, row in zip( rowheads, matrix )], verbose=False )
 
 if args.metatable is not None:
     t.metamerge( table( args.metatable ) )
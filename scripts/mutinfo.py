@@ -1,14 +1,39 @@
 #! /usr/bin/env python
 
+from __future__ import print_function
+
 import os, sys, re, glob, argparse
 import csv
-from zopy.stats import mutinfo, shannon
+import numpy as np
+from zopy.stats import mutinfo, shannon, mutinfo_matrix
+from zopy.utils import iter_rows
+from zopy.formats import iter_blocks
 
 parser = argparse.ArgumentParser()
 #parser.add_argument( '-1', "--col1", type=int, default=0 )
 parser.add_argument( '-m', "--missing", help="exclude missing values" )
+parser.add_argument( '-t', "--table", help="features x samples table; report pairwise NMI matrix instead" )
+parser.add_argument( '-r', "--raw", action="store_true", help="with --table: treat values as events (no sqrt binning)" )
+parser.add_argument( '-p', "--processes", type=int, default=None, help="with --table: worker processes" )
 args = parser.parse_args()
 
+# pairwise NMI over all features of a table
+if args.table is not None:
+    aFeatures, aaData = [], []
+    for i, aItems in enumerate( iter_rows( args.table ) ):
+        if i == 0:
+            aHeaders = aItems
+        else:
+            aFeatures.append( aItems[0] )
+            aaData.append( aItems[1:] if args.raw else [float( k ) for k in aItems[1:]] )
+    aaNMI = mutinfo_matrix( np.array( aaData ), discretize=not args.raw, processes=args.processes )
+    writer = csv.writer( sys.stdout, csv.excel_tab )
+    writer.writerow( [aHeaders[0]] + aFeatures )
+    sys.stdout.flush( )
+    for text in iter_blocks( aaNMI, rowheads=aFeatures ):
+        sys.stdout.write( text )
+    sys.exit( )
+
 total = 0
 bad = 0
 aX = []
@@ -17,7 +42,7 @@ for aItems in csv.reader( sys.stdin, delimiter="\t", quotechar="", quoting=csv.Q
     total += 1
     if len( aItems ) != 2:
        bad += 1
-       print >>sys.stderr, "ignoring", "\t".join( aItems )
+       print( "ignoring", "\t".join( aItems ), file=sys.stderr )
     else:
         aX.append( aItems[0] )
         aY.append( aItems[1] )
@@ -30,14 +55,14 @@ for x, y in zip( aX, aY ):
         aX2.append( x )
         aY2.append( y )
     else:
-        print >>sys.stderr, "ignoring", x, y
+        print( "ignoring", x, y, file=sys.stderr )
         bad += 1
 aX, aY = aX2, aY2
 
 # output
-print "total pairs  :", total
-print "bad pairs    :", bad, "( %.1f%% )" % ( 100 * bad / float( total ) )
-print "col1 entropy :", shannon( aX )
-print "col2 entropy :", shannon( aY )
-print "mutual info  :", mutinfo( aX, aY )
-print "normalized   :", mutinfo( aX, aY, normalized=True )
+print( "total pairs  :", total )
+print( "bad pairs    :", bad, "( %.1f%% )" % ( 100 * bad / float( total ) ) )
+print( "col1 entropy :", shannon( aX ) )
+print( "col2 entropy :", shannon( aY ) )
+print( "mutual info  :", mutinfo( aX, aY ) )
+print( "normalized   :", mutinfo( aX, aY, normalized=True ) )
@@ -19,6 +19,7 @@ from scipy.spatial.distance import pdist, squareform
 from sklearn.manifold import MDS, TSNE
 
 from zopy.utils import sortedby, iter_rows, path2name
+from zopy.diskcache import disk_memoize
 from zopy.table2 import table
 from zopy import mplutils as mu
 
@@ -39,6 +40,7 @@ def get_args( ):
     args = parser.parse_args()
     return args
 
+@disk_memoize
 def distance_matrix( data, method ):
     # pdist return default is condensed (not square) dist matrix
     dist = squareform( pdist( data, method ) )
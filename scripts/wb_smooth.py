@@ -3,16 +3,23 @@
 """
 Compositional Witten-Bell smoothing 
 Adapted from Franzosa et al. PNAS 2014
+(the smoothing itself lives in zopy.smoothing)
 ===============================================
 Author: Eric Franzosa (eric.franzosa@gmail.com)
 """
 
 import csv, argparse
 
-c_fNonCompDelta = 0.01
+import numpy as np
+
+from zopy.utils import try_open
+from zopy.smoothing import iter_wb_smooth, c_non_comp_delta as c_fNonCompDelta
+from zopy.compression import open_output
+from zopy.formats import format_block
+import zopy.table_sparse as table_sparse
 
 def funcLoadTable ( strPath ):
-	with open( strPath ) as fh:
+	with try_open( strPath ) as fh:
 		astrHeaders = None
 		astrFeatures = []
 		aafData = []
@@ -21,26 +28,13 @@ def funcLoadTable ( strPath ):
 				astrHeaders = astrLine
 			else:
 				astrFeatures.append( astrLine[0] )
-				aafData.append( map( float, astrLine[1:] ) )
-	return aafData, astrFeatures, astrHeaders
-	
-def funcTranspose ( aaData ):
-	return [[aaData[iRow][iCol] for iRow in range( len( aaData ) )] \
-		for iCol in range( len( aaData[0] ) )]
-	
-def funcWBSmooth ( afSample ):
-	assert abs( sum( afSample ) - 1.0 ) < c_fNonCompDelta, \
-		"This doesn't look like compositional data (col sum !~ 1.0)"
-	afNonZero = filter( lambda x: x > 0, afSample )
-	iN = int( 1 / min( afNonZero ) )
-	iT = len( afNonZero )
-	iZ = len( afSample ) - iT
-	def funcInner ( fValue ):
-		if fValue == 0:
-			return iT / float( iZ ) / float( iN + iT )
-		else:
-			return ( fValue * iN ) / float( iN + iT )
-	return map( funcInner, afSample )
+				aafData.append( [float( strValue ) for strValue in astrLine[1:]] )
+	return np.array( aafData ).reshape( len( astrFeatures ), len( astrHeaders ) - 1 ), \
+		astrFeatures, astrHeaders
+
+def funcLoadSparse ( strPath ):
+	tbl = table_sparse.table( strPath, verbose=False )
+	return tbl.data, tbl.rowheads, [tbl.origin] + tbl.colheads
 
 def main ( ):
 	parser = argparse.ArgumentParser()
@@ -48,14 +42,18 @@ def main ( ):
 		help="Input compositional PCL file" )
 	parser.add_argument( '-o', "--output", 
 		help="Output Witten-Bell smoothed compositional PCL file" )
+	parser.add_argument( '-s', "--sparse", action="store_true",
+		help="Hold the input as a sparse matrix (for large, zero-heavy tables)" )
 	args = parser.parse_args()
-	aafData, astrFeatures, astrHeaders = funcLoadTable( args.input )
-	aafData = funcTranspose( map( funcWBSmooth, funcTranspose( aafData ) ) )
-	with open( args.output, "wb" ) as fh:
-		Writer = csv.writer( fh, dialect="excel-tab" )
-		Writer.writerow( astrHeaders )
-		for iRow, afValues in enumerate( aafData ):
-			Writer.writerow( [astrFeatures[iRow]] + afValues )
+	funcLoad = funcLoadSparse if args.sparse else funcLoadTable
+	aafData, astrFeatures, astrHeaders = funcLoad( args.input )
+	with open_output( args.output ) as fh:
+		fh.write( "\t".join( astrHeaders ) + "\n" )
+		iRow = 0
+		# smoothed one block of rows at a time
+		for aafBlock in iter_wb_smooth( aafData, delta=c_fNonCompDelta ):
+			fh.write( format_block( aafBlock, rowheads=astrFeatures[iRow:iRow+len( aafBlock )], sig=None ) )
+			iRow += len( aafBlock )
 
 if __name__ == "__main__":
-	main( ) 
+	main( )
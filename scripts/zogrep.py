@@ -12,30 +12,32 @@ import re
 import csv
 import argparse
 
+from zopy.patterns import PatternSet, load_patterns, iter_row_matches
+
 def get_args( ):
     parser = argparse.ArgumentParser( )
-    parser.add_argument( "pattern", help="" )
+    parser.add_argument( "pattern", nargs="?", default=None, help="" )
+    parser.add_argument( "-f", "--patterns-file", help="one pattern per line (like grep -f)" )
     parser.add_argument( "-e", "--exact", action="store_true", help="" )
     parser.add_argument( "-c", "--column", type=int, help="" )
     parser.add_argument( "-v", "--invert", action="store_true", help="" )
+    parser.add_argument( "-p", "--processes", type=int, default=None, help="match chunks of rows in parallel" )
     args = parser.parse_args( )
     return args
 
 def main( ):
     args = get_args( )   
+    patterns = [] if args.pattern is None else [args.pattern]
+    if args.patterns_file is not None:
+        patterns += load_patterns( args.patterns_file )
+    if len( patterns ) == 0:
+        sys.exit( "Provide a pattern and/or a patterns file" )
+    matcher = PatternSet( patterns, exact=args.exact )
+    column = args.column - 1 if args.column is not None else None
     writer = csv.writer( sys.stdout, csv.excel_tab )
-    for row in csv.reader( sys.stdin, csv.excel_tab ):
-        include = False
-        for i, field in enumerate( row ):
-            if args.column is None or i+1 == args.column:
-                if args.exact:
-                    match = args.pattern == field
-                else:
-                    match = re.search( args.pattern, field )
-                if match or (args.invert and not match):
-                    include = True
-                    break
-        if include:
+    rows = csv.reader( sys.stdin, csv.excel_tab )
+    for row, match in iter_row_matches( rows, matcher, column=column, processes=args.processes ):
+        if match != args.invert:
             writer.writerow( row )
 
 if __name__ == "__main__":
@@ -4,6 +4,8 @@
 Make the raw material for the strain specific marker plots
 """
 
+from __future__ import print_function
+
 import os, sys, re, glob, argparse
 import numpy as np
 from scipy.stats.mstats import mquantiles
@@ -30,59 +32,69 @@ def funcMinNonZero ( aValues ):
 	aNonZero = [k for k in aValues if k > 0]
 	return min( aNonZero ) if len( aNonZero ) > 0 else None
 
-def funcTrimmedMax( values ):
-	# flatten
-	if isinstance( values[0], list ):
-		values = [k for row in values for k in row]
-	q1, q2, q3 = mquantiles( values )
-	upper_inner_fence = q3 + 1.5 * ( q3 - q1 )
-	outliers = [k for k in values if k > upper_inner_fence]
-	if len( outliers ) > 0:
-		print >>sys.stderr, "Outliers removed in trimmed max:", len( outliers ), len( outliers ) / float( len( values ) )
-	return max( [k for k in values if k <= upper_inner_fence] )
+def funcRowQuantiles ( aaValues, aProbs, alphap=0.4, betap=0.4 ):
+	""" mquantiles( row, aProbs ) for every row of a 2d array at once ( rows x probs ) """
+	aaSorted = np.sort( aaValues, axis=1 )
+	n = aaSorted.shape[1]
+	if n == 1:
+		return np.repeat( aaSorted, len( aProbs ), axis=1 )
+	p = np.asarray( aProbs, dtype=float )
+	aleph = n * p + ( alphap + p * ( 1.0 - alphap - betap ) )
+	k = np.floor( aleph.clip( 1, n - 1 ) ).astype( int )
+	gamma = ( aleph - k ).clip( 0, 1 )
+	return ( 1.0 - gamma ) * aaSorted[:, k - 1] + gamma * aaSorted[:, k]
+
+def funcTrimmedMax ( aaValues ):
+	""" per-row max of values inside the upper inner fence ( q3 + 1.5 IQR ) """
+	q1, q2, q3 = funcRowQuantiles( aaValues, [0.25, 0.5, 0.75] ).T
+	aFence = q3 + 1.5 * ( q3 - q1 )
+	aaInside = aaValues <= aFence[:, None]
+	iOutliers = aaValues.size - aaInside.sum( )
+	if iOutliers > 0:
+		print( "Outliers removed in trimmed max:", iOutliers, iOutliers / float( aaValues.size ), file=sys.stderr )
+	return np.where( aaInside, aaValues, -np.inf ).max( axis=1 )
+
+def funcTruncMean ( aaValues, tail=0.1 ):
+	""" per-row zopy.stats.trunc_mean """
+	low, high = funcRowQuantiles( aaValues, [tail, 1 - tail] ).T
+	aaInside = ( low[:, None] <= aaValues ) & ( aaValues <= high[:, None] )
+	return np.where( aaInside, aaValues, 0 ).sum( axis=1 ) / aaInside.sum( axis=1 )
 
 def funcRescale ( aaData, **kwargs ):
-	""" rescales the data in place """
+	""" rescales the data in place ( zeros are left as zero ) """
 	scaling = kwargs["scaling"]
 	bins = kwargs["bins"]
-	gmax = max( [max( aRow ) for aRow in aaData] )
-	gmin_nonzero = min( [funcMinNonZero( aRow ) for aRow in aaData if max( aRow ) > 0] )
-	trimmed_gmax = funcTrimmedMax( aaData )
-	for i, aRow in enumerate( aaData ):
-		multiplier = 0.25 if trunc_mean( aRow ) / c_fDivisor < c_fMinCoverage else 1
-		rmax = max( aRow )
-		rmin_nonzero = funcMinNonZero( aRow )
-		trimmed_rmax = funcTrimmedMax( aRow )
-		for j, value in enumerate( aRow ):
-			if value == 0:
-				continue
-			elif scaling == "binary":
-				aaData[i][j] = 1
-			elif scaling == "norm":
-				aaData[i][j] = aaData[i][j] / float( gmax )
-			elif scaling == "rownorm":
-				aaData[i][j] = aaData[i][j] / float( rmax )
-			elif scaling == "trimnorm":
-				aaData[i][j] = aaData[i][j] / float( trimmed_gmax ) if aaData[i][j] < trimmed_gmax else 1
-			elif scaling == "trimrownorm":
-				aaData[i][j] = aaData[i][j] / float( trimmed_rmax ) if aaData[i][j] < trimmed_rmax else 1
-			elif scaling == "special":
-				aaData[i][j] = np.sqrt( aaData[i][j] / float( trimmed_rmax ) ) if aaData[i][j] < trimmed_rmax else 1
-				aaData[i][j] *= multiplier
-			elif scaling == "bins":
-				for k, b in enumerate( bins ):
-					if value <= b:
-						aaData[i][j] = ( k + 1 ) / float( 1 + len( bins ) )
-						break
-				else:
-					aaData[i][j] = 1
-			"""
-			THESE DON'T REALLY WORK SINCE THEY FORCE THE MIN TO ZERO
-			elif scaling == "lognorm" and value > 0:
-				aaData[i][j] = ( np.log10( value ) - np.log10( gmin_nonzero ) ) / ( np.log10( gmax ) - np.log10( gmin_nonzero ) )
-			elif scaling == "rowlognorm" and value > 0:
-				aaData[i][j] = ( np.log10( value ) - np.log10( rmin_nonzero ) ) / ( np.log10( rmax ) - np.log10( rmin_nonzero ) )
-			"""
+	aaValues = np.array( aaData, dtype=float )
+	aaNew = aaValues.copy( )
+	if scaling == "binary":
+		aaNew[:] = 1
+	elif scaling == "norm":
+		aaNew /= aaValues.max( )
+	elif scaling == "rownorm":
+		aaNew /= aaValues.max( axis=1 )[:, None]
+	elif scaling == "trimnorm":
+		trimmed_gmax = funcTrimmedMax( aaValues.reshape( 1, -1 ) )[0]
+		aaNew = np.where( aaValues < trimmed_gmax, aaValues / trimmed_gmax, 1 )
+	elif scaling == "trimrownorm":
+		trimmed_rmax = funcTrimmedMax( aaValues )[:, None]
+		aaNew = np.where( aaValues < trimmed_rmax, aaValues / trimmed_rmax, 1 )
+	elif scaling == "special":
+		trimmed_rmax = funcTrimmedMax( aaValues )[:, None]
+		multiplier = np.where( funcTruncMean( aaValues ) / c_fDivisor < c_fMinCoverage, 0.25, 1 )
+		aaNew = np.where( aaValues < trimmed_rmax, np.sqrt( aaValues / trimmed_rmax ), 1 ) * multiplier[:, None]
+	elif scaling == "bins":
+		# k for the first bin edge with value <= edge; len( bins ) past the last edge
+		aaNew = ( np.digitize( aaValues, bins, right=True ) + 1 ) / float( 1 + len( bins ) )
+	"""
+	THESE DON'T REALLY WORK SINCE THEY FORCE THE MIN TO ZERO
+	elif scaling == "lognorm":
+		aaNew = ( np.log10( value ) - np.log10( gmin_nonzero ) ) / ( np.log10( gmax ) - np.log10( gmin_nonzero ) )
+	elif scaling == "rowlognorm":
+		aaNew = ( np.log10( value ) - np.log10( rmin_nonzero ) ) / ( np.log10( rmax ) - np.log10( rmin_nonzero ) )
+	"""
+	aaNew = np.where( aaValues == 0, aaValues, aaNew )
+	for aRow, aNewRow in zip( aaData, aaNew.tolist( ) ):
+		aRow[:] = aNewRow
 
 # ---------------------------------------------------------------
 # main function
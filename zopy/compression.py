@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+
+"""
+Codec layer behind zopy.utils.try_open
+======================================
+Compressed inputs are recognized by their magic bytes ( not their
+extension ). Each codec is opened with the fastest available backend:
+parallel threads for BGZF, an external decompressor ( pigz, zstd -T0,
+lz4, xz -T0 ) when one is on the PATH, else the python module. Outputs are
+compressed according to their extension.
+"""
+
+from __future__ import print_function
+
+import os
+import io
+import bz2
+import gzip
+import zlib
+import sys
+import struct
+import tempfile
+import threading
+import subprocess
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from zopy.utils import which
+
+# optional modules
+try:
+    import lzma
+except ImportError:
+    lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+# ---------------------------------------------------------------
+# constants
+# ---------------------------------------------------------------
+
+c_magic = [
+    ["gzip",  b"\x1f\x8b"],
+    ["bz2",   b"BZh"],
+    ["xz",    b"\xfd7zXZ\x00"],
+    ["zstd",  b"\x28\xb5\x2f\xfd"],
+    ["lz4",   b"\x04\x22\x4d\x18"],
+]
+c_extensions = {
+    ".gz":  "gzip",
+    ".bgz": "gzip",
+    ".bz2": "bz2",
+    ".xz":  "xz",
+    ".zst": "zstd",
+    ".lz4": "lz4",
+}
+# external decompressors ( tried in order ), writing to stdout
+c_commands = {
+    "gzip": [["pigz", "-dc"], ["gzip", "-dc"]],
+    "bz2":  [["lbzip2", "-dc"], ["pbzip2", "-dc"]],
+    "xz":   [["xz", "-T0", "-dc"]],
+    "zstd": [["zstd", "-T0", "-dcq"]],
+    "lz4":  [["lz4", "-dc"]],
+}
+c_threads = max( 1, min( 8, cpu_count( ) ) )
+# BGZF blocks decompressed per round of the thread pool
+c_bgzf_window = 256
+# text buffered before a block is handed to the compressor thread
+c_write_buffer = 2**22
+# blocks queued for compression before write() blocks
+c_write_queue = 4
+c_temp_prefix = ".zopy-tmp-"
+
+# ---------------------------------------------------------------
+# detection
+# ---------------------------------------------------------------
+
+def sniff( path ):
+    """ codec name from the file's first bytes ( None for plain files ) """
+    if not os.path.isfile( path ):
+        # don't consume the head of a pipe or device
+        return None
+    with open( path, "rb" ) as fh:
+        head = fh.read( 18 )
+    for codec, magic in c_magic:
+        if head.startswith( magic ):
+            return codec
+    return None
+
+def is_bgzf( path ):
+    """ gzip with the 'BC' extra subfield ( samtools/htslib blocked gzip ) """
+    with open( path, "rb" ) as fh:
+        head = fh.read( 18 )
+    return len( head ) == 18 and head[:2] == b"\x1f\x8b" and ord( head[3:4] ) & 4 \
+        and head[12:14] == b"BC"
+
+def codec_from_extension( path ):
+    return c_extensions.get( os.path.splitext( path )[1].lower( ) )
+
+# ---------------------------------------------------------------
+# readers
+# ---------------------------------------------------------------
+
+class ProcessReader( io.RawIOBase ):
+
+    """ stdout of an external decompressor as a raw binary stream """
+
+    def __init__( self, command, path ):
+        io.RawIOBase.__init__( self )
+        self.command = command
+        self.path = path
+        self.process = subprocess.Popen(
+            command + [path], stdout=subprocess.PIPE, stderr=subprocess.PIPE )
+        self.finished = False
+
+    def readable( self ):
+        return True
+
+    def readinto( self, buffer ):
+        data = self.process.stdout.read( len( buffer ) )
+        buffer[:len( data )] = data
+        if len( data ) == 0 and len( buffer ) > 0:
+            # EOF: a failed decompressor must not pass for a short file
+            self.finish( )
+        return len( data )
+
+    def finish( self ):
+        """ reap the process; raise if it failed """
+        if self.finished:
+            return None
+        self.finished = True
+        error = self.process.stderr.read( )
+        self.process.stderr.close( )
+        code = self.process.wait( )
+        if code != 0:
+            raise IOError( "{} failed on {}: {}".format(
+                self.command[0], self.path, error.decode( "utf-8", "replace" ).strip( ) ) )
+
+    def close( self ):
+        if not self.closed:
+            self.process.stdout.close( )
+            killed = False
+            if self.process.poll( ) is None:
+                # closed early ( e.g. only the head was read )
+                self.process.kill( )
+                killed = True
+            try:
+                if killed:
+                    self.finished = True
+                    self.process.stderr.close( )
+                    self.process.wait( )
+                else:
+                    self.finish( )
+            finally:
+                io.RawIOBase.close( self )
+
+def iter_bgzf_blocks( fh ):
+    """ yield the raw ( compressed ) BGZF blocks of a file """
+    while True:
+        head = fh.read( 18 )
+        if len( head ) == 0:
+            break
+        if len( head ) < 18 or head[12:14] != b"BC":
+            raise IOError( "Malformed BGZF block header" )
+        # BSIZE is total block size - 1
+        size = struct.unpack( "<H", head[16:18] )[0] + 1
+        yield head + fh.read( size - 18 )
+
+def inflate( block ):
+    # zlib releases the GIL, so threads decompress blocks concurrently
+    return zlib.decompress( block, 31 )
+
+class BGZFReader( io.RawIOBase ):
+
+    """ decompress BGZF blocks in parallel threads; yields data in order """
+
+    def __init__( self, path, threads=c_threads ):
+        io.RawIOBase.__init__( self )
+        self.fh = open( path, "rb" )
+        self.pool = ThreadPool( threads )
+        self.blocks = iter_bgzf_blocks( self.fh )
+        self.pending = []
+        self.buffer = b""
+
+    def readable( self ):
+        return True
+
+    def refill( self ):
+        window = []
+        for block in self.blocks:
+            window.append( block )
+            if len( window ) >= c_bgzf_window:
+                break
+        self.pending = self.pool.map( inflate, window )[::-1]
+
+    def readinto( self, buffer ):
+        while len( self.buffer ) == 0:
+            if len( self.pending ) == 0:
+                self.refill( )
+                if len( self.pending ) == 0:
+                    return 0
+            self.buffer = self.pending.pop( )
+        n = min( len( buffer ), len( self.buffer ) )
+        buffer[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close( self ):
+        if not self.closed:
+            self.pool.close( )
+            self.pool.join( )
+            self.fh.close( )
+            io.RawIOBase.close( self )
+
+def open_binary_reader( path, codec, external=True ):
+    """ binary stream of decompressed data via the fastest available backend """
+    if codec == "gzip" and is_bgzf( path ):
+        return io.BufferedReader( BGZFReader( path ) )
+    if external:
+        for command in c_commands.get( codec, [] ):
+            if which( command[0] ) is not None:
+                return io.BufferedReader( ProcessReader( command, path ) )
+    if codec == "gzip":
+        return gzip.open( path, "rb" )
+    elif codec == "bz2":
+        return bz2.BZ2File( path, "rb" )
+    elif codec == "xz" and lzma is not None:
+        return lzma.open( path, "rb" )
+    elif codec == "zstd" and zstandard is not None:
+        return zstandard.ZstdDecompressor( ).stream_reader( open( path, "rb" ), closefd=True )
+    elif codec == "lz4" and lz4frame is not None:
+        return lz4frame.open( path, "rb" )
+    raise IOError( "No {} decompressor available (install the python module or the command-line tool)".format( codec ) )
+
+def open_binary_writer( path, codec, mode="wb" ):
+    if codec == "gzip":
+        return gzip.open( path, mode )
+    elif codec == "bz2":
+        return bz2.BZ2File( path, mode )
+    elif codec == "xz" and lzma is not None:
+        return lzma.open( path, mode )
+    elif codec == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor( ).stream_writer( open( path, mode ), closefd=True )
+    elif codec == "lz4" and lz4frame is not None:
+        return lz4frame.open( path, mode )
+    raise IOError( "No {} compressor available (install the python module)".format( codec ) )
+
+# ---------------------------------------------------------------
+# main interface
+# ---------------------------------------------------------------
+
+def open_compressed( path, mode="r", external=True, **kwargs ):
+    """
+    open path for reading ( codec from magic bytes ) or writing ( codec from
+    extension ); returns None for plain files so the caller can use open()
+    text modes ( "r", "w", "a", "rt", ... ) return text handles
+    """
+    binary = "b" in mode
+    if "r" in mode:
+        codec = sniff( path )
+        if codec is None:
+            return None
+        fh = open_binary_reader( path, codec, external=external )
+    else:
+        codec = codec_from_extension( path )
+        if codec is None:
+            return None
+        fh = open_binary_writer( path, codec, mode=mode.replace( "t", "" ).replace( "b", "" ) + "b" )
+    if binary:
+        return fh
+    return io.TextIOWrapper( fh, encoding=kwargs.get( "encoding" ),
+                             errors=kwargs.get( "errors" ), newline=kwargs.get( "newline" ) )
+
+# ---------------------------------------------------------------
+# buffered / compressed / atomic output
+# ---------------------------------------------------------------
+
+def compressobj( codec, level=None ):
+    """ object with compress( bytes ) and flush( ) for a streaming codec """
+    if codec == "gzip":
+        # wbits=31 writes a gzip header and trailer
+        return zlib.compressobj( 6 if level is None else level, zlib.DEFLATED, 31 )
+    elif codec == "bz2":
+        return bz2.BZ2Compressor( 9 if level is None else level )
+    elif codec == "xz" and lzma is not None:
+        return lzma.LZMACompressor( preset=level )
+    elif codec == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor( level=3 if level is None else level, threads=-1 ).compressobj( )
+    return None
+
+class ProcessCompressor:
+
+    """ compressobj-like front end for an external compressor writing to fh """
+
+    def __init__( self, command, fh ):
+        self.process = subprocess.Popen( command, stdin=subprocess.PIPE, stdout=fh )
+
+    def compress( self, data ):
+        self.process.stdin.write( data )
+        return b""
+
+    def flush( self ):
+        self.process.stdin.close( )
+        if self.process.wait( ) != 0:
+            raise IOError( "External compressor failed" )
+        return b""
+
+class OutputWriter:
+
+    """
+    text output with a large buffer; full blocks are encoded, compressed and
+    written by a background thread ( so formatting and compression overlap );
+    files are written to a temp file and renamed into place on a clean close
+    """
+
+    def __init__( self, path=None, codec=None, level=None, buffer_size=c_write_buffer,
+                  atomic=True, encoding="utf-8" ):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.encoding = encoding
+        self.atomic = atomic and path is not None
+        self.parts = []
+        self.size = 0
+        self.error = None
+        self.closed = False
+        if path is None:
+            self.fh = getattr( sys.stdout, "buffer", sys.stdout )
+            self.temp = None
+        elif self.atomic:
+            folder = os.path.dirname( os.path.abspath( path ) )
+            fd, self.temp = tempfile.mkstemp( dir=folder, prefix=c_temp_prefix )
+            # mkstemp files are private; give the output the usual permissions
+            umask = os.umask( 0 )
+            os.umask( umask )
+            os.chmod( self.temp, 0o666 & ~umask )
+            self.fh = os.fdopen( fd, "wb" )
+        else:
+            self.temp = None
+            self.fh = open( path, "wb" )
+        self.compressor = None
+        if codec is not None:
+            self.compressor = compressobj( codec, level )
+            if self.compressor is None:
+                for command in c_commands.get( codec, [] ):
+                    if which( command[0] ) is not None:
+                        # same tools, compressing: drop the "-d" flag
+                        command = [k.replace( "d", "" ) if k.startswith( "-d" ) else k for k in command]
+                        self.fh.flush( )
+                        self.compressor = ProcessCompressor( command, self.fh )
+                        break
+            if self.compressor is None:
+                raise IOError( "No {} compressor available".format( codec ) )
+        self.queue = []
+        self.ready = threading.Condition( )
+        self.thread = threading.Thread( target=self.drain )
+        self.thread.daemon = True
+        self.thread.start( )
+
+    # ---- background thread ----
+
+    def drain( self ):
+        while True:
+            with self.ready:
+                while len( self.queue ) == 0:
+                    self.ready.wait( )
+                block = self.queue.pop( 0 )
+                self.ready.notify_all( )
+            if block is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                if self.compressor is not None:
+                    block = self.compressor.compress( block )
+                self.fh.write( block )
+            except Exception as e:
+                self.error = e
+
+    def submit( self, block ):
+        with self.ready:
+            while len( self.queue ) >= c_write_queue:
+                self.ready.wait( )
+            self.queue.append( block )
+            self.ready.notify_all( )
+
+    def check( self ):
+        if self.error is not None:
+            raise IOError( "Writing {} failed: {}".format( self.path, self.error ) )
+
+    # ---- file-like interface ----
+
+    def write( self, text ):
+        self.parts.append( text )
+        self.size += len( text )
+        if self.size >= self.buffer_size:
+            self.flush( )
+
+    def writelines( self, lines ):
+        for line in lines:
+            self.write( line )
+
+    def flush( self ):
+        self.check( )
+        if self.size > 0:
+            self.submit( "".join( self.parts ).encode( self.encoding ) )
+            self.parts, self.size = [], 0
+
+    def close( self, abort=False ):
+        if self.closed:
+            return
+        self.closed = True
+        if not abort:
+            self.flush( )
+        self.submit( None )
+        self.thread.join( )
+        try:
+            if not abort and self.error is None and self.compressor is not None:
+                self.fh.write( self.compressor.flush( ) )
+        except Exception as e:
+            self.error = e
+        if self.path is None:
+            self.fh.flush( )
+        else:
+            self.fh.close( )
+        if self.temp is not None:
+            if abort or self.error is not None:
+                os.remove( self.temp )
+            else:
+                os.replace( self.temp, self.path ) if hasattr( os, "replace" ) \
+                    else os.rename( self.temp, self.path )
+        self.check( )
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, kind, value, traceback ):
+        # an exception while writing leaves any previous output untouched
+        self.close( abort=kind is not None )
+
+def open_output( path=None, codec="auto", **kwargs ):
+    """ buffered text writer for path ( stdout if None ); codec "auto" follows the extension """
+    if codec == "auto":
+        codec = codec_from_extension( path ) if path is not None else None
+    return OutputWriter( path, codec=codec, **kwargs )
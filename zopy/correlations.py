@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+"""
+All-pairs correlations between the rows (features) of a numeric matrix
+======================================================================
+Rows are rank-transformed (spearman), centered and compared tile by tile
+with matrix products, so memory scales with the tile size rather than
+with the number of pairs. NaNs are treated as missing and dropped
+pairwise. For spearman, rows are ranked once over their own non-missing
+values (exact when there are no NaNs).
+"""
+
+from __future__ import print_function
+
+import numpy as np
+from scipy.stats import rankdata
+from scipy.stats import t as t_dist
+
+from zopy.utils import die
+
+# ---------------------------------------------------------------
+# constants
+# ---------------------------------------------------------------
+
+c_methods = ["pearson", "spearman"]
+# rows per tile; a tile pair holds ~6 x c_block^2 floats
+c_block   = 1000
+c_min_n   = 3
+
+# ---------------------------------------------------------------
+# preparation
+# ---------------------------------------------------------------
+
+def rank_rows( data ):
+    """ rank each row ( average ties ); nans are skipped and stay nan """
+    missing = np.isnan( data )
+    if not missing.any( ):
+        return rankdata( data, axis=1 )
+    ranks = np.full( data.shape, np.nan )
+    for i, row in enumerate( data ):
+        keep = ~missing[i]
+        ranks[i, keep] = rankdata( row[keep] )
+    return ranks
+
+def prepare( data, method ):
+    """ return ( transformed rows, complete? ); complete rows are unit-norm and centered """
+    if method not in c_methods:
+        die( "Unknown correlation method:", method, "(choose from", c_methods, ")" )
+    data = np.asarray( data, dtype=float )
+    if method == "spearman":
+        data = rank_rows( data )
+    complete = not np.isnan( data ).any( )
+    with np.errstate( invalid="ignore", divide="ignore" ):
+        # centering first limits cancellation in the pairwise sums
+        data = data - np.nanmean( data, axis=1 )[:, None]
+        if complete:
+            data = data / np.sqrt( np.sum( data**2, axis=1 ) )[:, None]
+    return data, complete
+
+# ---------------------------------------------------------------
+# tile computation
+# ---------------------------------------------------------------
+
+def tile_stats( A, B, complete ):
+    """ correlation and pairwise-complete n for every row of A vs. every row of B """
+    if complete:
+        r = A.dot( B.T )
+        n = np.full( r.shape, A.shape[1], dtype=float )
+    else:
+        fA = ( ~np.isnan( A ) ).astype( float )
+        fB = ( ~np.isnan( B ) ).astype( float )
+        A = np.where( fA > 0, A, 0.0 )
+        B = np.where( fB > 0, B, 0.0 )
+        n = fA.dot( fB.T )
+        sx = A.dot( fB.T )
+        sy = fA.dot( B.T )
+        with np.errstate( invalid="ignore", divide="ignore" ):
+            cov = A.dot( B.T ) - sx * sy / n
+            vx = ( A**2 ).dot( fB.T ) - sx**2 / n
+            vy = fA.dot( ( B**2 ).T ) - sy**2 / n
+            r = cov / np.sqrt( vx * vy )
+    return np.clip( r, -1.0, 1.0 ), n
+
+def r2p( r, n ):
+    """ two-sided pvalues for correlations r over n points ( t-distribution ) """
+    r = np.asarray( r, dtype=float )
+    df = np.asarray( n, dtype=float ) - 2
+    with np.errstate( invalid="ignore", divide="ignore" ):
+        t = r * np.sqrt( df / ( ( 1 - r ) * ( 1 + r ) ) )
+        p = 2 * t_dist.sf( np.abs( t ), df )
+    return np.where( df > 0, p, np.nan )
+
+def iter_tiles( data, method="spearman", block=c_block, upper=True ):
+    """ yield ( i0, j0, r, n ) per tile; with upper, only tiles on/above the diagonal """
+    X, complete = prepare( data, method )
+    nrows = len( X )
+    for i0 in range( 0, nrows, block ):
+        A = X[i0:i0+block]
+        for j0 in range( i0 if upper else 0, nrows, block ):
+            r, n = tile_stats( A, X[j0:j0+block], complete )
+            yield i0, j0, r, n
+
+# ---------------------------------------------------------------
+# outputs
+# ---------------------------------------------------------------
+
+def iter_edges( data, names=None, method="spearman", threshold=0.0,
+                max_p=None, min_n=c_min_n, block=c_block ):
+    """ yield ( name1, name2, r, p, n ) for each row pair with |r| >= threshold """
+    names = names if names is not None else list( range( len( data ) ) )
+    for i0, j0, r, n in iter_tiles( data, method=method, block=block ):
+        keep = ( np.abs( r ) >= threshold ) & ( n >= min_n )
+        if i0 == j0:
+            # self-tile: upper triangle only
+            keep &= np.triu( np.ones( keep.shape, dtype=bool ), k=1 )
+        ii, jj = np.nonzero( keep )
+        rr, nn = r[ii, jj], n[ii, jj]
+        pp = r2p( rr, nn )
+        for i, j, rv, pv, nv in zip( ii, jj, rr, pp, nn ):
+            if max_p is None or pv <= max_p:
+                yield names[i0+i], names[j0+j], rv, pv, int( nv )
+
+def correlation_matrix( data, method="spearman", pvalues=False, block=c_block ):
+    """ dense all-pairs correlation ( and optionally pvalue ) matrix; for modest row counts """
+    nrows = len( data )
+    R = np.empty( ( nrows, nrows ) )
+    N = np.empty( ( nrows, nrows ) )
+    for i0, j0, r, n in iter_tiles( data, method=method, block=block ):
+        i1, j1 = i0 + r.shape[0], j0 + r.shape[1]
+        R[i0:i1, j0:j1], N[i0:i1, j0:j1] = r, n
+        R[j0:j1, i0:i1], N[j0:j1, i0:i1] = r.T, n.T
+    return R if not pvalues else ( R, r2p( R, N ) )
+
+# ---------------------------------------------------------------
+# tests
+# ---------------------------------------------------------------
+
+if __name__ == "__main__":
+    from scipy.stats import spearmanr, pearsonr
+    data = np.random.rand( 7, 20 )
+    R, P = correlation_matrix( data, pvalues=True, block=3 )
+    r, p = spearmanr( data[0], data[5] )
+    assert abs( R[0, 5] - r ) < 1e-9 and abs( P[0, 5] - p ) < 1e-9
+    data[2, 3] = np.nan
+    R = correlation_matrix( data, method="pearson", block=3 )
+    keep = ~np.isnan( data[2] )
+    assert abs( R[2, 4] - pearsonr( data[2, keep], data[4, keep] )[0] ) < 1e-9
+    assert len( list( iter_edges( data, block=3 ) ) ) == 7 * 6 / 2
+    print( "ok" )
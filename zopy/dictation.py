@@ -4,8 +4,17 @@
 Slice columns from tables into dictionaries
 """
 
+import os
 import sys
 import csv
+import tempfile
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+import numpy as np
+
 from zopy.utils import try_open, warn, die
 
 # ---------------------------------------------------------------
@@ -13,6 +22,10 @@ from zopy.utils import try_open, warn, die
 # ---------------------------------------------------------------
 
 c_default = None
+# rows encoded to byte-string arrays at a time by the compact loaders
+c_chunk_rows = 100000
+# bumped when the layout of compact caches changes
+c_cache_version = 1
 
 # ---------------------------------------------------------------
 # shared methods
@@ -138,3 +151,328 @@ def ddjoin( dd1, dd2 ):
             for k3, value in dd2.get( k2, {} ).items( ):
                 dd.setdefault( k1, {} )[k3] = value
     return dd
+
+# ---------------------------------------------------------------
+# compact ( array-backed ) loaders
+# ---------------------------------------------------------------
+
+"""
+The compact_* loaders mirror col2dict, col2dict2 and polymap for very large
+mappings ( e.g. 100M UniRef->GO pairs ). Strings are interned once into
+sorted utf8 byte-string arrays and referenced by integer id; one-to-many
+mappings are stored CSR-style ( sorted keys, offsets, member ids ). Lookups
+are binary searches. Passing cache=<path> saves the arrays to a .npz on the
+first load and reuses them while the cache is newer than the source.
+"""
+
+def encode( items ):
+    """ utf8 byte-string array ( one byte per ascii char vs. four for numpy unicode ) """
+    return np.array( [k.encode( "utf8" ) for k in items], dtype=bytes )
+
+def decode( item ):
+    return item.decode( "utf8" )
+
+def concat( chunks ):
+    return np.concatenate( chunks ) if len( chunks ) > 0 else np.array( [], dtype=bytes )
+
+def find( vocab, key ):
+    """ position of key in a sorted byte-string array, or -1 """
+    if not isinstance( key, bytes ):
+        key = key.encode( "utf8" )
+    i = int( np.searchsorted( vocab, np.array( key ) ) )
+    return i if i < len( vocab ) and vocab[i] == key else -1
+
+def intern( items ):
+    """ ( sorted unique vocab, integer ids of items into vocab ) """
+    vocab, ids = np.unique( items, return_inverse=True )
+    return vocab, ids.astype( np.int32 if len( vocab ) < 2**31 else np.int64 ).ravel( )
+
+def last_of_runs( *sorted_ids ):
+    """ mask of the last element of each run of equal ( already sorted ) keys """
+    mask = np.ones( len( sorted_ids[0] ), dtype=bool )
+    if len( mask ) > 0:
+        changed = np.zeros( len( mask ) - 1, dtype=bool )
+        for ids in sorted_ids:
+            changed |= ids[1:] != ids[:-1]
+        mask[:-1] = changed
+    return mask
+
+def report_overwrites( keys, values, last, verbose=True ):
+    """ warn ( once ) about keys whose earlier values are overwritten by a different value """
+    if not verbose or values is None or last.all( ):
+        return None
+    group = np.cumsum( last[::-1] )[::-1]
+    group = group.max( ) - group
+    final = values[last][group]
+    differ = np.array( values != final, dtype=bool )
+    if differ.any( ):
+        i = int( np.flatnonzero( differ )[0] )
+        show = lambda k: decode( k ) if isinstance( k, bytes ) else k
+        warn( "Overwrote values for {:,} keys, e.g. <{}>:<{}> with <{}>".format(
+            len( np.unique( group[differ] ) ), show( keys[i] ), show( values[i] ), show( final[i] ) ) )
+
+class CompactDict( Mapping ):
+
+    """ read-only key->value mapping over sorted arrays ( see compact_col2dict ) """
+
+    def __init__( self, keys, values=None, vocab=None ):
+        # values: ids into vocab ( interned strings ), any array, or None ( all c_default )
+        self.keys_ = keys
+        self.values_ = values
+        self.vocab = vocab
+
+    def value( self, i ):
+        if self.values_ is None:
+            return c_default
+        elif self.vocab is not None:
+            return decode( self.vocab[self.values_[i]] )
+        return self.values_[i]
+
+    def __getitem__( self, key ):
+        i = find( self.keys_, key )
+        if i < 0:
+            raise KeyError( key )
+        return self.value( i )
+
+    def __contains__( self, key ):
+        return find( self.keys_, key ) >= 0
+
+    def __iter__( self ):
+        for key in self.keys_:
+            yield decode( key )
+
+    def __len__( self ):
+        return len( self.keys_ )
+
+    def items( self ):
+        for i, key in enumerate( self ):
+            yield key, self.value( i )
+
+    def arrays( self ):
+        return {"keys": self.keys_, "values": self.values_, "vocab": self.vocab}
+
+class CompactMultiDict( Mapping ):
+
+    """
+    read-only key->members mapping stored CSR-style ( see compact_polymap )
+    members come back as a frozenset ( or, with values, an inner dict )
+    """
+
+    def __init__( self, keys, offsets, members, vocab, values=None, value_vocab=None ):
+        self.keys_ = keys
+        self.offsets = offsets
+        self.members = members
+        self.vocab = vocab
+        self.values_ = values
+        self.value_vocab = value_vocab
+
+    def inner( self, i ):
+        span = slice( self.offsets[i], self.offsets[i + 1] )
+        members = [decode( k ) for k in self.vocab[self.members[span]]]
+        if self.values_ is None:
+            return frozenset( members )
+        values = [decode( k ) for k in self.value_vocab[self.values_[span]]]
+        return dict( zip( members, values ) )
+
+    def __getitem__( self, key ):
+        i = find( self.keys_, key )
+        if i < 0:
+            raise KeyError( key )
+        return self.inner( i )
+
+    def __contains__( self, key ):
+        return find( self.keys_, key ) >= 0
+
+    def __iter__( self ):
+        for key in self.keys_:
+            yield decode( key )
+
+    def __len__( self ):
+        return len( self.keys_ )
+
+    def items( self ):
+        for i, key in enumerate( self ):
+            yield key, self.inner( i )
+
+    def size( self, key ):
+        """ number of members of key without building them """
+        i = find( self.keys_, key )
+        return 0 if i < 0 else int( self.offsets[i + 1] - self.offsets[i] )
+
+    def arrays( self ):
+        return {"keys": self.keys_, "offsets": self.offsets, "members": self.members,
+                "vocab": self.vocab, "values": self.values_, "value_vocab": self.value_vocab}
+
+def build_multidict( outer, inner, values=None, verbose=True ):
+    """ CompactMultiDict from aligned byte-string arrays; a repeated pair keeps its last value """
+    keys, outer_ids = intern( outer )
+    vocab, inner_ids = intern( inner )
+    # stable: among repeated pairs the last one sorts last
+    order = np.lexsort( ( inner_ids, outer_ids ) )
+    outer_ids, inner_ids = outer_ids[order], inner_ids[order]
+    keep = last_of_runs( outer_ids, inner_ids )
+    value_vocab = None
+    if values is not None:
+        values = values[order]
+        report_overwrites( outer[order], values, keep, verbose=verbose )
+        value_vocab, values = intern( values[keep] )
+    offsets = np.zeros( len( keys ) + 1, dtype=np.int64 )
+    np.cumsum( np.bincount( outer_ids[keep], minlength=len( keys ) ), out=offsets[1:] )
+    return CompactMultiDict( keys, offsets, inner_ids[keep], vocab, values, value_vocab )
+
+# ---------------------------------------------------------------
+# binary cache
+# ---------------------------------------------------------------
+
+def save_compact( mapping, path, signature="" ):
+    """ write the mapping's arrays to a .npz ( atomically: temp file + rename ) """
+    arrays = {k: v for k, v in mapping.arrays( ).items( ) if v is not None}
+    if any( v.dtype.hasobject for v in arrays.values( ) ):
+        die( "Can't cache a compact mapping holding python objects (e.g. from func)" )
+    arrays["kind"] = np.array( type( mapping ).__name__ )
+    arrays["signature"] = np.array( "{}:{}".format( c_cache_version, signature ) )
+    fd, temp = tempfile.mkstemp( dir=os.path.dirname( os.path.abspath( path ) ), prefix=".tmp-" )
+    try:
+        with os.fdopen( fd, "wb" ) as fh:
+            np.savez( fh, **arrays )
+        getattr( os, "replace", os.rename )( temp, path )
+    except Exception:
+        if os.path.exists( temp ):
+            os.remove( temp )
+        raise
+
+def load_compact( path, signature=None ):
+    """ mapping from a .npz cache; None if it was built with a different signature """
+    with np.load( path, allow_pickle=False ) as data:
+        arrays = {k: data[k] for k in data.files}
+    found = str( arrays.pop( "signature" ) )
+    if signature is not None and found != "{}:{}".format( c_cache_version, signature ):
+        return None
+    kind = {"CompactDict": CompactDict, "CompactMultiDict": CompactMultiDict}[str( arrays.pop( "kind" ) )]
+    return kind( **arrays )
+
+def cached( path, cache, signature, build ):
+    """ reuse cache if newer than path and built with the same options; else build and save """
+    if cache is not None and os.path.exists( cache ) \
+            and os.path.getmtime( cache ) >= os.path.getmtime( path ):
+        mapping = load_compact( cache, signature=signature )
+        if mapping is not None:
+            return mapping
+    mapping = build( )
+    if cache is not None:
+        save_compact( mapping, cache, signature=signature )
+    return mapping
+
+# ---------------------------------------------------------------
+# compact versions of the loaders
+# ---------------------------------------------------------------
+
+def read_tuples( path, headers, expand, width ):
+    """ byte-string arrays ( one per position ) of the string tuples that expand( row ) yields """
+    columns = [[] for i in range( width )]
+    chunks = []
+    for row in read_csv( path, headers ):
+        for items in expand( row ):
+            for column, item in zip( columns, items ):
+                column.append( item )
+        if len( columns[0] ) >= c_chunk_rows:
+            chunks.append( [encode( column ) for column in columns] )
+            columns = [[] for i in range( width )]
+    chunks.append( [encode( column ) for column in columns] )
+    return [concat( parts ) for parts in zip( *chunks )]
+
+def compact_col2dict( path, key=0, value=None, 
+                      func=None, headers=False, verbose=True, cache=None ):
+    """
+    As col2dict, but returns a CompactDict ( string values are interned )
+    func results are kept as python objects ( and can't be cached )
+    """
+    if func is not None and cache is not None:
+        die( "compact_col2dict can't cache func results" )
+    def build( ):
+        if func is not None:
+            keys, values = [], []
+            for row in read_csv( path, headers ):
+                keys.append( row[key] )
+                values.append( get_value( row, value, func ) )
+            keys, objects = encode( keys ), values
+            values = np.empty( len( keys ), dtype=object )
+            values[:] = objects
+        elif value is not None:
+            keys, values = read_tuples( path, headers, lambda row: [( row[key], row[value] )], 2 )
+        else:
+            keys, = read_tuples( path, headers, lambda row: [( row[key], )], 1 )
+            values = None
+        # stable: the last row for a key sorts last and wins ( as in test_insert )
+        order = np.argsort( keys, kind="mergesort" )
+        keys = keys[order]
+        last = last_of_runs( keys )
+        if values is None:
+            return CompactDict( keys[last] )
+        values = values[order]
+        report_overwrites( keys, values, last, verbose=verbose )
+        keys, values = keys[last], values[last]
+        if values.dtype.hasobject:
+            return CompactDict( keys, values )
+        vocab, ids = intern( values )
+        return CompactDict( keys, ids, vocab )
+    return cached( path, cache, repr( ( "col2dict", key, value, headers ) ), build )
+
+def compact_col2dict2( path, key1=0, key2=1, value=None, 
+                       headers=False, mirror=False, verbose=True, cache=None ):
+    """
+    As col2dict2 ( without func/tupledict ), but returns a CompactMultiDict:
+    [key1] gives a dict of key2->value, or a frozenset of key2 if value is None
+    """
+    def expand( row ):
+        item = row[value] if value is not None else ""
+        yield row[key1], row[key2], item
+        if mirror:
+            yield row[key2], row[key1], item
+    def build( ):
+        outer, inner, values = read_tuples( path, headers, expand, 3 )
+        return build_multidict( outer, inner, values if value is not None else None, verbose=verbose )
+    return cached( path, cache, repr( ( "col2dict2", key1, key2, value, headers, mirror ) ), build )
+
+def compact_polymap( path, key=0, skip=None, headers=False, reverse=False, cache=None ):
+    """
+    As polymap, but returns a CompactMultiDict: [key] gives a frozenset of values
+    """
+    skip = set( skip if skip is not None else [] ) | {key}
+    def expand( row ):
+        if key > len( row ) - 1:
+            warn( "skipping unindexable short row:", row )
+            return
+        for i, item in enumerate( row ):
+            if i not in skip:
+                yield ( item, row[key] ) if reverse else ( row[key], item )
+    def build( ):
+        outer, inner = read_tuples( path, headers, expand, 2 )
+        return build_multidict( outer, inner )
+    return cached( path, cache, repr( ( "polymap", key, sorted( skip ), headers, reverse ) ), build )
+
+# ---------------------------------------------------------------
+# tests
+# ---------------------------------------------------------------
+
+if __name__ == "__main__":
+    folder = tempfile.mkdtemp( )
+    path = os.path.join( folder, "map.tsv" )
+    with open( path, "w" ) as fh:
+        fh.write( "k1\tb\ta\n" )
+        fh.write( "k2\tc\n" )
+        fh.write( "k1\ta\td\n" )
+        fh.write( "k\u00e9\tz\n" )
+    for reverse in [False, True]:
+        slow = polymap( path, reverse=reverse, sets=True )
+        fast = compact_polymap( path, reverse=reverse )
+        assert dict( fast.items( ) ) == slow
+        assert all( fast.size( k ) == len( v ) for k, v in slow.items( ) )
+    assert dict( compact_col2dict( path, value=1, verbose=False ).items( ) ) == col2dict( path, value=1, verbose=False )
+    assert dict( compact_col2dict2( path, value=1, verbose=False ).items( ) ) == \
+        {k: dict( v ) for k, v in col2dict2( path, value=1, verbose=False ).items( )}
+    cache = os.path.join( folder, "map.npz" )
+    first = compact_polymap( path, cache=cache )
+    again = compact_polymap( path, cache=cache )
+    assert dict( again.items( ) ) == dict( first.items( ) ) and "missing" not in again
+    print( "ok" )
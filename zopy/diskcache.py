@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+"""
+Persistent on-disk memoization for expensive computations
+=========================================================
+Results are keyed on a hash of the function's name and arguments
+(array contents and the mtimes of any input files included) and
+stored as .npy (numeric arrays) or .pkl (everything else) blobs.
+
+Writes go to a temp file in the cache dir and are renamed into place,
+so concurrent processes on a shared filesystem never see partial
+blobs. The cache is pruned least-recently-used first (by mtime,
+refreshed on every hit) once it exceeds its size cap.
+
+Set ZOPY_CACHE_DIR to move the cache; set ZOPY_NO_CACHE to bypass it.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import pickle
+import hashlib
+import tempfile
+from functools import wraps
+
+import numpy as np
+
+from zopy.utils import say, warn
+
+# ---------------------------------------------------------------
+# constants
+# ---------------------------------------------------------------
+
+c_cache_dir   = os.environ.get( "ZOPY_CACHE_DIR",
+                    os.path.join( os.path.expanduser( "~" ), ".cache", "zopy" ) )
+c_disabled    = "ZOPY_NO_CACHE" in os.environ
+c_max_bytes   = 2 * 1024**3
+c_prune_to    = 0.8
+c_stale_temp  = 24 * 3600
+c_temp_prefix = ".tmp-"
+c_npy_ext     = ".npy"
+c_pkl_ext     = ".pkl"
+c_strings     = ( str, type( u"" ) )
+
+# atomic-with-overwrite on posix and windows (py3); posix only (py2)
+rename = getattr( os, "replace", os.rename )
+
+# ---------------------------------------------------------------
+# argument hashing
+# ---------------------------------------------------------------
+
+def update_hash( hasher, obj ):
+    """ feed a canonical (run-to-run stable) representation of obj to hasher """
+    if obj is None or isinstance( obj, ( bool, int, float, complex, np.generic ) ):
+        hasher.update( repr( ( type( obj ).__name__, obj ) ).encode( "utf8" ) )
+    elif isinstance( obj, c_strings ):
+        hasher.update( b"str:" )
+        hasher.update( obj if isinstance( obj, bytes ) else obj.encode( "utf8" ) )
+        # strings naming files also key on the file's state
+        if os.path.isfile( obj ):
+            stat = os.stat( obj )
+            hasher.update( repr( ( stat.st_mtime, stat.st_size ) ).encode( "utf8" ) )
+    elif isinstance( obj, bytes ):
+        hasher.update( b"bytes:" )
+        hasher.update( obj )
+    elif isinstance( obj, np.ndarray ):
+        hasher.update( repr( ( "ndarray", obj.dtype.str, obj.shape ) ).encode( "utf8" ) )
+        if obj.dtype.hasobject:
+            update_hash( hasher, obj.tolist( ) )
+        else:
+            hasher.update( np.ascontiguousarray( obj ) )
+    elif isinstance( obj, ( list, tuple ) ):
+        hasher.update( repr( ( type( obj ).__name__, len( obj ) ) ).encode( "utf8" ) )
+        for item in obj:
+            update_hash( hasher, item )
+    elif isinstance( obj, dict ):
+        # digest items independently so insertion/hash order doesn't matter
+        hasher.update( repr( ( "dict", len( obj ) ) ).encode( "utf8" ) )
+        for digest in sorted( digest_of( item ) for item in obj.items( ) ):
+            hasher.update( digest.encode( "utf8" ) )
+    elif isinstance( obj, ( set, frozenset ) ):
+        hasher.update( repr( ( "set", len( obj ) ) ).encode( "utf8" ) )
+        for digest in sorted( digest_of( item ) for item in obj ):
+            hasher.update( digest.encode( "utf8" ) )
+    elif callable( obj ) and hasattr( obj, "__name__" ):
+        hasher.update( repr( ( "callable", getattr( obj, "__module__", None ),
+                               obj.__name__ ) ).encode( "utf8" ) )
+    elif hasattr( obj, "__dict__" ):
+        hasher.update( repr( ( "object", type( obj ).__name__ ) ).encode( "utf8" ) )
+        update_hash( hasher, vars( obj ) )
+    else:
+        hasher.update( pickle.dumps( obj, 2 ) )
+
+def digest_of( obj ):
+    """ hex digest of a single object """
+    hasher = hashlib.sha1( )
+    update_hash( hasher, obj )
+    return hasher.hexdigest( )
+
+def call_key( func, args, kwargs, namespace=None ):
+    """ hex digest identifying one call of func """
+    name = ( func.__module__, func.__name__, namespace )
+    return digest_of( ( name, args, kwargs ) )
+
+# ---------------------------------------------------------------
+# blob storage
+# ---------------------------------------------------------------
+
+def blob_paths( cache_dir, key ):
+    """ candidate blob paths for key; sharded by leading digits """
+    stem = os.path.join( cache_dir, key[0:2], key )
+    return stem + c_npy_ext, stem + c_pkl_ext
+
+def is_plain_array( value ):
+    return isinstance( value, np.ndarray ) and not value.dtype.hasobject
+
+def load_blob( path ):
+    """ return ( hit, value ); a vanished or unreadable blob is a miss """
+    try:
+        if path.endswith( c_npy_ext ):
+            value = np.load( path, allow_pickle=False )
+        else:
+            with open( path, "rb" ) as fh:
+                value = pickle.load( fh )
+    except Exception:
+        return False, None
+    # refresh mtime so pruning treats this blob as recently used
+    try:
+        os.utime( path, None )
+    except OSError:
+        pass
+    return True, value
+
+def save_blob( path, value ):
+    """ write to a private temp file, then rename into place """
+    folder = os.path.dirname( path )
+    if not os.path.isdir( folder ):
+        try:
+            os.makedirs( folder )
+        except OSError:
+            # another process may have created it in the meantime
+            if not os.path.isdir( folder ):
+                raise
+    fd, temp = tempfile.mkstemp( dir=folder, prefix=c_temp_prefix )
+    try:
+        with os.fdopen( fd, "wb" ) as fh:
+            if path.endswith( c_npy_ext ):
+                np.save( fh, value, allow_pickle=False )
+            else:
+                pickle.dump( value, fh, pickle.HIGHEST_PROTOCOL )
+            fh.flush( )
+            os.fsync( fh.fileno( ) )
+        rename( temp, path )
+    except Exception:
+        if os.path.exists( temp ):
+            os.remove( temp )
+        raise
+
+def prune( cache_dir, max_bytes=c_max_bytes ):
+    """ delete least-recently-used blobs until the cache fits under max_bytes """
+    now = time.time( )
+    blobs = []
+    total = 0
+    for folder, dirs, files in os.walk( cache_dir ):
+        for name in files:
+            path = os.path.join( folder, name )
+            try:
+                stat = os.stat( path )
+            except OSError:
+                # removed by a concurrent process
+                continue
+            if name.startswith( c_temp_prefix ):
+                # leave in-flight writes alone; clear out abandoned ones
+                if now - stat.st_mtime > c_stale_temp:
+                    remove_quietly( path )
+                continue
+            blobs.append( ( stat.st_mtime, stat.st_size, path ) )
+            total += stat.st_size
+    if total <= max_bytes:
+        return None
+    for mtime, size, path in sorted( blobs ):
+        if total <= c_prune_to * max_bytes:
+            break
+        remove_quietly( path )
+        total -= size
+
+def remove_quietly( path ):
+    try:
+        os.remove( path )
+    except OSError:
+        pass
+
+def clear( cache_dir=None ):
+    """ empty the cache """
+    prune( cache_dir if cache_dir is not None else c_cache_dir, max_bytes=-1 )
+
+# ---------------------------------------------------------------
+# decorator
+# ---------------------------------------------------------------
+
+def disk_memoize( func=None, cache_dir=None, max_bytes=c_max_bytes,
+                  namespace=None, verbose=False ):
+    """
+    cache a function's return values on disk across script invocations
+    usable as @disk_memoize or @disk_memoize( max_bytes=..., namespace=... );
+    bump namespace to invalidate old results after changing func's logic
+    """
+    if func is None:
+        return lambda func: disk_memoize( func, cache_dir=cache_dir, max_bytes=max_bytes,
+                                          namespace=namespace, verbose=verbose )
+    @wraps( func )
+    def inner( *args, **kwargs ):
+        if c_disabled:
+            return func( *args, **kwargs )
+        folder = cache_dir if cache_dir is not None else c_cache_dir
+        key = call_key( func, args, kwargs, namespace=namespace )
+        for path in blob_paths( folder, key ):
+            if os.path.exists( path ):
+                hit, value = load_blob( path )
+                if hit:
+                    if verbose:
+                        say( "Loaded cached result of {}: {}".format( func.__name__, path ) )
+                    return value
+        value = func( *args, **kwargs )
+        npy_path, pkl_path = blob_paths( folder, key )
+        try:
+            save_blob( npy_path if is_plain_array( value ) else pkl_path, value )
+            prune( folder, max_bytes=max_bytes )
+        except Exception as e:
+            # a cache failure should never cost the caller its result
+            warn( "Could not cache result of", func.__name__, "in", folder, ":", e )
+        return value
+    return inner
+
+# ---------------------------------------------------------------
+# tests
+# ---------------------------------------------------------------
+
+if __name__ == "__main__":
+    folder = tempfile.mkdtemp( )
+    calls = []
+    @disk_memoize( cache_dir=folder )
+    def square( x ):
+        calls.append( x )
+        return np.asarray( x ) ** 2
+    a = np.arange( 10 )
+    assert ( square( a ) == square( a.copy( ) ) ).all( )
+    assert len( calls ) == 1
+    square( a + 1 )
+    assert len( calls ) == 2
+    clear( folder )
+    square( a )
+    assert len( calls ) == 3
+    print( "ok" )
@@ -7,7 +7,8 @@ import numpy as np
 from scipy.stats import fisher_exact, mannwhitneyu
 
 from zopy.utils import qw, say
-from zopy.fdr import pvalues2qvalues as apply_fdr
+from zopy.fdr import qvalues
+from zopy.dictation import CompactMultiDict, encode, decode, find
 
 #-------------------------------------------------------------------------------
 # constants
@@ -81,30 +82,37 @@ def generate_background( annotations ):
         background.update( members )
     return background
 
+def filtering_report( ni, nf ):
+    say( "Annotations:" )
+    say( "  Loaded: {:,}".format( ni ) )
+    if ni != nf:
+        say( "  After filtering: {:,} ({:.1f}%)".format( nf, 100.0 * nf / ni ) )
+
 def preprocess_annotations( annotations, min_size ):
     ni = nf = len( annotations )
     if min_size is not None:
         annotations = {k:v for k, v in annotations.items( ) if len( v ) >= min_size}
         nf = len( annotations )
-    say( "Annotations:" )
-    say( "  Loaded: {:,}".format( ni ) )
-    if ni != nf:
-        say( "  After filtering: {:,} ({:.1f}%)".format( nf, 100.0 * nf / ni ) )
+    filtering_report( ni, nf )
     return annotations
+
+def keys_report( message, n_keys, n_keys_annotated ):
+    say( message )
+    say( "  Total keys: {:,}".format( n_keys ) )
+    say( "  Annotated keys: {:,} ({:.1f}%)".format(
+        n_keys_annotated, 100 * n_keys_annotated / (c_eps + n_keys) ) )
  
-def annotation_report( message, linking, annotations ):
+def annotation_report( message, linking, annotations, is_annotated=None ):
     is_linked = not all( [k == v for k, v in linking.items( )] )
-    say( message )
-    is_annotated = generate_background( annotations )
+    if is_annotated is None:
+        is_annotated = generate_background( annotations )
     n_keys = len( linking )
     n_keys_annotated = len( {key for key, link in linking.items( ) if link in is_annotated} )
     is_link = set( linking.values( ) )
     n_links = len( is_link )
-    n_links_annotated = len( is_link.__and__( is_annotated ) )
+    n_links_annotated = len( [link for link in is_link if link in is_annotated] )
     # outer key results
-    say( "  Total keys: {:,}".format( n_keys ) )
-    say( "  Annotated keys: {:,} ({:.1f}%)".format(
-        n_keys_annotated, 100 * n_keys_annotated / (c_eps + n_keys) ) )
+    keys_report( message, n_keys, n_keys_annotated )
     # inner key (link) results
     if is_linked:
         say( "  Total links: {:,}".format( n_links ) )
@@ -112,43 +120,110 @@ def annotation_report( message, linking, annotations ):
             n_links_annotated, 100 * n_links_annotated / (c_eps + n_links) ) )
     return None
 
-def progress( counter, annotations ):
+def progress( counter, total ):
     say( "Testing annotation {: >5d} of {: >5d}".format(
-        counter, len( annotations ) ) )
+        counter, total ) )
+
+#-------------------------------------------------------------------------------
+# compact ( array-backed ) annotations
+#-------------------------------------------------------------------------------
+
+class CompactAnnotated:
+
+    """ link membership over a CompactMultiDict's vocab ( generate_background's set, as a mask ) """
+
+    def __init__( self, vocab, mask ):
+        self.vocab = vocab
+        self.mask = mask
+
+    def __contains__( self, link ):
+        i = find( self.vocab, link )
+        return i >= 0 and bool( self.mask[i] )
+
+def compact_ids( vocab, links ):
+    """ ids of links in a CompactMultiDict's vocab; -1 if absent """
+    links = encode( links )
+    if len( vocab ) == 0 or len( links ) == 0:
+        return np.full( len( links ), -1, dtype=np.int64 )
+    i = np.minimum( np.searchsorted( vocab, links ), len( vocab ) - 1 )
+    return np.where( vocab[i] == links, i, -1 )
+
+def compact_terms( annotations, min_size ):
+    """ ( term index of each member, mask of terms with >= min_size members ) """
+    sizes = np.diff( annotations.offsets )
+    keep = np.ones( len( sizes ), dtype=bool ) if min_size is None else sizes >= min_size
+    filtering_report( len( sizes ), int( keep.sum( ) ) )
+    return np.repeat( np.arange( len( sizes ) ), sizes ), keep
+
+def compact_fisher_counts( sample, annotations, background, intersect_background, intersect_annotated, min_size ):
+    """
+    fisher_enrich's per-term counts for a CompactMultiDict, computed on member ids
+    ( the annotations are never expanded into per-term sets of strings )
+    returns ( sample, count_background, [( term, count_overlap, count_term ), ...] )
+    """
+    vocab, members = annotations.vocab, annotations.members
+    term_of, keep = compact_terms( annotations, min_size )
+    # background=None means every annotated member ( as its own key )
+    bg_ids = np.arange( len( vocab ) ) if background is None else compact_ids( vocab, list( background.values( ) ) )
+    usable = np.ones( len( members ), dtype=bool )
+    if intersect_background:
+        if background is None:
+            sample = {key:link for key, link in sample.items( ) if find( vocab, key ) >= 0}
+        else:
+            sample = {key:link for key, link in sample.items( ) if key in background}
+        in_background = np.zeros( len( vocab ), dtype=bool )
+        in_background[bg_ids[bg_ids >= 0]] = True
+        usable = in_background[members]
+        # may result in empty annotations (removed)
+        keep &= np.bincount( term_of[usable], minlength=len( keep ) ) > 0
+    usable &= keep[term_of]
+    annotated = np.zeros( len( vocab ), dtype=bool )
+    annotated[members[usable]] = True
+    is_annotated = CompactAnnotated( vocab, annotated )
+    if intersect_annotated:
+        sample = {key:link for key, link in sample.items( ) if link in is_annotated}
+        if background is None:
+            bg_ids = np.flatnonzero( annotated )
+        else:
+            background = {key:link for key, link in background.items( ) if link in is_annotated}
+            bg_ids = compact_ids( vocab, list( background.values( ) ) )
+    # report
+    annotation_report( "Sample:", sample, None, is_annotated )
+    if background is None:
+        keys_report( "Background:", len( bg_ids ), int( annotated[bg_ids].sum( ) ) )
+    else:
+        annotation_report( "Background:", background, None, is_annotated )
+    # keys per link, summed over each term's members
+    def term_totals( ids ):
+        per_link = np.bincount( ids[ids >= 0], minlength=len( vocab ) )
+        return np.bincount( term_of[usable], weights=per_link[members[usable]], minlength=len( keep ) )
+    overlaps = term_totals( compact_ids( vocab, list( sample.values( ) ) ) )
+    term_counts = term_totals( bg_ids )
+    counts = [( decode( annotations.keys_[i] ), int( overlaps[i] ), int( term_counts[i] ) )
+              for i in np.flatnonzero( keep )]
+    return sample, len( bg_ids ), counts
 
 def attach_q_values( results ):
-    p_values = [R["p_value"] for R in results]
-    q_values = apply_fdr( p_values )
-    for R, q in zip( results, q_values ):
+    p_values = np.array( [R["p_value"] for R in results], dtype=float )
+    q_values = qvalues( p_values )
+    for R, q in zip( results, q_values.tolist( ) ):
         R["q_value"] = q
 
 #-------------------------------------------------------------------------------
 # fisher-style enrichment
 #-------------------------------------------------------------------------------
 
-def fisher_enrich( sample,
-                   annotations, 
-                   depletions=True,
-                   background=None,
-                   intersect_background=False,
-                   intersect_annotated=False,
-                   min_fold=None,
-                   min_expected_overlap=None, 
-                   fdr=None, 
-                   verbose=False, ):
+def fisher_counts( sample, annotations, background, intersect_background, intersect_annotated, min_size ):
     """
-    Perform fisher-style enrichment over a set of keys, key sets, and optional background
+    per-term counts for fisher_enrich from a {term:members} mapping
+    returns ( sample, count_background, [( term, count_overlap, count_term ), ...] )
     """
-    # enable linking
-    if type( sample ) is not dict:
-        sample = {key:key for key in sample}
     if background is None:
         background = generate_background( annotations )
-    if type( background ) in [list, set]:
         background = {key:key for key in background}
     annotations = {term:set( links ) for term, links in annotations.items( )}
     # remove useless annotations (size < min_expected_overlap)
-    annotations = preprocess_annotations( annotations, min_expected_overlap )
+    annotations = preprocess_annotations( annotations, min_size )
     # restrict sample and annotation space to background?
     if intersect_background:
         sample = {key:link for key, link in sample.items( ) if key in background}
@@ -174,20 +249,47 @@ def fisher_enrich( sample,
     link_groups = {}
     for key, link in background.items( ):
         link_groups.setdefault( link, set( ) ).add( key )
+    counts = []
+    for term, members in annotations.items( ):
+        # overlap between members with term and members of sample
+        overlap = [key for key, link in sample.items( ) if link in members]
+        count_term = len( [key for link in members for key in link_groups.get( link, [] )] )
+        counts.append( ( term, len( overlap ), count_term ) )
+    return sample, len( background ), counts
+
+def fisher_enrich( sample,
+                   annotations, 
+                   depletions=True,
+                   background=None,
+                   intersect_background=False,
+                   intersect_annotated=False,
+                   min_fold=None,
+                   min_expected_overlap=None, 
+                   fdr=None, 
+                   verbose=False, ):
+    """
+    Perform fisher-style enrichment over a set of keys, key sets, and optional background
+    """
+    # enable linking
+    if type( sample ) is not dict:
+        sample = {key:key for key in sample}
+    if type( background ) in [list, set]:
+        background = {key:key for key in background}
+    if isinstance( annotations, CompactMultiDict ):
+        sample, count_background, counts = compact_fisher_counts(
+            sample, annotations, background, intersect_background, intersect_annotated, min_expected_overlap )
+    else:
+        sample, count_background, counts = fisher_counts(
+            sample, annotations, background, intersect_background, intersect_annotated, min_expected_overlap )
     # calculate results
     results = []
     counter = 0
-    for term, members in annotations.items( ):
+    for term, count_overlap, count_term in counts:
         counter += 1
         if verbose:
-            progress( counter, annotations )
-        # overlap between members with term and members of sample
-        overlap = [key for key, link in sample.items( ) if link in members]
+            progress( counter, len( counts ) )
         # counts
-        count_overlap         = len( overlap )
-        count_background      = len( background )
         count_sample          = len( sample )
-        count_term            = len( [key for link in members for key in link_groups.get( link, [] )] )
         count_sample_not_term = count_sample - count_overlap
         count_term_not_sample = count_term - count_overlap
         count_remainder       = count_background - count_overlap - count_term_not_sample - count_sample_not_term
@@ -251,26 +353,43 @@ def rank_enrich( quants,
         if not isinstance( value, Link ):
             quants[key] = Link( key, value )
     # remove useless annotations (size < min_overlap)
-    annotations = preprocess_annotations( annotations, min_overlap )
+    compact = isinstance( annotations, CompactMultiDict )
+    if compact:
+        term_of, keep = compact_terms( annotations, min_overlap )
+        annotated = np.zeros( len( annotations.vocab ), dtype=bool )
+        annotated[annotations.members[keep[term_of]]] = True
+        is_annotated = CompactAnnotated( annotations.vocab, annotated )
+    else:
+        annotations = preprocess_annotations( annotations, min_overlap )
+        is_annotated = generate_background( annotations )
     # restrict quants to annotated members?
     if intersect_annotated:
-        is_annotated = generate_background( annotations )
         quants = {key:link for key, link in quants.items( ) if link.key in is_annotated}
     # report
     linking = {key:link.key for key, link in quants.items( )}
-    annotation_report( "Input keys:", linking, annotations )
+    annotation_report( "Input keys:", linking, annotations, is_annotated )
     # arrays for fast compute
     kk = [link.key for link in quants.values( )]
     vv = [link.value for link in quants.values( )]
     vv = np.array( vv )
+    # positions in kk of each term's members
+    def term_indices( ):
+        if compact:
+            ids = compact_ids( annotations.vocab, kk )
+            offsets, members = annotations.offsets, annotations.members
+            for i in np.flatnonzero( keep ):
+                span = members[offsets[i]:offsets[i + 1]]
+                yield decode( annotations.keys_[i] ), np.flatnonzero( np.isin( ids, span ) )
+        else:
+            for term, members in annotations.items( ):
+                yield term, [i for i, k in enumerate( kk ) if k in members]
     # run analysis
     counter = 0
     results = []
-    for term, members in annotations.items( ):
+    for term, index in term_indices( ):
         counter += 1
         if verbose:
-            progress( counter, annotations )
-        index = [i for i, k in enumerate( kk ) if k in members]
+            progress( counter, int( keep.sum( ) ) if compact else len( annotations ) )
         xx = vv[index]
         yy = np.delete( vv, index )
         if len( xx ) == 0:
@@ -1,6 +1,23 @@
 #!/usr/bin/env python
 
-from zopy.utils import say
+import numpy as np
+
+from zopy.utils import say, die, iter_rows, tprint, try_open
+
+# ---------------------------------------------------------------
+# constants
+# ---------------------------------------------------------------
+
+c_methods = ["bh", "by", "storey"]
+c_storey_lambda = 0.5
+# grid for streaming q-values: 0 plus log-spaced edges from 1e-300 to 1;
+# streamed q-values are conservative by at most one grid step ( ~0.07% )
+c_stream_bins = 2**20
+c_stream_chunk = 10**6
+
+# ---------------------------------------------------------------
+# original list-based methods
+# ---------------------------------------------------------------
 
 def steps( n, alpha=0.05 ):
     return [alpha * i / float( n ) for i in range( 1, n+1 )]
@@ -14,40 +31,167 @@ def fdr_cutoff( pvalues, alpha=0.05 ):
             max_step = pvalue
     return max_step
 
-def pvalues2qvalues( pvalues, adjusted=True ):
-    n = len( pvalues )
-    # after sorting, index[i] is the original index of the ith-ranked value
-    index = range( n )
-    index = sorted( index, key=lambda i: pvalues[i] )
-    pvalues = sorted( pvalues )
-    qvalues = [pvalues[i-1] * n / i for i in range( 1, n+1 )]
-    # adjust qvalues to enforce monotonic behavior?
-    # -> q( i ) = min( q( i..n ) )
-    if adjusted:
-        qvalues.reverse( )
-        for i in range( 1, n ):
-            if qvalues[i] > qvalues[i-1]:
-                qvalues[i] = qvalues[i-1]
-        qvalues.reverse( )
-    # rebuild qvalues in the original order
-    ordered_qvalues = [None for q in qvalues]
-    for i, q in enumerate( qvalues ):
-        ordered_qvalues[index[i]] = q
-    return ordered_qvalues
+def pvalues2qvalues( pvalues, adjusted=True, method="bh" ):
+    return qvalues( pvalues, adjusted=adjusted, method=method ).tolist( )
 
-def pdict2qdict( pdict, adjusted=True ):
+def pdict2qdict( pdict, adjusted=True, method="bh" ):
     keys, pvalues = [], []
-    for key, p in pdict.items():
+    for key, p in pdict.items( ):
         keys.append( key )
         pvalues.append( p )
-    qvalues = pvalues2qvalues( pvalues, adjusted=adjusted )
+    qvalues = pvalues2qvalues( pvalues, adjusted=adjusted, method=method )
     return {key:q for key, q in zip( keys, qvalues )}
 
 def fdr( pvalues, **kwargs ):
     if type( pvalues ) is list:
-        return pvalues2values( pvalues, **kwargs )
+        return pvalues2qvalues( pvalues, **kwargs )
+    elif type( pvalues ) is np.ndarray:
+        return qvalues( pvalues, **kwargs )
     elif type( pvalues ) is dict:
         return pdict2qdict( pvalues, **kwargs )
     else:
         say( "Can't FDR non-list, non-dict" )
         return None
+
+# ---------------------------------------------------------------
+# vectorized methods
+# ---------------------------------------------------------------
+
+def storey_pi0( pvalues, lambda_=c_storey_lambda ):
+    """ estimated fraction of true nulls ( storey & tibshirani 2003, fixed lambda ) """
+    n = len( pvalues )
+    if n == 0:
+        return 1.0
+    return min( 1.0, np.count_nonzero( pvalues > lambda_ ) / ( n * ( 1.0 - lambda_ ) ) )
+
+def method_factor( method, n, pi0=None ):
+    """ multiplier applied to p * n / rank for each method """
+    if method == "bh":
+        return 1.0
+    elif method == "by":
+        return np.sum( 1.0 / np.arange( 1, n + 1 ) )
+    elif method == "storey":
+        return pi0
+    else:
+        die( "Unknown FDR method:", method, "(choose from", c_methods, ")" )
+
+def qvalues( pvalues, adjusted=True, method="bh", lambda_=c_storey_lambda ):
+    """
+    q-values for an array of p-values ( bh, by, or storey's pi0-scaled bh )
+    with adjusted, enforce monotonicity: q( i ) = min( q( i..n ) )
+    NaN p-values are left as NaN q-values and not counted in n
+    """
+    pvalues = np.asarray( pvalues, dtype=float )
+    finite = ~np.isnan( pvalues )
+    if not finite.all( ):
+        ret = np.full( len( pvalues ), np.nan )
+        ret[finite] = qvalues( pvalues[finite], adjusted=adjusted, method=method, lambda_=lambda_ )
+        return ret
+    n = len( pvalues )
+    pi0 = storey_pi0( pvalues, lambda_ ) if method == "storey" else None
+    # after sorting, order[i] is the original index of the ith-ranked value
+    order = np.argsort( pvalues, kind="mergesort" )
+    ranked = pvalues[order]
+    ranked *= method_factor( method, n, pi0 ) * n
+    ranked /= np.arange( 1, n + 1 )
+    if adjusted:
+        ranked = np.minimum.accumulate( ranked[::-1] )[::-1]
+        np.minimum( ranked, 1.0, out=ranked )
+    # rebuild qvalues in the original order
+    ret = np.empty( n )
+    ret[order] = ranked
+    return ret
+
+def grouped_qvalues( pvalues, groups, **kwargs ):
+    """ stratified FDR: q-values computed independently within each group """
+    pvalues = np.asarray( pvalues, dtype=float )
+    levels, codes = np.unique( np.asarray( groups ), return_inverse=True )
+    codes = codes.ravel( )
+    order = np.argsort( codes, kind="mergesort" )
+    bounds = np.cumsum( np.bincount( codes, minlength=len( levels ) ) )[:-1]
+    ret = np.empty( len( pvalues ) )
+    for index in np.split( order, bounds ):
+        ret[index] = qvalues( pvalues[index], **kwargs )
+    return ret
+
+# ---------------------------------------------------------------
+# two-pass streaming method ( p-values in a file )
+# ---------------------------------------------------------------
+
+def stream_edges( bins=c_stream_bins ):
+    return np.concatenate( [[0.0], np.logspace( -300, 0, bins )] )
+
+def parse_pvalue( item ):
+    """ float p-value, or nan for NA-style cells """
+    try:
+        return float( item )
+    except ValueError:
+        return np.nan
+
+def valid_pvalues( pvalues ):
+    """ mask of usable p-values ( finite and within [0, 1] ) """
+    with np.errstate( invalid="ignore" ):
+        return np.isfinite( pvalues ) & ( pvalues >= 0 ) & ( pvalues <= 1 )
+
+def iter_pvalue_chunks( path, column, headers, chunk=c_stream_chunk ):
+    """ yield ( rows, pvalues ) chunks from a tabular file; unparseable cells become nan """
+    rows, pvalues = [], []
+    for i, row in enumerate( iter_rows( path ) ):
+        if headers and i == 0:
+            continue
+        rows.append( row )
+        pvalues.append( parse_pvalue( row[column] ) )
+        if len( rows ) >= chunk:
+            yield rows, np.array( pvalues )
+            rows, pvalues = [], []
+    if len( rows ) > 0:
+        yield rows, np.array( pvalues )
+
+def stream_qvalues( path, column=-1, headers=False, output=None,
+                    method="bh", lambda_=c_storey_lambda, bins=c_stream_bins ):
+    """
+    append q-values to the rows of a file too large to hold in memory
+    pass 1 histograms p-values on a fine grid ( and counts p > lambda for storey );
+    pass 2 looks up each p-value's q from the grid's step-up minimum
+    non-finite or out-of-range p-values get q = nan and are not counted in n
+    """
+    edges = stream_edges( bins )
+    counts = np.zeros( len( edges ), dtype=np.int64 )
+    n = above = 0
+    for rows, pvalues in iter_pvalue_chunks( path, column, headers ):
+        pvalues = pvalues[valid_pvalues( pvalues )]
+        counts += np.bincount( np.searchsorted( edges, pvalues, side="left" ), minlength=len( edges ) )
+        n += len( pvalues )
+        above += np.count_nonzero( pvalues > lambda_ )
+    if n == 0:
+        die( "No valid p-values found in", path )
+    pi0 = min( 1.0, above / ( n * ( 1.0 - lambda_ ) ) ) if method == "storey" else None
+    # q at each edge: min over edges >= it of edge * n / #( p <= edge )
+    ranks = np.cumsum( counts )
+    with np.errstate( divide="ignore", invalid="ignore" ):
+        grid = np.where( ranks > 0, edges * method_factor( method, n, pi0 ) * n / ranks, np.inf )
+    grid = np.minimum( np.minimum.accumulate( grid[::-1] )[::-1], 1.0 )
+    fh = try_open( output, "w" ) if output is not None else None
+    if headers:
+        tprint( *( next( iter_rows( path ) ) + ["q_value"] ), file=fh )
+    for rows, pvalues in iter_pvalue_chunks( path, column, headers ):
+        valid = valid_pvalues( pvalues )
+        qs = np.full( len( pvalues ), np.nan )
+        qs[valid] = grid[np.searchsorted( edges, pvalues[valid], side="left" )]
+        for row, q in zip( rows, qs ):
+            tprint( *( row + ["%.6g" % q] ), file=fh )
+    if fh is not None:
+        fh.close( )
+
+# ---------------------------------------------------------------
+# tests
+# ---------------------------------------------------------------
+
+if __name__ == "__main__":
+    q = qvalues( [0.01, np.nan, 0.5, 0.02] )
+    assert np.isnan( q[1] )
+    assert np.allclose( q[[0, 2, 3]], qvalues( [0.01, 0.5, 0.02] ) )
+    assert np.allclose( qvalues( [0.01, 0.5, 0.02] ), [0.03, 0.5, 0.03] )
+    assert valid_pvalues( np.array( [0.5, np.nan, 1.5, -0.1, parse_pvalue( "NA" )] ) ).tolist( ) == \
+        [True, False, False, False, False]
+    print( "ok" )
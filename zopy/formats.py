@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+"""
+Fast numeric-to-text formatting for table output
+================================================
+Values are formatted a block of rows at a time with one precomputed
+format string ( as numpy.savetxt does per row ), so the cost is one string
+operation per block instead of one per cell. The significant-figure policy
+is set by sig: "%.<sig>g" ( zeros print as "0" ), or None for full
+precision ( the shortest repr of the array's own float type ). Integer
+arrays are always written with "%d".
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+# ---------------------------------------------------------------
+# constants
+# ---------------------------------------------------------------
+
+c_sig_figs   = 6
+c_block_rows = 1000
+
+# ---------------------------------------------------------------
+# formatting
+# ---------------------------------------------------------------
+
+def number_format( sig=c_sig_figs, dtype=np.float64 ):
+    """ format for one value of dtype; "%s" means the values are converted with str first """
+    kind = np.dtype( dtype ).kind
+    if kind in "biu":
+        return "%d"
+    elif sig is not None:
+        return "%.{}g".format( int( sig ) )
+    # float64 repr is python's shortest repr; other widths need their own
+    return "%r" if np.dtype( dtype ) == np.float64 else "%s"
+
+def as_numbers( values, sig=c_sig_figs ):
+    """ 2d array of values; integers stay integers ( and float32 stays float32 with sig=None ) """
+    values = np.asarray( values )
+    if values.dtype.kind not in "biuf" or ( values.dtype.kind == "f" and sig is not None ):
+        values = values.astype( float )
+    if values.ndim == 1:
+        values = values[:, None] if values.size > 0 else values.reshape( 0, 0 )
+    if values.dtype.kind == "b":
+        values = values.astype( int )
+    # + 0.0 turns -0.0 into 0.0, so every zero prints as "0"
+    return values + 0.0 if values.dtype.kind == "f" else values
+
+def as_cells( values, fmt ):
+    """ flat tuple of the values to interpolate into fmt """
+    if fmt == "%s":
+        values = values.astype( str )
+    return values.ravel( ).tolist( )
+
+def format_block( values, rowheads=None, sig=c_sig_figs ):
+    """ text for a block of rows ( optionally led by rowheads ), one line per row """
+    values = as_numbers( values, sig )
+    nrows, ncols = values.shape
+    if nrows == 0:
+        return ""
+    fmt = number_format( sig, values.dtype )
+    line = "\t".join( [fmt] * ncols ) + "\n"
+    if rowheads is None:
+        return ( line * nrows ) % tuple( as_cells( values, fmt ) )
+    # interleave the rowheads with the values
+    cells = np.empty( ( nrows, ncols + 1 ), dtype=object )
+    cells[:, 0] = [str( k ) for k in rowheads]
+    if ncols > 0:
+        cells[:, 1:] = np.reshape( as_cells( values, fmt ), ( nrows, ncols ) ).tolist( )
+    return ( ( "%s\t" + line ) * nrows ) % tuple( cells.ravel( ).tolist( ) )
+
+def iter_blocks( values, rowheads=None, sig=c_sig_figs, block=c_block_rows ):
+    """ yield formatted text for successive blocks of rows ( for writers ) """
+    for i in range( 0, len( values ), block ):
+        heads = rowheads[i:i+block] if rowheads is not None else None
+        yield format_block( values[i:i+block], rowheads=heads, sig=sig )
+
+def format_cells( values, sig=c_sig_figs, block=c_block_rows ):
+    """ rows of formatted strings ( e.g. to store back in a list-of-lists table ) """
+    rows = []
+    for text in iter_blocks( values, sig=sig, block=block ):
+        rows += [line.split( "\t" ) for line in text.split( "\n" )[:-1]]
+    return rows
+
+def iter_table_blocks( rowheads, rows, sig=c_sig_figs, block=c_block_rows ):
+    """ as iter_blocks for list-of-lists rows; blocks with non-numeric cells are written with str( ) """
+    for i in range( 0, len( rows ), block ):
+        heads, chunk = rowheads[i:i+block], rows[i:i+block]
+        try:
+            yield format_block( chunk, rowheads=heads, sig=sig )
+        except ( ValueError, TypeError ):
+            yield "".join( "\t".join( map( str, [head] + list( row ) ) ) + "\n"
+                           for head, row in zip( heads, chunk ) )
+
+# ---------------------------------------------------------------
+# tests
+# ---------------------------------------------------------------
+
+if __name__ == "__main__":
+    values = np.array( [[0.0, -0.0, 1.0, 1234567.0], [0.1234567, -2e-9, np.nan, 5.5]] )
+    expected = [["0" if k == 0.0 else "%.6g" % k for k in row] for row in values.tolist( )]
+    assert format_cells( values ) == expected
+    assert format_block( values, rowheads=["a", "b"], sig=None ).split( "\n" )[0] == \
+        "\t".join( ["a"] + [str( k ) for k in [0.0, 0.0, 1.0, 1234567.0]] )
+    assert "".join( iter_blocks( values, ["a", "b"], block=1 ) ) == format_block( values, ["a", "b"] )
+    assert format_block( np.array( [[1, -2]] ), sig=None ) == format_block( [[1, -2]] ) == "1\t-2\n"
+    assert format_block( np.array( [[0.1, -0.0]], dtype=np.float32 ), sig=None ) == "0.1\t0.0\n"
+    print( "ok" )
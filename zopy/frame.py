@@ -3,9 +3,19 @@
 import os
 import sys
 import re
+import csv
 import argparse
 
-from zopy.utils import iter_rows, warn, die
+import numpy as np
+
+from zopy.utils import try_open, warn, die
+from zopy.groupby import factorize
+
+#-------------------------------------------------------------------------------
+# constants
+#-------------------------------------------------------------------------------
+
+c_na_values = {"", "NA", "NaN", "nan", "#N/A"}
 
 #-------------------------------------------------------------------------------
 # helper functions (incomplete)
@@ -40,6 +50,43 @@ def verify_list_of_lists( aa ):
     if bad:
         die( "Can't convert lists to Frame" )
 
+#-------------------------------------------------------------------------------
+# column helpers
+#-------------------------------------------------------------------------------
+
+def column( values ):
+    """ 1d object array holding the values as-is ( np.array would split sequences ) """
+    values = list( values )
+    ret = np.empty( len( values ), dtype=object )
+    ret[:] = values
+    return ret
+
+def infer_column( values ):
+    """ int64 or float64 array if every value parses ( NA -> nan ), else object """
+    try:
+        return np.array( values, dtype=object ).astype( np.int64 )
+    except ( ValueError, TypeError, OverflowError ):
+        pass
+    try:
+        return np.array( [float( k ) if k not in c_na_values else np.nan for k in values] )
+    except ( ValueError, TypeError ):
+        return column( values )
+
+def split_rows( lines, indices ):
+    """
+    yield the fields at indices from each tab-delimited line; lines are split
+    only as far as the last needed field ( csv is used for quoted lines )
+    """
+    last = max( indices ) if len( indices ) > 0 else 0
+    for line in lines:
+        if '"' in line:
+            row = next( csv.reader( [line], csv.excel_tab ) )
+        else:
+            row = line.rstrip( "\r\n" ).split( "\t", last + 1 )
+        if len( row ) <= last:
+            row += [""] * ( last + 1 - len( row ) )
+        yield [row[i] for i in indices]
+
 #-------------------------------------------------------------------------------
 # class start
 #-------------------------------------------------------------------------------
@@ -50,20 +97,28 @@ class Frame:
     # init from file
     #-------------------------------------------------------------------------------
     
-    def __init__( self, source=None, allowed=None ):
+    def __init__( self, source=None, allowed=None, infer=False ):
+        """
+        columns are stored as 1d numpy arrays ( object dtype for strings );
+        with allowed, only those fields are split out of each line; with
+        infer, numeric columns are parsed to int64/float64 on load
+        """
         self.source = source if source is not None else sys.stdin
-        self.data = {}
-        rows = iter_rows( self.source )
-        self.fields = rows.next( )
-        for row in rows:
-            for h, v in zip( self.fields, row ):
-                if allowed is None or h in allowed:
-                    self.data.setdefault( h, [] ).append( v )
-        if allowed is not None:
-            self.fields = [k for k in self.fields if k in allowed]
+        fh = self.source if hasattr( self.source, "read" ) else try_open( self.source )
+        try:
+            headers = next( csv.reader( [next( fh, "" )], csv.excel_tab ), [] )
+            indices = [i for i, h in enumerate( headers ) if allowed is None or h in allowed]
+            self.fields = [headers[i] for i in indices]
+            cells = list( zip( *split_rows( fh, indices ) ) )
+        finally:
+            if fh is not self.source:
+                fh.close( )
         # add robustness to fields-only file
-        for f in self.fields:
-            self.data.setdefault( f, [] )
+        if len( cells ) == 0:
+            cells = [[] for f in self.fields]
+        self.data = {}
+        for f, values in zip( self.fields, cells ):
+            self.data[f] = infer_column( values ) if infer else column( values )
 
     #-------------------------------------------------------------------------------
     # utilities
@@ -74,9 +129,12 @@ class Frame:
             die( "Non-existing field:", field )
         return self.data[field]
 
+    def __len__( self ):
+        return len( self.data[self.fields[0]] ) if len( self.fields ) > 0 else 0
+
     def __repr__( self ):
         nf = len( self.fields )
-        nv = len( self[self.fields[0]] )
+        nv = len( self )
         return "[Frame from <{}> with <{}> fields of length <{}>]".format( self.source, nf, nv )
 
     def check( self, fields ):
@@ -87,17 +145,20 @@ class Frame:
             self[f]
         return fields
 
+    def keys( self, fields ):
+        """ values of one field, or tuples over several fields, as a list """
+        fields = self.check( fields )
+        if len( fields ) == 1:
+            return self[fields[0]].tolist( )
+        return list( zip( *[self[f].tolist( ) for f in fields] ) )
+
     def zip( self, fields ):
-        for items in zip( *[self[f] for f in self.check( fields )] ):
+        for items in zip( *[self[f].tolist( ) for f in self.check( fields )] ):
             yield items
 
     def rowdicts( self ):
-        size = len( self.data[self.fields[0]] )
-        for i in range( size ):
-            d = {}
-            for f in self.fields:
-                d[f] = self.data[f][i]
-            yield d
+        for items in self.zip( self.fields ):
+            yield dict( zip( self.fields, items ) )
             
     #-------------------------------------------------------------------------------
     # map operations
@@ -105,52 +166,67 @@ class Frame:
     
     def map( self, fields, function ):
         for f in self.check( fields ):
-            self.data[f] = map( function, self.data[f] )
+            self.data[f] = column( [function( k ) for k in self.data[f].tolist( )] )
 
     def sub( self, fields, from_str, to_str ):
-        self.map( fields, lambda x: re.sub( from_str, to_str, x ) )
+        pattern = re.compile( from_str )
+        self.map( fields, lambda x: pattern.sub( to_str, x ) )
+
+    def astype( self, fields, dtype ):
+        for f in self.check( fields ):
+            try:
+                self.data[f] = self.data[f].astype( dtype )
+            except ( ValueError, TypeError ) as e:
+                die( "Can't convert field <{}> to {}: {}".format( f, np.dtype( dtype ).name, e ) )
 
     def int( self, fields ):
-        self.map( fields, int )
+        self.astype( fields, np.int64 )
 
     def float( self, fields ):
-        self.map( fields, float )
+        self.astype( fields, np.float64 )
         
     #-------------------------------------------------------------------------------
     # filter operations
     #-------------------------------------------------------------------------------
+
+    def mask( self, mask ):
+        """ keep the rows where mask ( boolean array over rows ) is true """
+        mask = np.asarray( mask, dtype=bool )
+        if len( mask ) != len( self ):
+            die( "Mask of length", len( mask ), "for Frame of length", len( self ) )
+        for f, values in self.data.items( ):
+            self.data[f] = values[mask]
         
     def filter( self, fields, function ):
-        index = [i for i, args in enumerate( zip( *[self[k] for k in self.check( fields )] ) ) \
-                 if function( *args )]
-        for f, values in self.data.items( ):
-            self.data[f] = [values[i] for i in index]
+        fields = self.check( fields )
+        self.mask( np.fromiter( ( function( *args ) for args in self.zip( fields ) ),
+                                dtype=bool, count=len( self ) ) )
             
     def intersect( self, fields, collection ):
-        self.filter( fields, lambda x: x in collection )
+        collection = collection if isinstance( collection, ( set, frozenset, dict ) ) else set( collection )
+        keys = self.keys( fields )
+        self.mask( np.fromiter( ( k in collection for k in keys ), dtype=bool, count=len( keys ) ) )
 
     #-------------------------------------------------------------------------------
     # dict operations
     #-------------------------------------------------------------------------------
         
     def dict( self, key_fields, value_field, append=False ):
-        ret = {}
-        lossy = False
-        # generate keys
         key_fields = self.check( key_fields )
-        if len( key_fields ) == 1:
-            keys = self.data[key_fields[0]]
-        else:
-            keys = [tuple_key for tuple_key in zip( *[self[k] for k in key_fields] )]
-        # populate dictionary
-        for k, v in zip( keys, self[value_field] ):
-            if append:
-                ret.setdefault( k, [] ).append( v )
-            elif k in ret and ret[k] != v:
-                lossy = True
-            else:
-                ret[k] = v
-        if lossy:
+        keys = self.keys( key_fields )
+        values = self[value_field]
+        if append:
+            # group the value column by key code
+            levels, codes = factorize( keys )
+            order = np.argsort( codes, kind="mergesort" )
+            bounds = np.cumsum( np.bincount( codes, minlength=len( levels ) ) )[:-1]
+            groups = np.split( values[order], bounds ) if len( levels ) > 0 else []
+            return {k: v.tolist( ) for k, v in zip( levels, groups )}
+        values = values.tolist( )
+        # the first value seen for each key wins ( in first-seen key order )
+        first = dict( zip( reversed( keys ), reversed( values ) ) )
+        ret = {k: first[k] for k in dict.fromkeys( keys )}
+        if len( set( zip( keys, values ) ) ) > len( ret ):
             warn( "One to many mapping in <{}>: {} --> {}".format(
                 self.source,
                 key_fields,
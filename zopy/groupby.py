@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+"""
+Factorized groupby over the rows of a table
+===========================================
+Group keys are factorized once into integer codes; the common summarizers
+( sum, mean, median, max, min, count ) are then computed for all columns
+at once with sorted segment reductions. Other summarizers ( or non-numeric
+values ) fall back to one call per group x column.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+from zopy.utils import die
+
+# ---------------------------------------------------------------
+# constants
+# ---------------------------------------------------------------
+
+c_reducers = ["sum", "mean", "median", "max", "min", "count"]
+# summarizer functions recognized as a named reducer
+c_known = {
+    sum:       "sum",
+    np.sum:    "sum",
+    np.mean:   "mean",
+    np.median: "median",
+    max:       "max",
+    np.max:    "max",
+    min:       "min",
+    np.min:    "min",
+    len:       "count",
+}
+
+# ---------------------------------------------------------------
+# helpers
+# ---------------------------------------------------------------
+
+def factorize( keys, sort=False ):
+    """ return ( levels, codes ); levels in first-seen ( or sorted ) order """
+    index = {}
+    codes = np.fromiter( ( index.setdefault( k, len( index ) ) for k in keys ),
+                         dtype=np.int64, count=len( keys ) )
+    levels = list( index )
+    if sort:
+        order = sorted( range( len( levels ) ), key=lambda i: levels[i] )
+        rank = np.empty( len( levels ), dtype=np.int64 )
+        rank[order] = np.arange( len( levels ) )
+        levels = [levels[i] for i in order]
+        codes = rank[codes] if len( codes ) > 0 else codes
+    return levels, codes
+
+def reducer_name( summarizer ):
+    if isinstance( summarizer, str ):
+        return summarizer if summarizer in c_reducers else None
+    try:
+        return c_known.get( summarizer )
+    except TypeError:
+        # unhashable callable
+        return None
+
+def as_numeric( rows ):
+    """ 2d numeric array of rows, or None if any value is not a number ( e.g. unconverted strings ) """
+    try:
+        values = np.array( rows )
+    except ValueError:
+        return None
+    return values if values.ndim == 2 and values.dtype.kind in "biuf" else None
+
+# ---------------------------------------------------------------
+# segment reductions
+# ---------------------------------------------------------------
+
+def segment_reduce( values, codes, ngroups, how ):
+    """ reduce the rows of values within each group code; returns ngroups x ncols """
+    counts = np.bincount( codes, minlength=ngroups )
+    if how == "count":
+        return np.repeat( counts[:, None], values.shape[1], axis=1 )
+    order = np.argsort( codes, kind="mergesort" )
+    starts = np.concatenate( [[0], np.cumsum( counts )[:-1]] )
+    ranked = values[order]
+    if how == "sum":
+        return np.add.reduceat( ranked, starts, axis=0 )
+    elif how == "mean":
+        return np.add.reduceat( ranked, starts, axis=0 ) / counts[:, None]
+    elif how == "max":
+        return np.maximum.reduceat( ranked, starts, axis=0 )
+    elif how == "min":
+        return np.minimum.reduceat( ranked, starts, axis=0 )
+    elif how == "median":
+        # sort each column by value, then ( stably ) by group: values end up sorted within groups
+        by_value = np.argsort( values, axis=0, kind="mergesort" )
+        by_group = np.argsort( codes[by_value], axis=0, kind="mergesort" )
+        ranked = np.take_along_axis( values, np.take_along_axis( by_value, by_group, axis=0 ), axis=0 )
+        lo = starts + ( counts - 1 ) // 2
+        hi = starts + counts // 2
+        return ( ranked[lo] + ranked[hi] ) / 2.0
+
+def fallback_reduce( rows, codes, ngroups, summarizer ):
+    """ one summarizer call per group x column ( on a list of that group's values ) """
+    values = np.empty( ( len( rows ), len( rows[0] ) if len( rows ) > 0 else 0 ), dtype=object )
+    values[:] = rows
+    order = np.argsort( codes, kind="mergesort" )
+    bounds = np.cumsum( np.bincount( codes, minlength=ngroups ) )[:-1]
+    return [[summarizer( list( block[:, j] ) ) for j in range( block.shape[1] )]
+            for block in np.split( values[order], bounds )]
+
+# ---------------------------------------------------------------
+# main interface
+# ---------------------------------------------------------------
+
+def groupby_rows( rowheads, rows, grouper, summarizer, sort=False ):
+    """
+    group rows on grouper( rowhead ) and summarize each column within groups
+    summarizer may be a reducer name ( see c_reducers ) or any function of a list
+    returns ( new rowheads, new rows as lists )
+    """
+    levels, codes = factorize( [grouper( r ) for r in rowheads], sort=sort )
+    if len( levels ) == 0:
+        return [], []
+    how = reducer_name( summarizer )
+    values = as_numeric( rows ) if how is not None else None
+    if values is not None:
+        new_rows = segment_reduce( values, codes, len( levels ), how ).tolist( )
+    elif isinstance( summarizer, str ):
+        die( "Reducer", summarizer, "needs numeric values (or choose from", c_reducers, ")" )
+    else:
+        new_rows = fallback_reduce( rows, codes, len( levels ), summarizer )
+    return levels, new_rows
+
+# ---------------------------------------------------------------
+# tests
+# ---------------------------------------------------------------
+
+if __name__ == "__main__":
+    rng = np.random.RandomState( 0 )
+    keys = list( "abcab" * 20 )
+    rows = rng.rand( len( keys ), 4 ).tolist( )
+    for summarizer in [sum, np.mean, np.median, max, min, len]:
+        levels, fast = groupby_rows( keys, rows, lambda k: k, summarizer )
+        levels2, slow = groupby_rows( keys, rows, lambda k: k, lambda x: summarizer( x ) )
+        assert levels == levels2 == ["a", "b", "c"]
+        assert np.allclose( fast, slow ), summarizer
+    levels, joined = groupby_rows( ["x", "y", "x"], [["1"], ["2"], ["3"]], lambda k: k, "|".join )
+    assert joined == [["1|3"], ["2"]]
+    print( "ok" )
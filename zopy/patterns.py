@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+"""
+Match strings against large sets of patterns
+============================================
+Large sets of literal patterns go into one Aho-Corasick automaton ( a
+single pass over each string, regardless of the number of patterns ); a few
+literals are escaped and, with the regex patterns, combined into one
+compiled alternation.
+"""
+
+from __future__ import print_function
+
+import re
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool
+
+# ---------------------------------------------------------------
+# constants
+# ---------------------------------------------------------------
+
+c_regex_chars = set( ".^$*+?{}[]\\|()" )
+# inline global flags, numbered/named backreferences and named groups
+c_unjoinable = re.compile( r"\(\?[aiLmsux]+\)|\\[1-9]|\(\?P[<=]" )
+# rows per task in multi-process mode
+c_chunk = 10000
+# literal patterns beyond which the automaton beats one escaped re alternation
+c_automaton_min = 300
+
+# ---------------------------------------------------------------
+# helpers
+# ---------------------------------------------------------------
+
+def is_literal( pattern ):
+    return not any( k in c_regex_chars for k in pattern )
+
+def load_patterns( path ):
+    """ one pattern per line ( like grep -f ); blank lines are skipped """
+    with open( path ) as fh:
+        return [line.rstrip( "\r\n" ) for line in fh if line.strip( ) != ""]
+
+# ---------------------------------------------------------------
+# aho-corasick automaton
+# ---------------------------------------------------------------
+
+class AhoCorasick:
+
+    """ automaton reporting whether any of a set of literal strings occurs in a text """
+
+    def __init__( self, words ):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [False]
+        for word in words:
+            self.add( word )
+        self.link( )
+
+    def add( self, word ):
+        state = 0
+        for char in word:
+            if char not in self.goto[state]:
+                self.goto.append( {} )
+                self.fail.append( 0 )
+                self.out.append( False )
+                self.goto[state][char] = len( self.goto ) - 1
+            state = self.goto[state][char]
+        self.out[state] = True
+
+    def link( self ):
+        """ breadth-first construction of failure links """
+        queue = deque( self.goto[0].values( ) )
+        while queue:
+            state = queue.popleft( )
+            for char, child in self.goto[state].items( ):
+                queue.append( child )
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get( char, 0 )
+                self.fail[child] = target if target != child else 0
+                self.out[child] = self.out[child] or self.out[self.fail[child]]
+
+    def search( self, text ):
+        if self.out[0]:
+            # the empty word matches everything
+            return True
+        goto, fail, out = self.goto, self.fail, self.out
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get( char, 0 )
+            if out[state]:
+                return True
+        return False
+
+# ---------------------------------------------------------------
+# pattern set
+# ---------------------------------------------------------------
+
+class PatternSet:
+
+    """ test strings against many patterns at once ( exact: whole-string equality ) """
+
+    def __init__( self, patterns, exact=False ):
+        patterns = [patterns] if isinstance( patterns, str ) else list( patterns )
+        self.exact = set( patterns ) if exact else None
+        self.literals = None
+        self.regex = None
+        self.regexes = []
+        if not exact:
+            literals = [p for p in patterns if is_literal( p )]
+            regexes = [p for p in patterns if not is_literal( p )]
+            if len( literals ) >= c_automaton_min:
+                self.literals = AhoCorasick( literals )
+            else:
+                # few literals: re's C matcher is much faster than the python automaton
+                regexes = [re.escape( p ) for p in literals] + regexes
+            if len( regexes ) > 0:
+                # patterns that can't share an alternation ( inline global flags,
+                # backreferences, named groups ) are compiled and tested one by one
+                joinable = [p for p in regexes if not c_unjoinable.search( p )]
+                self.regexes = [re.compile( p ) for p in regexes if c_unjoinable.search( p )]
+                if len( joinable ) > 0:
+                    try:
+                        self.regex = re.compile( "|".join( "(?:%s)" % p for p in joinable ) )
+                    except re.error:
+                        self.regexes += [re.compile( p ) for p in joinable]
+
+    def search( self, text ):
+        """ true if any pattern occurs in text """
+        if self.exact is not None:
+            return text in self.exact
+        if self.literals is not None and self.literals.search( text ):
+            return True
+        if self.regex is not None and self.regex.search( text ) is not None:
+            return True
+        return any( regex.search( text ) is not None for regex in self.regexes )
+
+    def search_row( self, row, column=None ):
+        """ true if any field ( or the given 0-based column ) matches """
+        if column is not None:
+            return column < len( row ) and self.search( row[column] )
+        return any( self.search( field ) for field in row )
+
+# ---------------------------------------------------------------
+# streaming / multi-process matching
+# ---------------------------------------------------------------
+
+c_shared = {}
+
+def share_matcher( matcher, column ):
+    c_shared["matcher"] = matcher
+    c_shared["column"] = column
+
+def match_rows( rows ):
+    matcher, column = c_shared["matcher"], c_shared["column"]
+    return [matcher.search_row( row, column ) for row in rows]
+
+def iter_chunks( items, chunk ):
+    items = iter( items )
+    block = list( islice( items, chunk ) )
+    while block:
+        yield block
+        block = list( islice( items, chunk ) )
+
+def iter_row_matches( rows, matcher, column=None, processes=None, chunk=c_chunk ):
+    """ yield ( row, matched? ) in input order; with processes, chunks are matched in a pool """
+    if processes is None or processes < 2:
+        for row in rows:
+            yield row, matcher.search_row( row, column )
+        return
+    pool = Pool( processes, initializer=share_matcher, initargs=( matcher, column ) )
+    try:
+        # a bounded window of chunks keeps memory flat on long streams
+        window = []
+        for block in iter_chunks( rows, chunk ):
+            window.append( block )
+            if len( window ) >= 2 * processes:
+                for block, results in zip( window, pool.map( match_rows, window ) ):
+                    for row, matched in zip( block, results ):
+                        yield row, matched
+                window = []
+        for block, results in zip( window, pool.map( match_rows, window ) ):
+            for row, matched in zip( block, results ):
+                yield row, matched
+    finally:
+        pool.close( )
+        pool.join( )
+
+# ---------------------------------------------------------------
+# tests
+# ---------------------------------------------------------------
+
+if __name__ == "__main__":
+    words = ["he", "she", "his", "hers", "s__Bacteroides"]
+    ac = AhoCorasick( words )
+    for text in ["ushers", "xyz", "k__Bacteria|s__Bacteroides_ovatus", "hi", "h"]:
+        assert ac.search( text ) == any( w in text for w in words ), text
+    ps = PatternSet( ["^a.c$", "zz", "q"] )
+    assert ps.search( "abc" ) and ps.search( "xzzx" ) and not ps.search( "abcd" )
+    assert PatternSet( ["abc"], exact=True ).search_row( ["x", "abc"] )
+    assert PatternSet( ["(?i)bacteroides", "x.y"] ).search( "s__BACTEROIDES" )
+    many = PatternSet( ["id%05d" % i for i in range( c_automaton_min )] + ["q.z"] )
+    assert many.literals is not None and many.search( "x_id00042_y" ) and many.search( "qaz" )
+    assert not many.search( "id1" )
+    assert PatternSet( ["(a)\\1", "(b)\\1"] ).search( "bb" )
+    assert not PatternSet( ["(a)\\1", "(b)\\1"] ).search( "ab" )
+    rows = [[str( i ), str( i * 7 )] for i in range( 1000 )]
+    serial = [m for r, m in iter_row_matches( rows, ps, column=1 )]
+    parallel = [m for r, m in iter_row_matches( rows, ps, column=1, processes=2, chunk=64 )]
+    assert serial == parallel
+    print( "ok" )
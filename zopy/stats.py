@@ -1,20 +1,36 @@
 #!/usr/bin/env python
 
+from __future__ import print_function
+
 import os
 import sys
 import re
 import glob
 import random
 import math
+import pickle
+from multiprocessing import Pool
 
+import numpy as np
 from numpy import median, mean, std
-from scipy.stats import binom, rankdata, spearmanr, mannwhitneyu
+from scipy.stats import binom, norm, rankdata, spearmanr, pearsonr, mannwhitneyu
 from scipy.stats import fisher_exact as scipy_fisher_exact
 from scipy.stats.mstats import mquantiles
-from collections import Counter
 
 from zopy.utils import warn, die
 
+# ---------------------------------------------------------------
+# constants
+# ---------------------------------------------------------------
+
+# max number of resampled values held in memory at once
+c_max_block = 2**22
+# permutation trials per block ( also the granularity of early stopping )
+c_perm_step = 100
+c_perm_slack = 1e-12
+# draws per vectorized batch in AliasSampler.iter_choice
+c_sample_chunk = 10000
+
 # ---------------------------------------------------------------
 # utilities
 # ---------------------------------------------------------------
@@ -51,7 +67,7 @@ def trunc_spearman ( aX, aY, minlevel=0, clean=True, verbose=True ):
             aY2.append( y )
     if verbose:
         report = "%d ( %.1f%% ) min,min pairs" % ( counter, 100 * counter / float( len( aX ) ) )
-        print >>sys.stderr, "spearman with", report, "excluded" if clean else "included ( WARNING! )"
+        print( "spearman with", report, "excluded" if clean else "included ( WARNING! )", file=sys.stderr )
     return spearmanr( aX2, aY2 )
 
 def safe_spearman ( aX, aY, critical_dup_level=1.1 ):
@@ -62,9 +78,9 @@ def safe_spearman ( aX, aY, critical_dup_level=1.1 ):
         if not is_homogeneous( aX ) and not is_homogeneous( aY ):
             r, p = trunc_spearman( aX, aY )
         else:
-            print >>sys.stderr, "trivial spearman (one or more homogeneous rows)"
+            print( "trivial spearman (one or more homogeneous rows)", file=sys.stderr )
     else:
-        print >>sys.stderr, "trivial spearman (one or more tiny rows)"
+        print( "trivial spearman (one or more tiny rows)", file=sys.stderr )
     return r, p
 
 def fisher_exact ( focus_and_feature, focus_total, feature_total, total_total ):
@@ -120,6 +136,47 @@ def find_outliers ( dictValues, fence="inner" ):
             dictOutliers[k] = v
     return dictOutliers
 
+# ---------------------------------------------------------------
+# batched ( row-wise ) statistics
+# ---------------------------------------------------------------
+
+def spearman_r ( aX, aY ):
+    """ spearman correlation coefficient without the pvalue """
+    return spearmanr( aX, aY )[0]
+
+def pearson_r ( aX, aY ):
+    """ pearson correlation coefficient without the pvalue """
+    return pearsonr( aX, aY )[0]
+
+def rowwise_ranks ( aaValues ):
+    """ rank transform each row of a 2d array ( base-1 ); average tied ranks """
+    return rankdata( aaValues, axis=1 )
+
+def rowwise_pearson ( aaX, aaY ):
+    """ pearson correlation of matched rows of two 2d arrays; nan for constant rows """
+    aaX = aaX - aaX.mean( axis=1 )[:, None]
+    aaY = aaY - aaY.mean( axis=1 )[:, None]
+    numerator = ( aaX * aaY ).sum( axis=1 )
+    denominator = np.sqrt( ( aaX**2 ).sum( axis=1 ) * ( aaY**2 ).sum( axis=1 ) )
+    with np.errstate( divide="ignore", invalid="ignore" ):
+        return numerator / denominator
+
+def rowwise_spearman ( aaX, aaY ):
+    """ spearman correlation of matched rows of two 2d arrays; nan for constant rows """
+    return rowwise_pearson( rowwise_ranks( aaX ), rowwise_ranks( aaY ) )
+
+# one- and two-sample funcs with equivalent whole-matrix ( axis=1 ) versions
+c_rowwise_stats = {
+    mean:   lambda aa: aa.mean( axis=1 ),
+    median: lambda aa: np.median( aa, axis=1 ),
+    std:    lambda aa: aa.std( axis=1 ),
+}
+
+c_rowwise_stats2 = {
+    spearman_r: rowwise_spearman,
+    pearson_r:  rowwise_pearson,
+}
+
 # ---------------------------------------------------------------
 # bootstrap methods
 # ---------------------------------------------------------------
@@ -141,29 +198,102 @@ def funcInterval ( aValues, interval ):
     delta = ( 1 - interval ) / 2.0
     return list( mquantiles( aValues, [delta, 1 - delta] ) )
 
-def boot ( aValues, func=mean, trials=1e3, interval=0.95, stderr=False ):
-    """ estimate the ci/standard error of a measure by bootstrapping """
+def resample_index ( n, trials, rng ):
+    """ yield blocks of bootstrap positions; each row of a block is one trial """
+    per_block = max( 1, c_max_block // max( n, 1 ) )
+    done = 0
+    while done < trials:
+        size = min( per_block, trials - done )
+        yield rng.randint( 0, n, size=( size, n ) )
+        done += size
+
+def jackknife_index ( n ):
+    """ yield blocks of leave-one-out positions; row i of the full matrix omits position i """
+    per_block = max( 1, c_max_block // max( n, 1 ) )
+    for start in range( 0, n, per_block ):
+        omit = np.arange( start, min( n, start + per_block ) )
+        keep = np.ones( ( len( omit ), n ), dtype=bool )
+        keep[np.arange( len( omit ) ), omit] = False
+        yield np.nonzero( keep )[1].reshape( len( omit ), n - 1 )
+
+def call_packed ( packed ):
+    """ module-level ( picklable ) caller for process pools """
+    func, args = packed
+    return func( *args )
+
+def evaluate_blocks ( func, arrays, blocks, processes=None, as_list=False ):
+    """ evaluate func on the arrays as indexed by each row of each block; returns 1d array """
+    rowwise = ( c_rowwise_stats if len( arrays ) == 1 else c_rowwise_stats2 ).get( func )
+    pool = None
+    if rowwise is None and processes is not None and processes > 1:
+        try:
+            pickle.dumps( func )
+            pool = Pool( processes )
+        except Exception:
+            warn( "can't send", func, "to worker processes; evaluating serially" )
     aResults = []
-    for i in range( int( trials ) ):
-        aTemp = funcResample( aValues )
-        aResults.append( func( aTemp ) )
+    for index in blocks:
+        if rowwise is not None:
+            aResults.append( rowwise( *[a[index] for a in arrays] ) )
+        else:
+            tasks = [( func, [a[row].tolist( ) if as_list else a[row] for a in arrays] ) for row in index]
+            values = pool.map( call_packed, tasks ) if pool is not None else map( call_packed, tasks )
+            aResults.append( np.array( list( values ), dtype=float ) )
+    if pool is not None:
+        pool.close( )
+        pool.join( )
+    return np.concatenate( aResults )
+
+def bca_interval ( aResults, actual, aJackknife, interval ):
+    """ bias-corrected and accelerated ci endpoints ( Efron 1987 ) """
+    delta = ( 1 - interval ) / 2.0
+    z0 = norm.ppf( np.mean( aResults < actual ) )
+    deviations = np.mean( aJackknife ) - aJackknife
+    denominator = 6.0 * np.sum( deviations**2 )**1.5
+    accel = np.sum( deviations**3 ) / denominator if denominator > 0 else 0.0
+    z = norm.ppf( [delta, 1 - delta] )
+    levels = norm.cdf( z0 + ( z0 + z ) / ( 1 - accel * ( z0 + z ) ) )
+    if not np.all( np.isfinite( levels ) ):
+        warn( "BCa correction undefined ( degenerate bootstraps ); using percentile interval" )
+        levels = [delta, 1 - delta]
+    return list( mquantiles( aResults, levels ) )
+
+def run_boot ( func, samples, trials, interval, stderr, method, seed, processes ):
+    """ shared engine for boot and boot2; samples are resampled with shared positions """
+    as_list = not isinstance( samples[0], np.ndarray )
+    arrays = [np.asarray( k ) for k in samples]
+    n = len( arrays[0] )
+    rng = np.random.RandomState( seed )
+    aResults = evaluate_blocks( func, arrays, resample_index( n, int( trials ), rng ),
+                                processes=processes, as_list=as_list )
     # test for consistency
-    actual, bootmean = func( aValues ), mean( aResults )
+    actual, bootmean = func( *samples ), mean( aResults )
     if abs( actual - bootmean ) / float( actual ) > 0.05:
-        print >>sys.stderr, "WARNING: bootstraps not comparable, actual=", actual, "bootmean=", bootmean
-    return std( aResults ) if stderr else funcInterval( aResults, interval )
+        print( "WARNING: bootstraps not comparable, actual=", actual, "bootmean=", bootmean, file=sys.stderr )
+    if stderr:
+        return std( aResults )
+    elif method == "percentile":
+        return funcInterval( aResults, interval )
+    elif method == "bca":
+        aJackknife = evaluate_blocks( func, arrays, jackknife_index( n ),
+                                      processes=processes, as_list=as_list )
+        return bca_interval( aResults, actual, aJackknife, interval )
+    else:
+        die( "unknown bootstrap interval method:", method )
 
-def boot2 ( aValues1, aValues2, func=lambda x, y: spearmanr( x, y )[0], interval=0.95, trials=1e3, stderr=False ):
-    """ estimate the ci/standard error of a coupling measure by bootstrapping """
-    aResults = []
-    for i in range( int( trials ) ):
-        aTemp1, aTemp2 = funcResample2( aValues1, aValues2 )
-        aResults.append( func( aTemp1, aTemp2 ) )
-    # test for consistency
-    actual, bootmean = func( aValues1, aValues2 ), mean( aResults )
-    if abs( actual - bootmean ) / float( actual ) > 0.05:
-        print >>sys.stderr, "WARNING: bootstraps not comparable, actual=", actual, "bootmean=", bootmean
-    return std( aResults ) if stderr else funcInterval( aResults, interval )
+def boot ( aValues, func=mean, trials=1e3, interval=0.95, stderr=False,
+           method="percentile", seed=None, processes=None ):
+    """
+    estimate the ci/standard error of a measure by bootstrapping
+    funcs in c_rowwise_stats are evaluated on all trials at once; others once per
+    trial ( across a process pool if processes > 1 ); method may be "percentile" or "bca"
+    """
+    return run_boot( func, [aValues], trials, interval, stderr, method, seed, processes )
+
+def boot2 ( aValues1, aValues2, func=spearman_r, interval=0.95, trials=1e3, stderr=False,
+            method="percentile", seed=None, processes=None ):
+    """ estimate the ci/standard error of a coupling measure by bootstrapping ( see boot ) """
+    return run_boot( func, [aValues1, aValues2], trials, interval, stderr, method, seed, processes )
 
 # ---------------------------------------------------------------
 # permutation methods
@@ -173,84 +303,185 @@ def funcPerror ( p, trials ):
     """ estimates the stderr of pvalue by treating as a proportion of trials """
     return math.sqrt( p * ( 1 - p ) / float( trials ) )
 
-def perm_membership ( aX, aY, func=mean, trials=1e3 ):
-    """ permutation-style test for difference between two groups """
-    extremes = 0
-    diff_actual = func( aX ) - func( aY )
-    aZ = aX + aY
-    for i in range( int( trials ) ):
-        random.shuffle( aZ )
-        aXrand = aZ[0:len( aX )]
-        aYrand = aZ[len( aX ):]
-        diff_random = func( aXrand ) - func( aYrand )
-        if abs( diff_random ) >= abs( diff_actual ):
-            extremes += 1
-    # note: treating the actual value as observation; prevents p=0
-    if extremes == 0: print >>sys.stderr, "never observed more extreme in", trials, "trials"
-    pvalue = ( 1 + extremes ) / float( trials )
-    return pvalue #, funcPerror( pvalue, trials )
-
-def perm_coupling ( aX, aY, func=lambda x, y: spearmanr( x, y )[0], trials=1e3 ):
-    """ permutation-style test for coupling between two vectors """
-    aYcopy = aY[:]
-    coupling_actual = func( aX, aYcopy )
-    extremes = 0
-    for i in range( int( trials ) ):
-        random.shuffle( aYcopy )
-        coupling_random = func( aX, aYcopy )
-        if abs( coupling_random ) >= abs( coupling_actual ):
-            extremes += 1
+def permute_index ( n, trials, rng ):
+    """ yield blocks of random permutations of range( n ); each row is one trial """
+    per_block = max( 1, min( c_perm_step, c_max_block // max( n, 1 ) ) )
+    done = 0
+    while done < trials:
+        size = min( per_block, trials - done )
+        yield rng.rand( size, n ).argsort( axis=1 )
+        done += size
+
+def perm_pvalue ( actual, null_blocks, trials, tolerance=None ):
+    """
+    pvalue from blocks of null statistics; optionally stop once funcPerror < tolerance
+    without early stopping, the blocks must supply exactly trials null values
+    """
+    # relative slack so float noise in batched stats doesn't hide exact ties
+    threshold = abs( actual ) * ( 1 - c_perm_slack )
+    extremes = done = 0
+    stopped = False
+    for aNull in null_blocks:
+        extremes += int( np.sum( np.abs( aNull ) >= threshold ) )
+        done += len( aNull )
+        # clamped: p can exceed 1 when every trial so far is at least as extreme
+        if tolerance is not None and funcPerror( min( 1.0, ( 1 + extremes ) / float( done ) ), done ) < tolerance:
+            stopped = True
+            break
+    if not stopped and done != int( trials ):
+        print( "null blocks supplied", done, "of", int( trials ), "requested trials", file=sys.stderr )
+    if done == 0:
+        return 1.0
     # note: treating the actual value as observation; prevents p=0
-    if extremes == 0: print >>sys.stderr, "never observed more extreme in", trials, "trials"
-    pvalue = ( 1 + extremes ) / float( trials )
-    return pvalue #, funcPerror( pvalue, trials )
+    if extremes == 0: print( "never observed more extreme in", done, "trials", file=sys.stderr )
+    pvalue = min( 1.0, ( 1 + extremes ) / float( done ) )
+    return pvalue #, funcPerror( pvalue, done )
+
+def perm_membership ( aX, aY, func=mean, trials=1e3, tolerance=None, seed=None ):
+    """
+    permutation-style test for difference between two groups
+    funcs in c_rowwise_stats are evaluated on blocks of permutations at once;
+    with tolerance, stops early once the pvalue's stderr drops below it
+    """
+    diff_actual = func( aX ) - func( aY )
+    nx = len( aX )
+    aZ = np.concatenate( [np.asarray( aX ), np.asarray( aY )] )
+    rowwise = c_rowwise_stats.get( func )
+    def null_blocks( ):
+        rng = np.random.RandomState( seed )
+        for index in permute_index( len( aZ ), int( trials ), rng ):
+            if rowwise is not None:
+                yield rowwise( aZ[index[:, 0:nx]] ) - rowwise( aZ[index[:, nx:]] )
+            else:
+                yield np.array( [func( list( aZ[row[0:nx]] ) ) - func( list( aZ[row[nx:]] ) )
+                                 for row in index], dtype=float )
+    return perm_pvalue( diff_actual, null_blocks( ), trials, tolerance=tolerance )
+
+def perm_coupling ( aX, aY, func=spearman_r, trials=1e3, tolerance=None, seed=None ):
+    """
+    permutation-style test for coupling between two vectors
+    spearman_r/pearson_r are computed for blocks of permutations as one matrix
+    product on pre-ranked ( spearman ), standardized data; see perm_membership
+    """
+    coupling_actual = func( aX, aY )
+    aYarray = np.asarray( aY )
+    if func in c_rowwise_stats2:
+        # correlation of unit-norm centered vectors is their dot product
+        def unit( a ):
+            a = rankdata( a ) if func is spearman_r else np.asarray( a, dtype=float )
+            a = a - a.mean( )
+            with np.errstate( divide="ignore", invalid="ignore" ):
+                return a / np.sqrt( np.sum( a**2 ) )
+        aXunit, aYunit = unit( aX ), unit( aY )
+    def null_blocks( ):
+        rng = np.random.RandomState( seed )
+        for index in permute_index( len( aYarray ), int( trials ), rng ):
+            if func in c_rowwise_stats2:
+                yield aYunit[index].dot( aXunit )
+            else:
+                yield np.array( [func( aX, list( aYarray[row] ) ) for row in index], dtype=float )
+    return perm_pvalue( coupling_actual, null_blocks( ), trials, tolerance=tolerance )
 
 # ---------------------------------------------------------------
 # information theory
 # ---------------------------------------------------------------
 
+def encode ( aX ):
+    """ encode an event vector as small ints ( 0..levels-1 ); returns codes, levels """
+    if isinstance( aX, np.ndarray ) and aX.ndim == 1 and aX.dtype.kind in "biuf":
+        levels, codes = np.unique( aX, return_inverse=True )
+        return codes.ravel( ), len( levels )
+    # any hashable events ( tuples, None, mixed types ) each stay one value
+    index = {}
+    codes = np.fromiter( ( index.setdefault( x, len( index ) ) for x in aX ), dtype=np.int64 )
+    return codes, len( index )
+
+def entropy_of_counts ( aaCounts ):
+    """ shannon entropy ( bits ) of each row of a 2d array of counts """
+    aaProbs = aaCounts / aaCounts.sum( axis=1 ).astype( float )[:, None]
+    with np.errstate( divide="ignore", invalid="ignore" ):
+        aaTerms = np.where( aaProbs > 0, aaProbs * np.log2( aaProbs ), 0.0 )
+    return -aaTerms.sum( axis=1 )
+
 def shannon ( aX ):
     """ computes the shannon entropy for an event vector """
-    pX = Counter()
-    for x in aX:
-        pX[x] += 1
-    total = float( sum( pX.values() ) )
-    result = 0
-    for x, count in pX.items():
-        prob = count / total
-        result += -1 * prob * math.log( prob ) / math.log( 2 )
-    return result
+    codes, levels = encode( aX )
+    return entropy_of_counts( np.bincount( codes, minlength=levels )[None, :] )[0]
 
-def sqrt_bin ( a ):
+def sqrt_bin_codes ( a ):
+    """ index of each value's bin; ~sqrt( n ) bins with equal counts """
+    a = np.asarray( a )
     n = len( a )
     b = int( math.sqrt( n ) )
-    a2 = sorted( a )
-    bins = [a2[int( n * k / float( b ) ) - 1] for k in range( 1, b+1 )]
-    a3 = []
-    for i, x in enumerate( a ):
-        for b in bins:
-            if x <= b:
-                a3.append( b )
-                break
-    return a3
+    a2 = np.sort( a )
+    bins = a2[[int( n * k / float( b ) ) - 1 for k in range( 1, b+1 )]]
+    # first bin whose upper edge is >= x
+    return np.searchsorted( bins, a, side="left" ), bins
+
+def sqrt_bin ( a ):
+    codes, bins = sqrt_bin_codes( a )
+    return bins[codes].tolist( )
 
 def mutinfo ( aX, aY, normalized=False ):
     """ computes the mutual information for a pair of event vectors """
-    pX = Counter()
-    pY = Counter()
-    pJoint = Counter()
-    for x, y in zip( aX, aY ):
-        pX[x] += 1
-        pY[y] += 1
-        pJoint[( x, y )] += 1
-    for d in [pX, pY, pJoint]:
-        total = float( sum( d.values() ) )
-        for k in d:
-            d[k] /= total
-    result = 0
-    for ( x, y ), joint in pJoint.items():
-        result += joint * math.log( joint / pX[x] / pY[y] ) / math.log( 2 )
-    return result if not normalized else result / min( shannon( aX ), shannon( aY ) )
+    cx, kx = encode( aX )
+    cy, ky = encode( aY )
+    hx = entropy_of_counts( np.bincount( cx, minlength=kx )[None, :] )[0]
+    hy = entropy_of_counts( np.bincount( cy, minlength=ky )[None, :] )[0]
+    hxy = entropy_of_counts( np.bincount( cx * ky + cy, minlength=kx * ky )[None, :] )[0]
+    result = hx + hy - hxy
+    return result if not normalized else result / min( hx, hy )
+
+# shared with pool workers ( set once per process by share_codes )
+c_shared = {}
+
+def share_codes ( aaCodes, levels ):
+    c_shared["codes"] = aaCodes
+    c_shared["levels"] = levels
+
+def joint_entropy_rows ( rows ):
+    """ joint entropy of each feature in rows vs. every feature; uses c_shared codes """
+    aaCodes, levels = c_shared["codes"], c_shared["levels"]
+    nfeatures = len( aaCodes )
+    per_chunk = max( 1, c_max_block // ( levels * levels ) )
+    aaResult = np.empty( ( len( rows ), nfeatures ) )
+    for r, i in enumerate( rows ):
+        aXcoded = aaCodes[i] * levels
+        for j0 in range( 0, nfeatures, per_chunk ):
+            aaY = aaCodes[j0:j0+per_chunk]
+            # offset each pair's combined codes into its own bincount segment
+            offsets = np.arange( len( aaY ) )[:, None] * levels * levels
+            counts = np.bincount( ( offsets + aXcoded + aaY ).ravel( ),
+                                  minlength=len( aaY ) * levels * levels )
+            aaResult[r, j0:j0+len( aaY )] = entropy_of_counts( counts.reshape( len( aaY ), -1 ) )
+    return aaResult
+
+def mutinfo_matrix ( aaData, normalized=True, discretize=True, processes=None, block=64 ):
+    """
+    all-pairs ( normalized ) mutual information between the rows of a 2d array
+    rows are discretized once by sqrt_bin ( or treated as events if not discretize ),
+    encoded as ints, and joint histograms built by bincount on combined codes;
+    blocks of rows are farmed out to a process pool if processes > 1
+    """
+    encoder = ( lambda row: sqrt_bin_codes( row )[0] ) if discretize else ( lambda row: encode( row )[0] )
+    aaCodes = np.array( [encoder( row ) for row in aaData], dtype=np.int64 )
+    levels = int( aaCodes.max( ) ) + 1 if aaCodes.size > 0 else 1
+    nfeatures = len( aaCodes )
+    aEntropy = entropy_of_counts( np.array( [np.bincount( row, minlength=levels ) for row in aaCodes] ) )
+    blocks = [list( range( i, min( nfeatures, i + block ) ) ) for i in range( 0, nfeatures, block )]
+    if processes is not None and processes > 1:
+        pool = Pool( processes, initializer=share_codes, initargs=( aaCodes, levels ) )
+        aaJoint = np.vstack( pool.map( joint_entropy_rows, blocks ) )
+        pool.close( )
+        pool.join( )
+    else:
+        share_codes( aaCodes, levels )
+        aaJoint = np.vstack( [joint_entropy_rows( rows ) for rows in blocks] )
+    aaResult = aEntropy[:, None] + aEntropy[None, :] - aaJoint
+    if normalized:
+        with np.errstate( divide="ignore", invalid="ignore" ):
+            aaResult = aaResult / np.minimum( aEntropy[:, None], aEntropy[None, :] )
+    return aaResult
 
 # ---------------------------------------------------------------
 # binomial error model (inspired by metaphlan soft coreness)
@@ -268,42 +499,88 @@ def binomial_error( errors, trials, error_rate ):
 # class for aiding in weighted random choice
 # ---------------------------------------------------------------
 
-class WeightedChooser( ):
-    def __init__( self, weights ):
-        self.intervals = []
-        total = float( sum( weights.values() ) )
-        last = 0
-        for item in sorted( weights, key=lambda x: weights[x], reverse=True ):
-            delta = weights[item] / total
-            self.intervals.append( (item, last, last + delta) )
-            last += delta
+class AliasSampler( ):
+
+    """
+    weighted random choice via a walker/vose alias table
+    O( k ) setup from a [item]=weight dict; O( 1 ) per draw
+    """
+
+    def __init__( self, weights, seed=None ):
+        self.items = list( weights )
+        k = len( self.items )
+        total = float( sum( weights.values( ) ) )
+        if k == 0 or total <= 0:
+            die( "can't sample from empty or all-zero weights" )
+        scaled = [weights[item] * k / total for item in self.items]
+        self.prob = [1.0 for i in range( k )]
+        self.alias = list( range( k ) )
+        small = [i for i, p in enumerate( scaled ) if p < 1]
+        large = [i for i, p in enumerate( scaled ) if p >= 1]
+        while small and large:
+            s, l = small.pop( ), large.pop( )
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] += scaled[s] - 1
+            ( small if scaled[l] < 1 else large ).append( l )
+        # leftovers differ from 1 only by rounding; they keep prob 1
+        self.k = k
+        self.seed = seed
+        self.random = random.Random( seed ) if seed is not None else random
+        # numpy state is built on the first batch draw: many samplers ( e.g. one
+        # per read in protein_reads ) only ever use choice( )
+        self.rng = None
+
+    def arrays( self ):
+        self.rng = np.random.RandomState( self.seed )
+        self.aprob = np.array( self.prob )
+        self.aalias = np.array( self.alias )
+        try:
+            self.values = np.array( self.items )
+        except ValueError:
+            self.values = None
+        if self.values is None or self.values.ndim != 1:
+            # e.g. tuple items; keep them whole
+            self.values = np.empty( self.k, dtype=object )
+            self.values[:] = self.items
+
     def choice( self ):
-        i = 0
-        step = len( self.intervals )
-        r = random.random()
-        while not ( self.intervals[i][1] <= r <= self.intervals[i][2] ):
-            step = max( 1, step / 2 )
-            if r > self.intervals[i][1]:
-                i += step
-            else:
-                i -= step
-        return self.intervals[i][0]
-    def iter_choice( self, n ):
-        for i in range( n ):
-            yield self.choice( )
+        i = int( self.random.random( ) * self.k )
+        return self.items[i if self.random.random( ) < self.prob[i] else self.alias[i]]
+
+    def sample_index( self, n ):
+        """ n draws at once as positions in self.items """
+        if self.rng is None:
+            self.arrays( )
+        index = self.rng.randint( 0, self.k, size=int( n ) )
+        coins = self.rng.random_sample( int( n ) )
+        return np.where( coins < self.aprob[index], index, self.aalias[index] )
+
+    def sample( self, n ):
+        """ n draws at once as a numpy array of items """
+        index = self.sample_index( n )
+        return self.values[index]
+
+    def iter_choice( self, n, chunk=c_sample_chunk ):
+        n = int( n )
+        while n > 0:
+            for i in self.sample_index( min( n, chunk ) ):
+                yield self.items[i]
+            n -= chunk
+
+class WeightedChooser( AliasSampler ):
+    """ original name for AliasSampler ( was a per-draw interval search ) """
+    pass
 
 #-------------------------------------------------------------------------------
 # roc analysis
 #-------------------------------------------------------------------------------
 
 def calc_auc( tprs, fprs ):
-    auc = 0
-    n = len( tprs )   
-    for i in range( n - 1 ):
-        height = ( tprs[i] + tprs[i+1] ) / 2.0
-        width = fprs[i+1] - fprs[i]
-        auc += height * width
-    return auc
+    """ trapezoid area under the curve; fprs ( x-axis ) in increasing order """
+    tprs = np.asarray( tprs, dtype=float )
+    fprs = np.asarray( fprs, dtype=float )
+    return float( np.sum( ( tprs[1:] + tprs[:-1] ) / 2.0 * np.diff( fprs ) ) )
 
 def curve_check( labels, scores ):
     if not set( labels ) <= set( [0, 1] ):
@@ -311,57 +588,85 @@ def curve_check( labels, scores ):
     if not len( labels ) == len( scores ):
         die( "labels and scores have non-equal lengths" )
     return None
-        
+
+def curve_counts( labels, scores ):
+    """ cumulative tp/fp counts at each unique score; most stringent first """
+    labels = np.asarray( labels )
+    scores = np.asarray( scores )
+    order = np.argsort( scores, kind="mergesort" )[::-1]
+    scores = scores[order]
+    tp = np.cumsum( labels[order] )
+    fp = np.arange( 1, len( labels ) + 1 ) - tp
+    # tied scores are called together: keep only the end of each tie group
+    last = np.append( scores[1:] != scores[:-1], True )
+    return tp[last], fp[last]
+
 def roc_curve( labels, scores ):
     curve_check( labels, scores )
-    # track unique scores and associated pos/neg cases
-    sdict = {}
-    for l, s in zip( labels, scores ):
-        sdict.setdefault( s, [] ).append( l )
+    tp, fp = curve_counts( labels, scores )
     ptot = float( sum( labels ) )
     ntot = len( labels ) - ptot
-    tp = 0
-    fp = 0
-    tprs = []
-    fprs = []
-    # work backward through unique scores; most stringent first
-    for s in sorted( sdict, reverse=True ):
-        calls = sdict[s]
-        tp += sum( calls )
-        fp += len( calls ) - sum( calls )
-        tprs.append( tp / ptot )
-        fprs.append( fp / ntot )
     # attach extremes (make no calls / all calls positive)
-    tprs = [0] + tprs + [1]
-    fprs = [0] + fprs + [1]
+    tprs = [0] + ( tp / ptot ).tolist( ) + [1]
+    fprs = [0] + ( fp / ntot ).tolist( ) + [1]
     # return with auc value
     return tprs, fprs, calc_auc( tprs, fprs )
 
 def pr_curve( labels, scores ):
     curve_check( labels, scores )
-    # track unique scores and associated pos/neg cases
-    sdict = {}
-    for l, s in zip( labels, scores ):
-        sdict.setdefault( s, [] ).append( l )
+    tp, fp = curve_counts( labels, scores )
     ptot = float( sum( labels ) )
-    tp = 0
-    fp = 0
     # tpr = recall / ppv = precision
-    tprs = []
-    ppvs = []
-    # work backward through unique scores; most stringent first
-    for s in sorted( sdict, reverse=True ):
-        calls = sdict[s]
-        tp += sum( calls )
-        fp += len( calls ) - sum( calls )
-        tprs.append( tp / ptot )
-        ppvs.append( tp / float( tp + fp ) )
     # attach extremes (make no calls / all calls positive)
-    tprs = [0] + tprs + [1]
-    ppvs = [1] + ppvs + [ptot / float( len( labels ) )]
+    tprs = [0] + ( tp / ptot ).tolist( ) + [1]
+    ppvs = [1] + ( tp / ( tp + fp ).astype( float ) ).tolist( ) + [ptot / float( len( labels ) )]
     # return with auc value
     return ppvs, tprs, calc_auc( ppvs, tprs )
-    
+
+def batch_counts( labels, aaScores ):
+    """
+    cumulative tp/fp counts for each row of scores vs. one labels vector
+    rows keep all n positions; positions inside a tie group repeat the
+    group-end counts, so they add zero-width ( no-op ) curve segments
+    """
+    labels = np.asarray( labels )
+    aaScores = np.atleast_2d( aaScores )
+    nrows, n = aaScores.shape
+    order = np.argsort( aaScores, axis=1, kind="mergesort" )[:, ::-1]
+    aaSorted = np.take_along_axis( aaScores, order, axis=1 )
+    tp = np.cumsum( labels[order], axis=1 )
+    fp = np.arange( 1, n + 1 )[None, :] - tp
+    # index of each position's tie-group end: reverse running min over group ends
+    last = np.hstack( [aaSorted[:, 1:] != aaSorted[:, :-1], np.ones( ( nrows, 1 ), dtype=bool )] )
+    ends = np.where( last, np.arange( n )[None, :], n )
+    ends = np.minimum.accumulate( ends[:, ::-1], axis=1 )[:, ::-1]
+    return np.take_along_axis( tp, ends, axis=1 ), np.take_along_axis( fp, ends, axis=1 )
+
+def batch_auc( aaHeights, aaWidths ):
+    """ row-wise trapezoid areas """
+    return np.sum( ( aaHeights[:, 1:] + aaHeights[:, :-1] ) / 2.0 * np.diff( aaWidths, axis=1 ), axis=1 )
+
+def roc_aucs( labels, aaScores ):
+    """ roc auc of each row of scores vs. one labels vector ( ties as in roc_curve ) """
+    curve_check( labels, aaScores[0] )
+    tp, fp = batch_counts( labels, aaScores )
+    ptot = float( sum( labels ) )
+    ntot = len( labels ) - ptot
+    zeros, ones = np.zeros( ( len( tp ), 1 ) ), np.ones( ( len( tp ), 1 ) )
+    tprs = np.hstack( [zeros, tp / ptot, ones] )
+    fprs = np.hstack( [zeros, fp / ntot, ones] )
+    return batch_auc( tprs, fprs )
+
+def pr_aucs( labels, aaScores ):
+    """ pr auc of each row of scores vs. one labels vector ( ties as in pr_curve ) """
+    curve_check( labels, aaScores[0] )
+    tp, fp = batch_counts( labels, aaScores )
+    ptot = float( sum( labels ) )
+    zeros, ones = np.zeros( ( len( tp ), 1 ) ), np.ones( ( len( tp ), 1 ) )
+    tprs = np.hstack( [zeros, tp / ptot, ones] )
+    ppvs = np.hstack( [ones, tp / ( tp + fp ).astype( float ), ones * ptot / len( labels )] )
+    return batch_auc( ppvs, tprs )
+
 # ---------------------------------------------------------------
 # testing
 # ---------------------------------------------------------------
@@ -370,12 +675,14 @@ if __name__ == "__main__":
     # perm/boot tests
     x = [random.random() for k in range( 100 )]
     y = [random.random() + 0.1 * x[i] for i in range( len( x ) )]
-    print "mean x, mean y, spearman( x,y )", mean( x ), mean( y ), spearmanr( x, y )[0]
-    print "boot x CI95", boot( x )
-    print "boot x SErr", boot( x, stderr=True )
-    print "boot xy corr CI95", boot2( x, y )
-    print "boot xy corr SErr", boot2( x, y, stderr=True )
-    print "perm xy diff pval", perm_membership( x, y )
-    print "perm xy corr pval", perm_coupling( x, y )
+    print( "mean x, mean y, spearman( x,y )", mean( x ), mean( y ), spearmanr( x, y )[0] )
+    print( "boot x CI95", boot( x ) )
+    print( "boot x SErr", boot( x, stderr=True ) )
+    print( "boot x BCa CI95", boot( x, method="bca" ) )
+    print( "boot xy corr CI95", boot2( x, y ) )
+    print( "boot xy corr SErr", boot2( x, y, stderr=True ) )
+    print( "boot xy corr BCa CI95", boot2( x, y, method="bca" ) )
+    print( "perm xy diff pval", perm_membership( x, y ) )
+    print( "perm xy corr pval", perm_coupling( x, y ) )
 
 
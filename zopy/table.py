@@ -13,6 +13,9 @@ from scipy.stats import rankdata
 from numpy import array
 
 import zopy.utils as zu
+from zopy.groupby import groupby_rows
+from zopy.compression import open_output
+from zopy.formats import c_sig_figs, format_cells, iter_table_blocks
 
 #-------------------------------------------------------------------------------
 # constants
@@ -184,16 +187,16 @@ class Table:
     def copy( self ):
         return copy.deepcopy( self )
 
-    def write( self, path=None ):
-        fh = sys.stdout
-        if path is not None:
-            fh = zu.try_open( path, "w" )
-        W = csv.writer( fh, csv.excel_tab )
-        W.writerow( [self.origin] + self.colheads )
-        for r, row in zip( self.rowheads, self.data ):
-            W.writerow( [r] + row )
-        if path is not None:
-            fh.close( )
+    def write( self, path=None, sig=None ):
+        with open_output( path ) as fh:
+            W = csv.writer( fh, csv.excel_tab )
+            W.writerow( [self.origin] + self.colheads )
+            if sig is None:
+                for r, row in zip( self.rowheads, self.data ):
+                    W.writerow( [r] + row )
+            else:
+                for text in iter_table_blocks( self.rowheads, self.data, sig=sig ):
+                    fh.write( text )
 
     def rowsort( self, order=None ):
         order = order if order is not None else sorted( self.rowheads )
@@ -445,23 +448,14 @@ class Table:
         new = any( [n, new] )
         if transposed:
             self.transpose( )
-        # stack row values according to grouper function
-        data = {}
-        for r in self.rowheads:
-            key = grouper( r )
-            if key not in data:
-                data[key] = [[] for c in self.colheads]
-            for value, group in zip( self.row( r ), data[key] ):
-                group.append( value )
-        new_rowheads = sorted( data )
-        # apply summarizer to stacks to make new rows
-        new_data = [[summarizer( group ) for group in data[key]] for key in rowheads]
+        # factorize groups and summarize columns within them ( sorted group order )
+        new_rowheads, new_data = groupby_rows( self.rowheads, self.data, grouper, summarizer, sort=True )
         # **** ~copied from <filter> ****
         ret = None
         if not new:
             self.rowheads = new_rowheads
             self.data = new_data
-            if self.transposed:
+            if transposed:
                 self.transpose( )
             self.remap( )
             self.report( "after groupby size is", self.size( ), "and rowheads like '{}'".format( self.rowheads[0] ) )
@@ -626,9 +620,9 @@ class Table:
         """ Attempt to float all non-header entries in the table """
         self.apply_entries( float )
 
-    def unfloat( self ):
+    def unfloat( self, sig=c_sig_figs ):
         """ convert 0.0 to 0 and reduce others to N sig figs for compression """
-        self.apply_entries( lambda k: "0" if k == 0.0 else "%.6g" % ( k ) )
+        self.data = format_cells( self.data, sig=sig )
 
     def normalize_columns( self ):
         """ Normalizes the columns. Fails if there are non-numeric entries. """
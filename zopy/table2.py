@@ -11,12 +11,17 @@ import sys
 import re
 import copy
 import csv
+import multiprocessing
 from itertools import chain
 
 from scipy.stats import rankdata
-from numpy import array
+from numpy import array, linspace
 
-from zopy.utils import try_open
+from zopy.utils import try_open, say
+from zopy.groupby import groupby_rows
+from zopy.patterns import PatternSet
+from zopy.compression import open_output
+from zopy.formats import c_sig_figs, format_cells, iter_table_blocks
 
 # ---------------------------------------------------------------
 # constants 
@@ -27,6 +32,69 @@ c_strNA             = "#N/A"
 c_iMaxPrintChoices  = 3
 c_iMaxPeekChoices   = 5
 
+# ---------------------------------------------------------------
+# header interning
+# ---------------------------------------------------------------
+
+try:
+    from sys import intern
+except ImportError:
+    # python 2: builtin
+    pass
+
+def intern_header( header ):
+    """ share one copy of each header string across rows, maps and derived tables """
+    return intern( header ) if type( header ) is str else header
+
+# ---------------------------------------------------------------
+# reduce execution helpers
+# ---------------------------------------------------------------
+
+class ColumnView:
+
+    """ read-only view of one col of a list of lists, indexed like a row """
+
+    def __init__( self, data, index ):
+        self.data = data
+        self.index = index
+
+    def __len__( self ):
+        return len( self.data )
+
+    def __getitem__( self, i ):
+        if isinstance( i, slice ):
+            return [row[self.index] for row in self.data[i]]
+        return self.data[i][self.index]
+
+    def __iter__( self ):
+        for row in self.data:
+            yield row[self.index]
+
+# function and rows for forked reduce workers ( lambdas can't be pickled )
+c_shared = {}
+
+def test_rows( bounds ):
+    function, rows = c_shared["function"], c_shared["rows"]
+    return [bool( function( rows[i] ) ) for i in range( *bounds )]
+
+def evaluate_rows( function, rows, start=0, processes=None ):
+    """ tests of function over rows[start:], optionally split across forked processes """
+    if processes is not None and processes > 1 and len( rows ) - start > processes:
+        if multiprocessing.get_start_method( ) != "fork":
+            say( "Parallel reduce needs forked processes; evaluating serially" )
+        else:
+            c_shared["function"], c_shared["rows"] = function, rows
+            bounds = [int( k ) for k in linspace( start, len( rows ), processes + 1 )]
+            pool = multiprocessing.Pool( processes )
+            try:
+                blocks = pool.map( test_rows, zip( bounds[:-1], bounds[1:] ) )
+            finally:
+                pool.close( )
+                pool.join( )
+                c_shared.clear( )
+            return [test for block in blocks for test in block]
+    return [bool( function( rows[i] ) ) for i in range( start, len( rows ) )]
+
 # ---------------------------------------------------------------
 # beginning of the table object
 # ---------------------------------------------------------------
@@ -51,7 +119,7 @@ class table:
             self.source = "<list of lists>"
         else:
             with try_open( source ) if isinstance( source, str ) else sys.stdin as fh:
-                self.data = [row for row in csv.reader( fh, delimiter="\t", quotechar="", quoting=csv.QUOTE_NONE )]
+                self.data = [row for row in csv.reader( fh, delimiter="\t", quoting=csv.QUOTE_NONE )]
                 self.source = source if source is not None else "<stdin>"
         # track transposition status
         self.istransposed=False
@@ -70,48 +138,69 @@ class table:
 
     def remap( self ):
         """ rebuilding table indexing after instantiation or modification ( e.g. transpose ) """
-        # convenience variables for knowing headers
-        self.colheads = self.data[0][1:]
-        self.rowheads = [row[0] for row in self.data[1:]]
         # convenience variables for mapping headers to indexes
         # note, the overall header ( 0,0 ) can be called by name or this default
         self.colmap = { c_strHeaders:0 }
         self.rowmap = { c_strHeaders:0 }
-        # define colmap; check for collisions
-        # **** elif is special case for tables that used c_strHeaders originally ****
-        for i, header in enumerate( self.data[0] ):
-            if header not in self.colmap:
-                self.colmap[header] = i
-            elif i == 0 and header == c_strHeaders:
-                pass                
-            else:
-                self.report( "COL COLLISION:", header, "to be replaced with", header+"-dup" )
-                header += "-dup"
-                self.colmap[header] = i
-                """
-                self.report( "EXITING: col collision:", header, "at", i, "defined at", self.colmap[header] )
-                sys.exit()
-                """
-        # define rowmap; check for collisions
+        # keys actually used in the maps, by position ( differ from headers on collision )
+        self.colkeys = []
+        self.rowkeys = []
+        # convenience variables for knowing headers
+        self.colheads = []
+        self.rowheads = []
+        self.index_cols( 0 )
+        self.index_rows( 0 )
+
+    def index_key( self, mapping, header, i, label ):
+        """ add one header to a map; returns the key used """
         # **** elif is special case for tables that used c_strHeaders originally ****
-        for i, row in enumerate( self.data ):
-            header = row[0]
-            if header not in self.rowmap:
-                self.rowmap[header] = i
-            elif i == 0 and header == c_strHeaders:
-                pass
-            else:
-                self.report( "ROW COLLISION:", header, "to be replaced with", header+"-dup" )
-                header += "-dup"
-                self.rowmap[header] = i
-                """
-                self.report( "EXITING: row collision:", header, "at", i, "defined at", self.rowmap[header] )
-                sys.exit()
-                """
-        # check that all rows have the same length
-        aRowLens = [len( aRow ) for aRow in self.data]
-        if len( set( aRowLens ) ) != 1:
-            self.report( "EXITING: Not all rows have the same length", set( aRowLens ) )
+        if header not in mapping:
+            mapping[header] = i
+        elif i == 0 and header == c_strHeaders:
+            pass
+        else:
+            self.report( label, "COLLISION:", header, "to be replaced with", header+"-dup" )
+            header += "-dup"
+            mapping[header] = i
+        return header
+
+    def unindex( self, mapping, keys, start ):
+        """ drop map entries for positions >= start """
+        for i in range( start, len( keys ) ):
+            if mapping.get( keys[i] ) == i:
+                del mapping[keys[i]]
+        del keys[start:]
+
+    def index_cols( self, start ):
+        """ ( re )index colheads from position start on; earlier cols must be unchanged """
+        self.unindex( self.colmap, self.colkeys, start )
+        headers = self.data[0]
+        for i in range( start, len( headers ) ):
+            headers[i] = intern_header( headers[i] )
+            self.colkeys.append( self.index_key( self.colmap, headers[i], i, "COL" ) )
+        del self.colheads[max( 0, start-1 ):]
+        self.colheads += headers[max( 1, start ):]
+        self.width = len( headers )
+
+    def index_rows( self, start ):
+        """ ( re )index rows from position start on; earlier rows must be unchanged """
+        if start == 0:
+            # the colhead row also holds the origin header
+            self.rowmap = { c_strHeaders:0 }
+        self.unindex( self.rowmap, self.rowkeys, start )
+        for i in range( start, len( self.data ) ):
+            row = self.data[i]
+            row[0] = intern_header( row[0] )
+            self.rowkeys.append( self.index_key( self.rowmap, row[0], i, "ROW" ) )
+        del self.rowheads[max( 0, start-1 ):]
+        self.rowheads += [row[0] for row in self.data[max( 1, start ):]]
+        self.check_widths( start )
+
+    def check_widths( self, start ):
+        """ check that rows from start on have the width of the colhead row """
+        aRowLens = set( len( aRow ) for aRow in self.data[start:] )
+        if len( aRowLens - {self.width} ) > 0:
+            self.report( "EXITING: Not all rows have the same length", aRowLens | {self.width} )
             sys.exit()
 
     # ---------------------------------------------------------------
@@ -148,13 +237,17 @@ class table:
         """ Returns a DEEP copy of the table """
         return copy.deepcopy( self )
 
-    def dump( self, output_file=None ):
-        """ Print the table to a file """
-        fh = try_open( output_file, "w" ) if output_file is not None else sys.stdout
-        dumper = csv.writer( fh, delimiter="\t", quotechar="", quoting=csv.QUOTE_NONE )
-        for row in self.data:
-            dumper.writerow( row )
-        fh.close()
+    def dump( self, output_file=None, sig=None ):
+        """ Print the table to a file; with sig, numeric rows are written with sig significant figures """
+        with open_output( output_file ) as fh:
+            if sig is None:
+                for row in self.data:
+                    fh.write( "\t".join( map( str, row ) ) + "\n" )
+            else:
+                fh.write( "\t".join( map( str, self.data[0] ) ) + "\n" )
+                aRows = self.data[1:]
+                for text in iter_table_blocks( [row[0] for row in aRows], [row[1:] for row in aRows], sig=sig ):
+                    fh.write( text )
 
     def rowsort( self, order=None ):
         """ alphasorts the rows based on rowheads """
@@ -274,38 +367,49 @@ class table:
     # reduce method, operates like python's filter on rows
     # ---------------------------------------------------------------
 
-    def reduce( self, function, protect_headers=True, transposed=False, invert=False, in_place=True ):
-        """ apply a function to the rows of the table and rebuild with or return true evals """
-        # flip?
-        if transposed: 
-            self.transpose()
-        # auto-pass headers?
-        data2 = [self.data[0] if protect_headers else []]
+    def reduce_mask( self, function, protect_headers=True, transposed=False, invert=False, processes=None ):
+        """ evaluate function on each row ( or, if transposed, on col views ) and return a list of tests """
         start = 1 if protect_headers else 0
-        # apply test to rows
-        if not invert:
-            data2 += [row for row in self.data[start:] if function( row )]
+        if not transposed:
+            rows = self.data
         else:
-            data2 += [row for row in self.data[start:] if not function( row )]
+            rows = [ColumnView( self.data, j ) for j in range( len( self.data[0] ) )]
+            # header lookups inside function should see the table as if transposed
+            self.rowmap, self.colmap = self.colmap, self.rowmap
+        try:
+            mask = evaluate_rows( function, rows, start, processes )
+        finally:
+            if transposed:
+                self.rowmap, self.colmap = self.colmap, self.rowmap
+        if invert:
+            mask = [not test for test in mask]
+        # auto-pass headers?
+        return ( [True] if protect_headers else [] ) + mask
+
+    def reduce( self, function, protect_headers=True, transposed=False, invert=False, in_place=True, processes=None ):
+        """ apply a function to the rows of the table and rebuild with or return true evals """
+        mask = self.reduce_mask( function, protect_headers=protect_headers, transposed=transposed,
+                                 invert=invert, processes=processes )
+        keep = [i for i, test in enumerate( mask ) if test]
+        # select cols directly rather than transposing the table twice
+        if transposed:
+            data2 = [[row[j] for j in keep] for row in self.data]
+        else:
+            data2 = [self.data[i] for i in keep]
         # (1) rebuild table
         if in_place:
             self.data = data2
-            if transposed: 
-                self.transpose()
             self.remap()
             self.report( "--> reduced size is", self.size() )
             return None
         # (2) return rows that passed as new table
         else:
-            if transposed: 
-                self.transpose()
-            # rebuild data2 to avoid referencing self.data rows
-            data2 = [row[:] for row in data2]
+            # rebuild data2 to avoid referencing self.data rows ( transposed rows are already new )
+            if not transposed:
+                data2 = [row[:] for row in data2]
             # this returns to the outer function, which must also return
             new_table = table( data2, verbose=self.isverbose )
-            # if we were working on a transposed table, must also transpose selected rows
-            if transposed: 
-                new_table.transpose()
+            new_table.istransposed = self.istransposed
             return new_table
 
     # ---------------------------------------------------------------
@@ -317,7 +421,8 @@ class table:
         if isinstance( patterns, str ):
             patterns = [patterns]
         self.report( "applying grep", "index=", index, "patterns=", pretty_list( patterns ), kwargs )
-        return self.reduce( lambda row: any( [re.search( k, row[self.coldex( index )] ) for k in patterns] ), **kwargs )
+        matcher = PatternSet( patterns )
+        return self.reduce( lambda row: matcher.search( row[self.coldex( index )] ), **kwargs )
 
     def select( self, index, choices, **kwargs ):
         """ select rows whose col[index] entry is in choices """
@@ -365,16 +470,8 @@ class table:
 
     def groupby( self, funcGrouper, funcSummarizer ):
         """ user grouper function on rowheads to cluster rows, then use summarizer function to combine values """ 
-        groups = {} # map new rowheads to 1+ old rowheads
-        for rowhead in self.rowheads:
-            groupdict = groups.setdefault( funcGrouper( rowhead ), {} )
-            groupdict[rowhead] = 1
-        data2 = [self.data[0]] # colheads
-        for group, dictRowheads in groups.items():
-            aaRows = [self.row( rowhead ) for rowhead in dictRowheads]
-            aaRowsTransposed = [[aRow[i] for aRow in aaRows] for i in range( len( aaRows[0] ) )]
-            data2.append( [group] + [funcSummarizer( aRow ) for aRow in aaRowsTransposed] )
-        self.data = data2
+        aGroups, aaRows = groupby_rows( self.rowheads, [self.row( rowhead ) for rowhead in self.rowheads], funcGrouper, funcSummarizer )
+        self.data = [self.data[0]] + [[group] + aRow for group, aRow in zip( aGroups, aaRows )] # colheads
         self.remap()
         self.report( "applied groupby:", "rowheads now like <%s>" % ( self.rowheads[0] ), "; new size is", self.size() )
 
@@ -456,7 +553,7 @@ class table:
         """ inserts a pre-formatted row ( has header; proper order ) into the table before index """
         index = self.rowdex( index )
         self.data.insert( index, row )
-        self.remap()
+        self.index_rows( index )
 
     def augment( self, table2 ):
         """ join table with table2 on colheads """
@@ -464,11 +561,12 @@ class table:
         if len( setRowheadOverlap ) > 0:
             self.report( "augmentee contains", len( setRowheadOverlap ), "duplicate rowheads (skip)" )
         # note: "colhead in dictColmap" much faster than "colhead in aColheads"
-        self.data = self.data + [
+        start = len( self.data )
+        self.data += [
             [rowhead2] + [table2.entry( rowhead2, colhead ) if colhead in table2.colmap else c_strNA for colhead in self.colheads] 
             for rowhead2 in table2.rowheads if rowhead2 not in self.rowmap
             ]
-        self.remap()
+        self.index_rows( start )
         self.report( "augmented with rows from", table2.source, "new size is", self.size() )
 
     def extend( self, table2 ):
@@ -478,6 +576,7 @@ class table:
             self.report( "extendee contains", len( setColheadOverlap ), "duplicate colheads (skip)" )
         # find index for unique cols in table2
         aIndex = [j for j, colhead in enumerate( table2.colheads ) if colhead not in self.colmap]
+        start = self.width
         for i in range( len( self.data ) ):
             rowhead = self.data[i][0]
             # headers are a special case (may not align on rowhead if 0,0 entries differ)
@@ -490,7 +589,9 @@ class table:
             # a self-specific row, add all NA entries
             else:
                 self.data[i] += [c_strNA for j in aIndex]
-        self.remap()
+        self.index_cols( start )
+        # every row gained cols
+        self.check_widths( 0 )
         self.report( "extended with cols from", table2.source, "new size is", self.size() )
 
     def merge( self, table2 ):
@@ -525,8 +626,9 @@ class table:
         dataTemp = self.data[1:] # data rows
         self.head( 0 )
         self.augment( tableMetadata )
+        start = len( self.data )
         self.data += dataTemp
-        self.remap()
+        self.index_rows( start )
         self.report( "added metadata from", tableMetadata.source, "new size is", self.size() )
 
     # ---------------------------------------------------------------
@@ -541,9 +643,11 @@ class table:
         """ Attempt to float all non-header entries in the table """
         self.apply_entries( float )
 
-    def unfloat( self ):
+    def unfloat( self, sig=c_sig_figs ):
         """ convert 0.0 to 0 and reduce others to N sig figs for compression """
-        self.apply_entries( lambda k: "0" if k == 0.0 else "%.6g" % ( k ) )
+        aaCells = format_cells( [row[1:] for row in self.data[1:]], sig=sig )
+        for i, aCells in enumerate( aaCells, 1 ):
+            self.data[i] = [self.data[i][0]] + aCells
 
     def normalize_columns( self ):
         """ Normalizes the columns. Fails if there are non-numeric entries. """
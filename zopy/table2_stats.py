@@ -9,6 +9,9 @@ perform tests on the table2 object
 import sys
 from math import log
 from scipy.stats import spearmanr
+from numpy import array
+
+from zopy.correlations import correlation_matrix
 
 # ---------------------------------------------------------------
 # constants
@@ -93,6 +96,19 @@ def one_sample ( tableData, func=None ):
 
 def two_sample ( tableData, func=None ):
     dictResults = {}
+    # correlations: compute all pairs at once via blocked matrix products
+    if func in ["spearman", "pearson"]:
+        aSamples, aaCols = zip( *tableData.iter_cols() )
+        if func == "spearman":
+            # same check as funcSpearman, once per column rather than once per pair
+            for aCol in aaCols:
+                funcTestZeroes( list( aCol ) )
+        aaR = correlation_matrix( array( aaCols, dtype=float ), method=func )
+        for i, sample1 in enumerate( aSamples ):
+            for j, sample2 in enumerate( aSamples ):
+                if sample1 < sample2:
+                    dictResults[( sample1, sample2 )] = aaR[i][j]
+        return dictResults
     for sample1, col1 in tableData.iter_cols():
         for sample2, col2 in tableData.iter_cols():
             if sample1 < sample2:
@@ -11,13 +11,16 @@ New zopy table class
 import os
 import sys
 import re
-import csv
 
 import numpy as np
 from numpy import array, ndarray
 from scipy.stats import rankdata
+from multiprocessing import Pool
 
-from zopy.utils import reader, try_open, die, warn
+from zopy.utils import reader, try_open, say, die, warn
+from zopy.patterns import PatternSet
+from zopy.compression import open_output, sniff
+from zopy.formats import iter_blocks
 
 # ---------------------------------------------------------------
 # constants 
@@ -26,6 +29,13 @@ from zopy.utils import reader, try_open, die, warn
 c_default_origin    = "#HEADERS"
 c_na                = "#N/A"
 c_max_print_choices = 3
+c_na_values         = {"", "NA", "NaN", "nan", c_na}
+# body rows inspected to decide numeric vs. string
+c_sample_rows       = 1000
+# rows parsed into one array before stacking
+c_chunk_rows        = 10000
+# dtype requesting inference ( numeric vs. str )
+c_auto_dtype        = "auto"
 
 # ---------------------------------------------------------------
 # helper functions
@@ -47,8 +57,174 @@ def load_from_path( path ):
 def load_from_handle( fh ):
     return coerce( [row for row in reader( fh )] )
 
+# ---------------------------------------------------------------
+# typed loading ( headers read separately, body parsed to dtype )
+# ---------------------------------------------------------------
+
+def split_line( line ):
+    return line.rstrip( "\n" ).split( "\t" )
+
+def is_number( item ):
+    if item in c_na_values:
+        return True
+    try:
+        float( item )
+        return True
+    except ValueError:
+        return False
+
+def infer_dtype( rows, numeric=np.float64 ):
+    """ numeric dtype if every sampled body cell is a number or NA, else str """
+    for row in rows:
+        if not all( is_number( k ) for k in row[1:] ):
+            return str
+    return numeric
+
+class RaggedRowError( ValueError ):
+    """ a body row whose width doesn't match the headers ( not a dtype problem ) """
+    pass
+
+def parse_rows( rows, dtype, ncols=None ):
+    """ split rows into ( rowheads, 2d array of dtype ) """
+    if ncols is not None:
+        for row in rows:
+            if len( row ) - 1 != ncols:
+                raise RaggedRowError( "Row {} has {} values for {} colheads".format(
+                    row[0], len( row ) - 1, ncols ) )
+    rowheads = [row[0] for row in rows]
+    if dtype is str:
+        return rowheads, array( [row[1:] for row in rows], dtype=str )
+    body = [[k if k not in c_na_values else "nan" for k in row[1:]] for row in rows]
+    return rowheads, array( body, dtype=dtype ).reshape( len( rows ), -1 )
+
+def stack( chunks, ncols, dtype ):
+    rowheads, blocks = [], []
+    for heads, block in chunks:
+        rowheads += heads
+        blocks.append( block )
+    if len( blocks ) == 0:
+        return rowheads, np.zeros( ( 0, ncols ), dtype=dtype )
+    return rowheads, np.concatenate( blocks ) if len( blocks ) > 1 else blocks[0]
+
+def iter_chunks( lines, dtype, ncols=None, chunk=c_chunk_rows ):
+    rows = []
+    for line in lines:
+        rows.append( split_line( line ) )
+        if len( rows ) >= chunk:
+            yield parse_rows( rows, dtype, ncols )
+            rows = []
+    if len( rows ) > 0:
+        yield parse_rows( rows, dtype, ncols )
+
+def parse_body( lines, dtype, ncols ):
+    """ stack the parsed chunks; ragged rows die here, other ValueErrors are dtype failures """
+    try:
+        return stack( iter_chunks( lines, dtype, ncols ), ncols, dtype )
+    except RaggedRowError as e:
+        die( e )
+
+def load_typed_from_handle( fh, dtype=None, sample=c_sample_rows, path=None ):
+    """
+    return ( origin, rowheads, colheads, data ); dtype=None infers numeric
+    ( float64 ) vs. str from the first sample rows. the body is parsed chunk
+    by chunk, so no string copy of the full table is held alongside the array.
+    if an inferred numeric dtype meets a non-numeric cell past the sample, the
+    body is reloaded as str: from path if given ( fh came from it ), else from
+    text kept while parsing ( plain handles can't be re-read )
+    """
+    headers = split_line( next( fh ) )
+    ncols = len( headers ) - 1
+    head = []
+    for line in fh:
+        head.append( line )
+        if len( head ) >= sample:
+            break
+    inferred = dtype is None
+    if inferred:
+        dtype = infer_dtype( [split_line( k ) for k in head] )
+        if dtype is not str and path is None:
+            head += list( fh )
+    def lines( ):
+        for line in head:
+            yield line
+        for line in fh:
+            yield line
+    try:
+        rowheads, data = parse_body( lines( ), dtype, ncols )
+    except ValueError as e:
+        if not inferred:
+            die( "Can't parse table body as {} ({}); load with dtype=str".format( np.dtype( dtype ).name, e ) )
+        warn( "Non-numeric cell past the first", sample, "rows ({}); loading as str".format( e ) )
+        if path is None:
+            rowheads, data = parse_body( iter( head ), str, ncols )
+        else:
+            with try_open( path ) as fh2:
+                next( fh2 )
+                rowheads, data = parse_body( fh2, str, ncols )
+    return headers[0], rowheads, headers[1:], data
+
+def load_byte_range( args ):
+    """ parse the lines that start within [start, stop) of an uncompressed file """
+    path, start, stop, dtype, ncols = args
+    chunks = []
+    with open( path, "rb" ) as fh:
+        if start > 0:
+            # the partial line belongs to the previous range
+            fh.seek( start - 1 )
+            fh.readline( )
+        rows = []
+        while fh.tell( ) < stop:
+            line = fh.readline( )
+            if line == b"":
+                break
+            rows.append( split_line( line.decode( "utf-8" ) ) )
+            if len( rows ) >= c_chunk_rows:
+                chunks.append( parse_rows( rows, dtype, ncols ) )
+                rows = []
+        if len( rows ) > 0:
+            chunks.append( parse_rows( rows, dtype, ncols ) )
+    return chunks
+
+def load_typed_parallel( path, dtype=None, processes=2, sample=c_sample_rows ):
+    """ as load_typed_from_handle, but split the ( uncompressed ) body by byte ranges across processes """
+    with open( path, "rb" ) as fh:
+        headers = split_line( fh.readline( ).decode( "utf-8" ) )
+        offset = fh.tell( )
+        inferred = dtype is None
+        if inferred:
+            head = []
+            for line in fh:
+                head.append( split_line( line.decode( "utf-8" ) ) )
+                if len( head ) >= sample:
+                    break
+            dtype = infer_dtype( head )
+    size = os.path.getsize( path )
+    bounds = np.linspace( offset, size, processes + 1 ).astype( int )
+    ncols = len( headers ) - 1
+    tasks = [[path, bounds[i], bounds[i+1], dtype, ncols] for i in range( processes )]
+    pool = Pool( processes )
+    try:
+        try:
+            results = pool.map( load_byte_range, tasks )
+        except RaggedRowError as e:
+            die( e )
+        except ValueError as e:
+            if not inferred:
+                die( "Can't parse table body as {} ({}); load with dtype=str".format( np.dtype( dtype ).name, e ) )
+            warn( "Non-numeric cell past the first", sample, "rows ({}); loading as str".format( e ) )
+            dtype = str
+            try:
+                results = pool.map( load_byte_range, [task[:3] + [str, ncols] for task in tasks] )
+            except RaggedRowError as e:
+                die( e )
+    finally:
+        pool.close( )
+        pool.join( )
+    rowheads, data = stack( [c for chunks in results for c in chunks], ncols, dtype )
+    return headers[0], rowheads, headers[1:], data
+
 def multiplex( choices ):
-    return set( choices ) if hasattr( choices, "__iter__" ) else {choices}
+    return set( choices ) if hasattr( choices, "__iter__" ) and not isinstance( choices, str ) else {choices}
 
 def anymatch( string, patterns ):
     test = False
@@ -78,6 +254,8 @@ class table:
         name=None,
         verbose=True,
         numeric=False,
+        dtype=None,
+        processes=None,
         ):
 
         """ """
@@ -98,6 +276,22 @@ class table:
                 else range( self.data.shape[0] )
             self.colheads = colheads if colheads is not None \
                 else range( self.data.shape[1] )
+        elif headers and ( path is not None or fh is not None ):
+            # str body ( the text as written ) unless numeric or a dtype is requested;
+            # dtype="auto" infers float64 vs. str from the data
+            dtype = dtype if dtype is not None else ( np.float64 if numeric else str )
+            dtype = None if isinstance( dtype, str ) and dtype == c_auto_dtype else dtype
+            # byte ranges only make sense for plain files ( codec sniffed from magic bytes )
+            compressed = path is not None and ( not os.path.isfile( path ) or sniff( path ) is not None )
+            if path is not None and processes is not None and processes > 1 and not compressed:
+                loaded = load_typed_parallel( path, dtype=dtype, processes=processes )
+            elif path is not None:
+                with try_open( path ) as fh:
+                    loaded = load_typed_from_handle( fh, dtype=dtype, path=path )
+            else:
+                loaded = load_typed_from_handle( fh, dtype=dtype )
+            self.origin, self.rowheads, self.colheads, self.data = loaded
+            self.is_numeric = self.data.dtype.kind == "f"
         else:
             if path is not None:
                 matrix = load_from_path( path )
@@ -172,7 +366,7 @@ class table:
     def report( self, *args ):
         """ generic reporter """
         if self.is_verbose:
-            print >>sys.stderr, self.name, ":", " ".join( [str( k ) for k in args] )
+            say( self.name, ":", " ".join( [str( k ) for k in args] ) )
 
     def transpose( self ):
         """ much, much faster than old method """
@@ -201,15 +395,20 @@ class table:
     # write table to stdout/disk
     # ---------------------------------------------------------------
         
-    def write( self, path=None, gzip=False ):
+    def write( self, path=None, gzip=False, sig=None ):
         """ 
-        **** implement gzipped writing ****
+        write to path ( or stdout ); compressed per the extension, or gzipped if gzip
+        numeric tables are formatted in blocks; sig=None keeps full precision
         """
-        with ( try_open( path ) if path is not None else sys.stdout ) as fh: 
-            writer = csv.writer( fh, delimiter="\t", quotechar="", quoting=csv.QUOTE_NONE )
-            writer.writerow( [self.origin] + list( self.colheads ) )
-            for rowhead, row in zip( self.rowheads, self.data ):
-                writer.writerow( [rowhead] + list( row ) )
+        codec = "gzip" if gzip else "auto"
+        with open_output( path, codec=codec ) as fh: 
+            fh.write( "\t".join( map( str, [self.origin] + list( self.colheads ) ) ) + "\n" )
+            if self.data.dtype.kind in "biuf":
+                for text in iter_blocks( self.data, rowheads=list( self.rowheads ), sig=sig ):
+                    fh.write( text )
+            else:
+                for rowhead, row in zip( self.rowheads, self.data ):
+                    fh.write( "\t".join( map( str, [rowhead] + list( row ) ) ) + "\n" )
 
     # ---------------------------------------------------------------
     # appliers
@@ -267,26 +466,61 @@ class table:
             yield self.colheads[j], self.data[:, j]
         
     # ---------------------------------------------------------------
-    # filter a table on a function of its headers
+    # filter a table on a boolean mask over its rows
     # ---------------------------------------------------------------
 
-    def filter ( self, 
-                 function, 
-                 vectors=False, 
-                 transposed=False, t=False, 
-                 invert=False, v=False,
-                 new=False, ):
+    def headers( self ):
+        """ rowheads as an object array ( for vectorized header tests ) """
+        heads = np.empty( self.nrows, dtype=object )
+        heads[:] = list( self.rowheads )
+        return heads
+
+    def header_mask( self, choices, regex=False ):
+        """ rows whose header is in choices ( or matches any choice as a regex ) """
+        heads = self.headers( )
+        if not regex:
+            return np.fromiter( ( k in choices for k in heads ), dtype=bool, count=self.nrows )
+        matcher = PatternSet( choices )
+        return np.fromiter( ( matcher.search( str( k ) ) for k in heads ),
+                            dtype=bool, count=self.nrows )
+
+    def field_mask( self, field, choices, regex=False ):
+        """ rows whose value in field is in choices ( or matches any choice as a regex ) """
+        values = self.data[:, self.coldex( field )]
+        if not regex:
+            return np.isin( values, list( choices ) )
+        matcher = PatternSet( choices )
+        return np.fromiter( ( matcher.search( str( k ) ) for k in values ),
+                            dtype=bool, count=self.nrows )
+
+    def filter_mask( self, mask,
+                     transposed=False, t=False,
+                     invert=False, v=False,
+                     new=False, ):
+        """
+        keep rows where mask is true; mask is a function of the table ( after
+        any transposition ) or a precomputed boolean array. in place, a contiguous
+        run of kept rows is taken as a slice ( a view, not a copy ); a new table
+        always gets its own copy of the data
+        """
         # process shorthand
         transposed = any( [transposed, t] )
         invert = any( [invert, v] )
         if transposed:
             self.transpose()
-        new_rowheads = []
-        for header, row in self.iter_rows():
-            test = function( header ) if not vectors else function( row )
-            if (test and not invert) or (not test and invert):
-                new_rowheads.append( header )
-        new_data = self.data[[self.rowmap[k] for k in new_rowheads]]
+        if callable( mask ):
+            mask = mask( self )
+        mask = np.asarray( mask, dtype=bool )
+        if invert:
+            mask = ~mask
+        index = np.flatnonzero( mask )
+        if len( index ) > 0 and index[-1] - index[0] + 1 == len( index ):
+            new_data = self.data[index[0]:index[-1]+1]
+            if new:
+                new_data = new_data.copy( )
+        else:
+            new_data = self.data[index]
+        new_rowheads = [self.rowheads[i] for i in index]
         if not new:
             self.rowheads = new_rowheads
             self.data = new_data
@@ -297,29 +531,35 @@ class table:
         else:
             new_table = table( 
                 data=new_data, 
-                rowheads=new_rowheads[:], 
-                colheads=self.colheads[:], 
+                rowheads=new_rowheads, 
+                colheads=list( self.colheads ), 
+                numeric=self.is_numeric,
                 )
             if transposed:
                 self.transpose()
                 new_table.transpose()
             return new_table
 
+    def filter ( self, 
+                 function, 
+                 vectors=False, 
+                 **kwargs ):
+        """ keep rows for which function( header ) ( or function( row ) with vectors ) is true """
+        def inner( self ):
+            items = self.data if vectors else self.rowheads
+            return np.fromiter( ( bool( function( k ) ) for k in items ), dtype=bool, count=self.nrows )
+        return self.filter_mask( inner, **kwargs )
+
     # ---------------------------------------------------------------
-    # methods that call filter
+    # methods that call filter_mask
     # ---------------------------------------------------------------
 
     def select( self, choices, field=None, **kwargs ):
         choices = multiplex( choices )
         if field is None:
-            def inner( header ):
-                return header in choices
+            return self.filter_mask( lambda self: self.header_mask( choices ), **kwargs )
         else:
-            def inner( header ):
-                cpos = self.colmap[field]
-                rpos = self.rowmap[header]
-                return self.data[rpos, cpos] in choices
-        return self.filter( inner, **kwargs )
+            return self.filter_mask( lambda self: self.field_mask( field, choices ), **kwargs )
 
     def delete( self, choices, **kwargs ):
         return self.select( choices, invert=True, **kwargs )
@@ -327,17 +567,12 @@ class table:
     def grep( self, choices, field=None, **kwargs ):
         choices = multiplex( choices )
         if field is None:
-            def inner( header ):
-                return anymatch( header, choices )
+            return self.filter_mask( lambda self: self.header_mask( choices, regex=True ), **kwargs )
         else:
-            def inner( header ):
-                cpos = self.colmap[field]
-                rpos = self.rowmap[header]
-                return anymatch( self.data[rpos, cpos], choices )
-        return self.filter( inner, **kwargs )
+            return self.filter_mask( lambda self: self.field_mask( field, choices, regex=True ), **kwargs )
 
     def head( self, header, **kwargs ):
-        return self.filter( lambda k: self.rowdex( k ) <= self.rowdex( header ), **kwargs )
+        return self.filter_mask( lambda self: np.arange( self.nrows ) <= self.rowdex( header ), **kwargs )
 
     def apfilter( self, minabund=0, minprev=1, **kwargs ):
         if not self.is_numeric:
@@ -346,11 +581,23 @@ class table:
             self.report( "will interpret minimum prevalence", minprev, "as a fraction of samples" )
         if not ( kwargs.get( "t", False ) or kwargs.get( "transposed", False ) ):
             self.report( "using apfilter on non-transposed table is not standard" )
-        def inner( vector, minabund=minabund, minprev=minprev ):
+        def inner( self, minprev=minprev ):
             if type( minprev ) is float:
-                minprev = int( len( vector ) * minprev )
-            return list( vector >= minabund ).count( True ) >= minprev
-        return self.filter( inner, vectors=True, **kwargs )
+                minprev = int( self.ncols * minprev )
+            return np.count_nonzero( self.data >= minabund, axis=1 ) >= minprev
+        return self.filter_mask( inner, **kwargs )
+
+    def limit( self, field, lower=None, upper=None, **kwargs ):
+        """ keep rows whose ( numeric ) value in field lies within [lower, upper] """
+        def inner( self ):
+            values = self.data[:, self.coldex( field )].astype( float )
+            mask = np.ones( self.nrows, dtype=bool )
+            if lower is not None:
+                mask &= values >= lower
+            if upper is not None:
+                mask &= values <= upper
+            return mask
+        return self.filter_mask( inner, **kwargs )
 
     # ---------------------------------------------------------------
     # mathmatical operations
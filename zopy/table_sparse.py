@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+
+"""
+Sparse (CSR-backed) zopy table class for zero-heavy numeric tables
+Mirrors the header-indexing API of zopy.table_arrays.table
+"""
+
+# ---------------------------------------------------------------
+# imports
+# ---------------------------------------------------------------
+
+from __future__ import print_function
+
+import numpy as np
+from scipy import sparse
+
+from zopy.utils import try_open, say, die, warn
+from zopy.patterns import PatternSet
+from zopy.compression import open_output
+from zopy.formats import c_sig_figs, c_block_rows, number_format, format_block
+
+# ---------------------------------------------------------------
+# constants
+# ---------------------------------------------------------------
+
+c_default_origin = "#HEADERS"
+c_na_values      = {"", "NA", "NaN", "nan", "#N/A"}
+
+# ---------------------------------------------------------------
+# helper functions
+# ---------------------------------------------------------------
+
+def multiplex( choices ):
+    return set( choices ) if hasattr( choices, "__iter__" ) and not isinstance( choices, str ) else {choices}
+
+def parse_value( item ):
+    """ NA cells become nan: stored explicitly ( nan is nonzero ), so never confused with 0 """
+    return np.nan if item in c_na_values else float( item )
+
+def warn_na( data, name ):
+    count = int( np.isnan( data.data ).sum( ) )
+    if count > 0:
+        warn( "Loaded", count, "NA cells from", name, "as nan" )
+
+def load_from_handle( fh ):
+    """ read a dense tsv one row at a time, keeping only the nonzero cells """
+    origin, colheads = None, None
+    rowheads, indptr, indices, values = [], [0], [], []
+    for line in fh:
+        items = line.rstrip( "\n" ).split( "\t" )
+        if colheads is None:
+            origin, colheads = items[0], items[1:]
+            continue
+        rowheads.append( items[0] )
+        row = np.array( [parse_value( k ) for k in items[1:]] )
+        if len( row ) != len( colheads ):
+            die( "Row", items[0], "has", len( row ), "values for", len( colheads ), "colheads" )
+        nonzero = np.flatnonzero( row )
+        indices.append( nonzero )
+        values.append( row[nonzero] )
+        indptr.append( indptr[-1] + len( nonzero ) )
+    data = sparse.csr_matrix(
+        ( np.concatenate( values ) if values else np.zeros( 0 ),
+          np.concatenate( indices ) if indices else np.zeros( 0, dtype=int ),
+          np.array( indptr ) ),
+        shape=( len( rowheads ), len( colheads ) ),
+    )
+    return origin, rowheads, colheads, data
+
+def load_triplets_from_handle( fh ):
+    """ read 'rowhead colhead value' lines ( sparse tsv ); header order is first-seen """
+    rowmap, colmap = {}, {}
+    rr, cc, vv = [], [], []
+    for line in fh:
+        r, c, v = line.rstrip( "\n" ).split( "\t" )
+        rr.append( rowmap.setdefault( r, len( rowmap ) ) )
+        cc.append( colmap.setdefault( c, len( colmap ) ) )
+        vv.append( parse_value( v ) )
+    data = sparse.coo_matrix( ( vv, ( rr, cc ) ), shape=( len( rowmap ), len( colmap ) ) ).tocsr( )
+    rowheads = sorted( rowmap, key=lambda k: rowmap[k] )
+    colheads = sorted( colmap, key=lambda k: colmap[k] )
+    return c_default_origin, rowheads, colheads, data
+
+# ---------------------------------------------------------------
+# main table class
+# ---------------------------------------------------------------
+
+class table:
+
+    """ numeric table whose values are held in a scipy CSR matrix """
+
+    def __init__(
+        self,
+        path=None,
+        fh=None,
+        data=None,
+        rowheads=None,
+        colheads=None,
+        triplets=False,
+        origin=c_default_origin,
+        name=None,
+        verbose=True,
+        ):
+
+        self.name = name if name is not None else path
+        self.is_verbose = verbose
+        self.origin = origin
+        loader = load_triplets_from_handle if triplets else load_from_handle
+        if data is not None:
+            self.data = sparse.csr_matrix( data, dtype=float )
+            self.rowheads = list( rowheads ) if rowheads is not None \
+                else list( range( self.data.shape[0] ) )
+            self.colheads = list( colheads ) if colheads is not None \
+                else list( range( self.data.shape[1] ) )
+        elif path is not None:
+            with try_open( path ) as fh:
+                self.origin, self.rowheads, self.colheads, self.data = loader( fh )
+            warn_na( self.data, path )
+        elif fh is not None:
+            self.origin, self.rowheads, self.colheads, self.data = loader( fh )
+            warn_na( self.data, self.name )
+        else:
+            die( "No loading option." )
+        self.index( )
+        self.report( "new sparse table with shape", self.shape,
+                     "and density {:.4f}".format( self.density( ) ) )
+
+    def index( self ):
+        """ rebuild header maps and shape """
+        self.shape = self.data.shape
+        self.nrows, self.ncols = self.shape
+        assert len( self.rowheads ) == self.nrows, "Dimension issue"
+        assert len( self.colheads ) == self.ncols, "Dimension issue"
+        self.rowmap = {}
+        self.colmap = {}
+        for i, value in enumerate( self.rowheads ):
+            while value in self.rowmap:
+                warn( "Duplicate rowhead", value, "defined at", self.rowmap[value] )
+                value = str( value ) + "-dup"
+                warn( "  trying", value )
+            self.rowmap[value] = i
+        for j, value in enumerate( self.colheads ):
+            while value in self.colmap:
+                warn( "Duplicate colhead", value, "defined at", self.colmap[value] )
+                value = str( value ) + "-dup"
+                warn( "  trying", value )
+            self.colmap[value] = j
+
+    # ---------------------------------------------------------------
+    # object methods
+    # ---------------------------------------------------------------
+
+    def __repr__( self ):
+        r = min( self.nrows, 5 )
+        c = min( self.ncols, 5 )
+        block = self.data[0:r, 0:c].toarray( )
+        outline = "\t".join( map( str, [self.origin] + self.colheads[0:c] ) ) + "\n"
+        for i in range( r ):
+            outline += "\t".join( map( str, [self.rowheads[i]] + list( block[i] ) ) ) + "\n"
+        return outline
+
+    # ---------------------------------------------------------------
+    # custom utils
+    # ---------------------------------------------------------------
+
+    def rowdex( self, index ):
+        """ Convert numerical or string rowhead to numerical rowhead index """
+        return index if isinstance( index, int ) else self.rowmap[index]
+
+    def coldex( self, index ):
+        """ Convert numerical or string colhead to numerical colhead index """
+        return index if isinstance( index, int ) else self.colmap[index]
+
+    def report( self, *args ):
+        """ generic reporter """
+        if self.is_verbose:
+            say( self.name, ":", " ".join( [str( k ) for k in args] ) )
+
+    def density( self ):
+        return self.data.nnz / float( max( 1, self.nrows * self.ncols ) )
+
+    def transpose( self ):
+        self.rowheads, self.colheads = self.colheads, self.rowheads
+        self.data = self.data.transpose( ).tocsr( )
+        self.index( )
+        return self
+
+    def rowsort( self ):
+        """ sorts the rows based on rowheads """
+        order = sorted( range( self.nrows ), key=lambda x: self.rowheads[x] )
+        self.data = self.data[order, :]
+        self.rowheads = [self.rowheads[i] for i in order]
+        self.index( )
+        return self
+
+    def colsort( self ):
+        """ sorts the cols based on colheads """
+        order = sorted( range( self.ncols ), key=lambda x: self.colheads[x] )
+        self.data = self.data[:, order].tocsr( )
+        self.colheads = [self.colheads[j] for j in order]
+        self.index( )
+        return self
+
+    def dense( self ):
+        """ the values as a dense 2d array """
+        return self.data.toarray( )
+
+    # ---------------------------------------------------------------
+    # write table to stdout/disk
+    # ---------------------------------------------------------------
+
+    def write( self, path=None, triplets=False, sig=c_sig_figs ):
+        """ write as a dense tsv ( zeros as '0' ) or as nonzero 'rowhead colhead value' triplets """
+        fmt = number_format( sig )
+        with open_output( path ) as fh:
+            if not triplets:
+                print( "\t".join( map( str, [self.origin] + self.colheads ) ), file=fh )
+                # densify one block of rows at a time
+                for i in range( 0, self.nrows, c_block_rows ):
+                    block = self.data[i:i+c_block_rows].toarray( )
+                    fh.write( format_block( block, rowheads=self.rowheads[i:i+c_block_rows], sig=sig ) )
+                return
+            for i, rowhead in enumerate( self.rowheads ):
+                start, stop = self.data.indptr[i], self.data.indptr[i+1]
+                for j, value in zip( self.data.indices[start:stop], self.data.data[start:stop] ):
+                    print( rowhead, self.colheads[j], fmt % value, sep="\t", file=fh )
+
+    # ---------------------------------------------------------------
+    # generators
+    # ---------------------------------------------------------------
+
+    def iter_rows( self ):
+        for i in range( self.nrows ):
+            yield self.rowheads[i], self.data[i].toarray( )[0]
+
+    def iter_cols( self ):
+        csc = self.data.tocsc( )
+        for j in range( self.ncols ):
+            yield self.colheads[j], csc[:, j].toarray( )[:, 0]
+
+    # ---------------------------------------------------------------
+    # filter a table on a mask or a function of its headers
+    # ---------------------------------------------------------------
+
+    def filter_mask( self, mask, transposed=False, invert=False, new=False ):
+        """ keep rows where mask is True; mask is computed on the ( transposed? ) table """
+        mask = np.asarray( mask, dtype=bool )
+        if invert:
+            mask = ~mask
+        index = np.flatnonzero( mask )
+        data = self.data[index]
+        rowheads = [self.rowheads[i] for i in index]
+        if not new:
+            self.data, self.rowheads = data, rowheads
+            self.index( )
+            if transposed:
+                self.transpose( )
+            self.report( "new shape is", self.shape )
+            return self
+        else:
+            ret = table( data=data, rowheads=rowheads, colheads=self.colheads[:],
+                         origin=self.origin, name=self.name, verbose=self.is_verbose )
+            if transposed:
+                self.transpose( )
+                ret.transpose( )
+            return ret
+
+    def filter( self, function,
+                transposed=False, t=False,
+                invert=False, v=False,
+                new=False, ):
+        """ keep rows for which function( rowhead ) is true """
+        transposed = any( [transposed, t] )
+        invert = any( [invert, v] )
+        if transposed:
+            self.transpose( )
+        mask = [bool( function( header ) ) for header in self.rowheads]
+        return self.filter_mask( mask, transposed=transposed, invert=invert, new=new )
+
+    def field_values( self, field ):
+        """ one column's values, aligned to the rows """
+        return self.data[:, self.coldex( field )].toarray( )[:, 0]
+
+    # ---------------------------------------------------------------
+    # methods that call filter
+    # ---------------------------------------------------------------
+
+    def select( self, choices, field=None, **kwargs ):
+        choices = multiplex( choices )
+        if field is None:
+            return self.filter( lambda header: header in choices, **kwargs )
+        # field values must be found on the table as it will be filtered
+        return self.on_values( field, lambda values: np.isin( values, list( choices ) ), **kwargs )
+
+    def delete( self, choices, **kwargs ):
+        return self.select( choices, invert=True, **kwargs )
+
+    def grep( self, choices, field=None, **kwargs ):
+        choices = multiplex( choices )
+        matcher = PatternSet( choices )
+        if field is None:
+            return self.filter( lambda header: matcher.search( str( header ) ), **kwargs )
+        return self.on_values( field, lambda values: [matcher.search( number_format( ) % k ) for k in values], **kwargs )
+
+    def head( self, header, **kwargs ):
+        return self.filter( lambda k: self.rowdex( k ) <= self.rowdex( header ), **kwargs )
+
+    def on_values( self, field, test, transposed=False, t=False, invert=False, v=False, new=False ):
+        """ filter rows on a vectorized test of one field's values """
+        transposed = any( [transposed, t] )
+        if transposed:
+            self.transpose( )
+        mask = test( self.field_values( field ) )
+        return self.filter_mask( mask, transposed=transposed, invert=any( [invert, v] ), new=new )
+
+    def apfilter( self, minabund=0, minprev=1, transposed=False, t=False, **kwargs ):
+        """ keep rows with >= minprev values >= minabund ( float minprev = fraction ) """
+        transposed = any( [transposed, t] )
+        if transposed:
+            self.transpose( )
+        if type( minprev ) is float:
+            self.report( "will interpret minimum prevalence", minprev, "as a fraction of samples" )
+            minprev = int( self.ncols * minprev )
+        # only stored ( nonzero ) cells can differ from zero
+        if minabund > 0:
+            counts = ( self.data >= minabund ).getnnz( axis=1 )
+        else:
+            counts = self.ncols - ( self.data < minabund ).getnnz( axis=1 )
+        return self.filter_mask( counts >= minprev, transposed=transposed, **kwargs )
+
+    # ---------------------------------------------------------------
+    # mathmatical operations
+    # ---------------------------------------------------------------
+
+    def colnorm( self, basis=1.0 ):
+        sums = np.asarray( self.data.sum( axis=0 ) ).ravel( )
+        scale = np.zeros( self.ncols )
+        scale[sums != 0] = basis / sums[sums != 0]
+        self.data = self.data.dot( sparse.diags( scale ) ).tocsr( )
+        return self
+
+    def rownorm( self, basis=1.0 ):
+        sums = np.asarray( self.data.sum( axis=1 ) ).ravel( )
+        scale = np.zeros( self.nrows )
+        scale[sums != 0] = basis / sums[sums != 0]
+        self.data = sparse.diags( scale ).dot( self.data ).tocsr( )
+        return self
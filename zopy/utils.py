@@ -6,8 +6,6 @@ import os
 import sys
 import re
 import csv
-import gzip
-import bz2
 from collections import defaultdict, OrderedDict
 from textwrap import fill
 
@@ -51,34 +49,23 @@ def pretty_progress( current, total, update=None ):
 # ---------------------------------------------------------------
 
 def try_open( path, mode="r", *args, **kwargs ):
-    """ open a (possibly compressed?) file; fail gracefully """
-    fh = None
+    """
+    open a (possibly compressed?) file; fail gracefully
+    compression is detected from magic bytes on read, extension on write
+    ( gzip/bgzf, bz2, xz, zstd, lz4; see zopy.compression )
+    """
+    # imported here: zopy.compression uses utils
+    from zopy.compression import open_compressed
+    verbose = kwargs.pop( "verbose", False )
+    external = kwargs.pop( "external", True )
     try:
-        # 1) load as gzip file
-        if path.endswith( ".gz" ):
-            say( "Treating", path, "as gzip file" )
-            # python 2/3 switching
-            if sys.version_info.major == 3:
-                opener = gzip.open
-                mode = "rt" if mode == "r" else mode
-            else:
-                opener = gzip.GzipFile
-            fh = opener( path, mode=mode, *args, **kwargs )
-        # 2) load as bz2 file
-        elif path.endswith( ".bz2" ):
-            say( "Treating", path, "as bzip2 file" )
-            # python 2/3 switching
-            if sys.version_info.major == 3:
-                opener = bz2.open
-                mode = "rt" if mode == "r" else mode
-            else:
-                opener = bz2.BZ2File
-            fh = opener( path, mode=mode, *args, **kwargs )
-        # 3) load as regular file
-        else:
-            fh = open( path, mode=mode, *args, **kwargs )
-    except:
-        die( "Problem opening", path )
+        fh = open_compressed( path, mode, external=external, **kwargs )
+        if fh is None:
+            fh = open( path, mode, *args, **kwargs )
+        elif verbose:
+            say( "Treating", path, "as compressed file" )
+    except ( IOError, OSError ) as e:
+        die( "Problem opening", path, "in mode", mode, "-", e )
     return fh
 
 def which( program ):